@@ -0,0 +1,140 @@
+"""Write cost against subset read latency of the NetCDF encoding profiles.
+
+Runs offline on a synthetic (time, y, x) grid. For every profile in
+erddapds.encoding.PROFILES, plus the uncompressed source encoding, it
+records the time to write the file, its size, the time to append a day
+of records in place, and the latency of the two typical ERDDAP subsets:
+one time slice of the whole grid and the full time series at one point.
+
+Usage:
+    python benchmarks/encoding.py --output encoding.json
+    python benchmarks/encoding.py --quick
+"""
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from netCDF4 import Dataset
+import xarray as xr
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import erddapds  # noqa: E402
+from erddapds.encoding import (PROFILES,  # noqa: E402
+                               apply_profile)
+from erddapds.ncutils import append_netcdf  # noqa: E402
+
+SHAPES = {'full': (2160, 200, 200), 'quick': (240, 100, 100)}
+
+
+def make_grid(t0, ntime, ny, nx):
+    # Smooth fields compress like model output, unlike white noise
+    t = np.arange(t0, t0 + ntime, dtype='f8')
+    y = np.linspace(0, np.pi, ny, dtype='f4')
+    x = np.linspace(0, np.pi, nx, dtype='f4')
+    base = (np.sin(y)[:, None] * np.cos(x)[None, :]).astype('f4')
+    temp = 10 + 5 * base[None] + np.sin(t / 24.0).astype('f4')[:, None, None]
+    ds = xr.Dataset(
+        {'temperature': (('time', 'y', 'x'), temp, {'units': 'degree_C'}),
+         'salinity': (('time', 'y', 'x'), 30 + temp / 10, {'units': '1e-3'})},
+        coords={'time': ('time', t, {'units': 'hours since 1970-01-01'}),
+                'y': np.arange(ny), 'x': np.arange(nx)})
+    return ds
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_profile(tmp, profile, shape, repeat):
+    ntime, ny, nx = shape
+    path = os.path.join(tmp, f'{profile}.nc')
+    ds = make_grid(0, ntime, ny, nx)
+    if profile != 'source':
+        apply_profile(ds, profile)
+
+    start = time.perf_counter()
+    ds.to_netcdf(path, unlimited_dims='time')
+    write = time.perf_counter() - start
+
+    newfile = os.path.join(tmp, 'append.nc')
+    make_grid(ntime, 24, ny, nx).to_netcdf(newfile, unlimited_dims='time')
+    start = time.perf_counter()
+    append_netcdf(path, newfile)
+    append = time.perf_counter() - start
+
+    def time_slice():
+        with Dataset(path) as nc:
+            nc.variables['temperature'][ntime // 2, :, :]
+
+    def time_series():
+        with Dataset(path) as nc:
+            nc.variables['temperature'][:, ny // 2, nx // 2]
+
+    chunks = ds['temperature'].encoding.get('chunksizes')
+    return {
+        'profile': profile,
+        'shape': list(shape),
+        'chunks': list(chunks) if chunks else None,
+        'write_seconds': write,
+        'append_seconds': append,
+        'size_mb': os.path.getsize(path) / 1024 ** 2,
+        'time_slice_seconds': timed(time_slice, repeat),
+        'time_series_seconds': timed(time_series, repeat),
+    }
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the NetCDF encoding profiles')
+    parser.add_argument('--quick', action='store_true', help='Small grid only')
+    parser.add_argument('--repeat', type=int, default=5, help='Reads per subset, best is kept')
+    parser.add_argument('--output', metavar='OUTPUT', help='Write JSON results here')
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    shape = SHAPES['quick' if args.quick else 'full']
+    results = {
+        'erddapds': erddapds.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': [],
+    }
+    print(f'{"profile":<18}{"write":>9}{"append":>9}{"MiB":>9}{"slice":>10}{"series":>10}  chunks')
+    for profile in ['source'] + list(PROFILES):
+        tmp = tempfile.mkdtemp(prefix='erddapds_encoding_')
+        try:
+            r = run_profile(tmp, profile, shape, args.repeat)
+        finally:
+            shutil.rmtree(tmp)
+        print(f'{r["profile"]:<18}{r["write_seconds"]:>9.3f}{r["append_seconds"]:>9.3f}'
+              f'{r["size_mb"]:>9.1f}{r["time_slice_seconds"]:>10.4f}'
+              f'{r["time_series_seconds"]:>10.4f}  {r["chunks"]}', flush=True)
+        results['results'].append(r)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
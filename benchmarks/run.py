@@ -0,0 +1,280 @@
+"""Benchmarks of the catalog and ingest hot paths.
+
+Runs offline: catalogs and NetCDF files are synthetic and fragments come
+from the GenerateDatasetsXml.sh stub next to this file. The inputs of a
+case are written beforehand by one child process, then the case runs in
+another freshly spawned one, so that its peak RSS is that of the operation
+measured and not of generating its inputs.
+
+Usage:
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --quick --compare results.json
+"""
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from lxml import etree
+import xarray as xr
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import erddapds  # noqa: E402
+from erddapds import ERDDAPDATASET, utils  # noqa: E402
+from erddapds.transform import TransformPlan  # noqa: E402
+
+GDS_STUB = os.path.join(HERE, 'stub', 'GenerateDatasetsXml.sh')
+
+DETAILS = {
+    'type': 'Timeseries',
+    'title': 'Benchmark NcFile',
+    'summary': 'Benchmark Summary',
+    'fileNameRegex': 'bench.nc',
+}
+
+DATASET = '''<dataset type="EDDTableFromNcCFFiles" datasetID="{dsid}" active="true">
+    <reloadEveryNMinutes>10080</reloadEveryNMinutes>
+    <fileDir>/data/{dsid}/</fileDir>
+    <fileNameRegex>.*\\.nc</fileNameRegex>
+    <addAttributes>
+        <att name="institution">Benchmark</att>
+        <att name="summary">Dataset {dsid}</att>
+        <att name="title">Dataset {dsid}</att>
+    </addAttributes>
+    <dataVariable>
+        <sourceName>temperature</sourceName>
+        <destinationName>temperature</destinationName>
+        <dataType>float</dataType>
+    </dataVariable>
+</dataset>
+'''
+
+
+def write_catalog(path, ndatasets):
+    with open(path, 'w', encoding='ISO-8859-1') as f:
+        f.write('<?xml version="1.0" encoding="ISO-8859-1" ?>\n<erddapDatasets>\n')
+        for i in range(ndatasets):
+            f.write(DATASET.format(dsid=f'bench_{i:06d}'))
+        f.write('</erddapDatasets>\n')
+
+
+def write_timeseries(path, t0, nrecords, nstations=10):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds = xr.Dataset(
+        {'temperature': (('time', 'station'),
+                         np.random.rand(nrecords, nstations).astype('f4'),
+                         {'units': 'degree_C', 'standard_name': 'sea_water_temperature'}),
+         'salinity': (('time', 'station'),
+                      np.random.rand(nrecords, nstations).astype('f4'),
+                      {'units': '1e-3'})},
+        coords={'time': ('time', np.arange(t0, t0 + nrecords, dtype='f8'),
+                         {'units': 'seconds since 1970-01-01', 'standard_name': 'time'}),
+                'station': np.arange(nstations)})
+    ds.attrs['featureType'] = 'timeSeries'
+    ds.to_netcdf(path, unlimited_dims='time')
+
+
+def large_fragment(nvars):
+    root = etree.fromstring(DATASET.format(dsid='large').encode())
+    root.remove(root.find('dataVariable'))
+    for name in ('time', 'depth', 'y', 'x'):
+        axis = etree.SubElement(root, 'axisVariable')
+        etree.SubElement(axis, 'sourceName').text = name
+        etree.SubElement(axis, 'destinationName').text = name
+        attrs = etree.SubElement(axis, 'addAttributes')
+        for att in ('long_name', 'source_name', 'standard_name', 'units'):
+            etree.SubElement(attrs, 'att', name=att).text = name
+    names = list(utils.VAR_COLOUR_RANGES) + [f'var_{i}' for i in range(nvars)]
+    for name in names[:nvars]:
+        var = etree.SubElement(root, 'dataVariable')
+        etree.SubElement(var, 'sourceName').text = name
+        etree.SubElement(var, 'destinationName').text = name
+        etree.SubElement(var, 'dataType').text = 'float'
+        attrs = etree.SubElement(var, 'addAttributes')
+        etree.SubElement(attrs, 'att', name='long_name').text = name
+    return root
+
+
+def prepare_catalog(tmp, ndatasets):
+    write_catalog(os.path.join(tmp, 'datasets.xml'), ndatasets)
+
+
+def prepare_timeseries(tmp, nrecords):
+    write_timeseries(os.path.join(tmp, 'data', 'bench.nc'), 0, nrecords)
+    write_timeseries(os.path.join(tmp, 'incoming', 'bench.nc'), nrecords, 100)
+
+
+def prepare_nothing(tmp, size):
+    pass
+
+
+def bench_add_to_datasetsxml(tmp, ndatasets):
+    dsxml = os.path.join(tmp, 'datasets.xml')
+    edd = ERDDAPDATASET('bench_new', details=DETAILS, variables={})
+    edd.generate_datasetxml('EDDTableFromNcCFFiles', tmp, 'bench.nc',
+                            gds_loc=GDS_STUB, big_parent_directory=tmp)
+    start = time.perf_counter()
+    edd.add_to_datasetsxml(dsxml)
+    return time.perf_counter() - start
+
+
+def bench_toggle_dataset(tmp, ndatasets):
+    dsxml = os.path.join(tmp, 'datasets.xml')
+    edd = ERDDAPDATASET(f'bench_{ndatasets // 2:06d}')
+    start = time.perf_counter()
+    edd._ERDDAPDATASET__toggle_dataset(tmp, dsxml, 'false')
+    return time.perf_counter() - start
+
+
+def bench_update_dataset(tmp, nrecords, mode='merge'):
+    datadir = os.path.join(tmp, 'data')
+    newnc = os.path.join(tmp, 'incoming', 'bench.nc')
+    edd = ERDDAPDATASET('bench')
+    start = time.perf_counter()
+    out = edd.update_dataset(datadir, newnc, tmp, os.path.join(tmp, 'datasets.xml'), mode=mode)
+    elapsed = time.perf_counter() - start
+    if isinstance(out, Exception):
+        raise out
+    return elapsed
+
+
+def bench_update_xml(tmp, nvars, compiled=False):
+    root = large_fragment(nvars)
+    metadata = copy.deepcopy(erddapds.core.METADATA)
+    start = time.perf_counter()
+    if compiled:
+        TransformPlan(metadata, DETAILS, {}).apply(root, 'large')
+    else:
+        utils.update_xml(root, 'large', metadata, DETAILS, {})
+    return time.perf_counter() - start
+
+
+# name: (inputs written before measuring, measured operation, size parameter)
+CASES = {
+    'add_to_datasetsxml': (prepare_catalog, bench_add_to_datasetsxml, 'ndatasets'),
+    'toggle_dataset': (prepare_catalog, bench_toggle_dataset, 'ndatasets'),
+    'update_dataset_merge': (prepare_timeseries,
+                             lambda tmp, n: bench_update_dataset(tmp, n, 'merge'), 'nrecords'),
+    'update_dataset_append': (prepare_timeseries,
+                              lambda tmp, n: bench_update_dataset(tmp, n, 'append'), 'nrecords'),
+    'update_xml': (prepare_nothing, bench_update_xml, 'nvars'),
+    'update_xml_compiled': (prepare_nothing,
+                            lambda tmp, n: bench_update_xml(tmp, n, compiled=True), 'nvars'),
+}
+
+SIZES = {
+    'ndatasets': [100, 1000, 10000, 50000],
+    'nrecords': [1000, 10000, 100000, 1000000],
+    'nvars': [10, 100, 500],
+}
+
+QUICK_SIZES = {
+    'ndatasets': [100, 1000],
+    'nrecords': [1000, 10000],
+    'nvars': [10, 100],
+}
+
+
+def run_case(name, size, repeat, inputs):
+    """Run a case repeat times on copies of its inputs, in the current process.
+    """
+    _, func, _ = CASES[name]
+    times = []
+    for _ in range(repeat):
+        tmp = tempfile.mkdtemp(prefix='erddapds_bench_')
+        try:
+            # Copied file by file, the inputs never go through this process memory
+            shutil.copytree(inputs, tmp, dirs_exist_ok=True)
+            os.makedirs(os.path.join(tmp, 'flag'))
+            times.append(func(tmp, size))
+        finally:
+            shutil.rmtree(tmp)
+    return {
+        'case': name,
+        'size': size,
+        'repeat': repeat,
+        'seconds': min(times),
+        'mean_seconds': sum(times) / len(times),
+        # ru_maxrss is in KiB on Linux, bytes on macOS
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (
+            1024 if sys.platform == 'darwin' else 1),
+    }
+
+
+def compare(results, baseline):
+    old = {(r['case'], r['size']): r for r in baseline['results']}
+    print(f'{"case":<24}{"size":>10}{"seconds":>12}{"baseline":>12}{"ratio":>8}')
+    for r in results['results']:
+        b = old.get((r['case'], r['size']))
+        if b is None:
+            continue
+        ratio = r['seconds'] / b['seconds'] if b['seconds'] else float('inf')
+        print(f'{r["case"]:<24}{r["size"]:>10}{r["seconds"]:>12.4f}{b["seconds"]:>12.4f}{ratio:>8.2f}')
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark erddapds hot paths')
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=sorted(CASES),
+                        help='Cases to run')
+    parser.add_argument('--quick', action='store_true', help='Small sizes only')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case, best is kept')
+    parser.add_argument('--output', metavar='OUTPUT', help='Write JSON results here')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results to compare against')
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    sizes = QUICK_SIZES if args.quick else SIZES
+    results = {
+        'erddapds': erddapds.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': [],
+    }
+    # Linux keeps the peak RSS of a process across fork and exec, so the inputs
+    # are generated out of this process too, which stays at its import footprint
+    context = multiprocessing.get_context('spawn')
+    for name in args.cases:
+        prepare, _, param = CASES[name]
+        for size in sizes[param]:
+            inputs = tempfile.mkdtemp(prefix='erddapds_bench_inputs_')
+            try:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    pool.submit(prepare, inputs, size).result()
+                # A fresh process per case keeps peak RSS attributable to it
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    r = pool.submit(run_case, name, size, args.repeat, inputs).result()
+            finally:
+                shutil.rmtree(inputs)
+            print(f'{r["case"]:<24}{r["size"]:>10}{r["seconds"]:>12.4f}s'
+                  f'{r["peak_rss_kb"] / 1024:>10.1f} MiB', flush=True)
+            results['results'].append(r)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+#!/bin/bash
+# Offline stand-in for ERDDAP's GenerateDatasetsXml.sh used by the benchmarks.
+# Prints a minimal fragment for the EDD type ($1), data directory ($2)
+# and fileNameRegex ($3) it is called with.
+echo "GenerateDatasetsXml stub starting"
+cat <<XML
+<dataset type="$1" datasetID="stub_generated" active="true">
+    <reloadEveryNMinutes>10080</reloadEveryNMinutes>
+    <fileDir>$2</fileDir>
+    <fileNameRegex>$3</fileNameRegex>
+    <addAttributes>
+        <att name="cdm_data_type">TimeSeries</att>
+        <att name="institution">???</att>
+        <att name="keywords">temperature</att>
+        <att name="summary">stub</att>
+        <att name="title">stub</att>
+    </addAttributes>
+    <dataVariable>
+        <sourceName>time</sourceName>
+        <destinationName>time</destinationName>
+        <dataType>double</dataType>
+        <addAttributes>
+            <att name="ioos_category">Time</att>
+        </addAttributes>
+    </dataVariable>
+    <dataVariable>
+        <sourceName>temperature</sourceName>
+        <destinationName>temperature</destinationName>
+        <dataType>float</dataType>
+        <addAttributes>
+            <att name="ioos_category">Unknown</att>
+        </addAttributes>
+    </dataVariable>
+</dataset>
+XML
+echo "GenerateDatasetsXml stub finished"
@@ -0,0 +1,331 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import hashlib
+import os
+import re
+import sqlite3
+from collections import OrderedDict
+
+from lxml import etree
+
+from erddapds.datasetsxml import (ENCODING,
+                                  scan_datasets)
+from erddapds.flags import FlagWriter
+from erddapds.transaction import Transaction
+
+# Global attributes of a dataset kept in the catalog
+KEY_ATTRIBUTES = ('title', 'summary', 'institution', 'project', 'cdm_data_type',
+                  'featureType', 'infoUrl', 'creator_name')
+
+_VERSION = '1'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS datasets (
+    dsid TEXT PRIMARY KEY, position INTEGER, digest TEXT, type TEXT,
+    active INTEGER, fileDir TEXT, fileNameRegex TEXT);
+CREATE TABLE IF NOT EXISTS variables (dsid TEXT, name TEXT, PRIMARY KEY (dsid, name));
+CREATE TABLE IF NOT EXISTS attributes (dsid TEXT, name TEXT, value TEXT,
+                                       PRIMARY KEY (dsid, name));
+CREATE INDEX IF NOT EXISTS variables_name ON variables (name);
+CREATE INDEX IF NOT EXISTS attributes_name ON attributes (name, value);
+CREATE INDEX IF NOT EXISTS datasets_active ON datasets (active);
+'''
+
+# datasets columns find() filters on, in the order of its arguments
+_COLUMNS = ('type', 'fileDir', 'fileNameRegex')
+
+
+def _text(node, path):
+    value = node.findtext(path)
+    return value.strip() if value is not None else None
+
+
+def summarize(fragment):
+    """Catalog summary of one dataset fragment.
+
+    Args:
+        fragment (lxml.etree._Element, str or bytes): Dataset fragment.
+
+    Returns:
+        dict: datasetID, type, active, fileDir, fileNameRegex, variables
+        (destination names, in order) and attributes (KEY_ATTRIBUTES found
+        in the global addAttributes).
+    """
+    if isinstance(fragment, (str, bytes)):
+        if isinstance(fragment, str):
+            fragment = fragment.encode(ENCODING)
+        parser = etree.XMLParser(remove_blank_text=True, encoding=ENCODING)
+        fragment = etree.fromstring(fragment.strip(), parser)
+
+    variables = []
+    for var in fragment.iterchildren('dataVariable', 'axisVariable'):
+        name = _text(var, 'destinationName') or _text(var, 'sourceName')
+        if name and name not in variables:
+            variables.append(name)
+    attributes = OrderedDict()
+    for att in fragment.iterfind('addAttributes/att'):
+        if att.get('name') in KEY_ATTRIBUTES:
+            attributes[att.get('name')] = (att.text or '').strip()
+
+    return {
+        'datasetID': fragment.get('datasetID'),
+        'type': fragment.get('type'),
+        # ERDDAP treats a dataset without the attribute as active
+        'active': fragment.get('active', 'true').strip().lower() != 'false',
+        'fileDir': _text(fragment, 'fileDir'),
+        'fileNameRegex': _text(fragment, 'fileNameRegex'),
+        'variables': variables,
+        'attributes': attributes,
+    }
+
+
+def _regexp(pattern, value):
+    return value is not None and re.search(pattern, value) is not None
+
+
+def _match(column, value):
+    if isinstance(value, re.Pattern):
+        return f'{column} REGEXP ?'
+    return f'{column} = ?'
+
+
+def _pattern(value):
+    return value.pattern if isinstance(value, re.Pattern) else value
+
+
+class Catalog(object):
+    """Queryable summary of the datasets of datasets.xml, kept in SQLite.
+
+    Every top level dataset is summarized once, see summarize, and stored in
+    ``<dsxml>.catalog``. The catalog is refreshed before every query: nothing
+    is read while the mtime and size of datasets.xml are the ones recorded,
+    and only the datasets whose bytes changed are parsed again otherwise.
+
+    Args:
+        dsxml (str): datasets.xml location.
+        path (str): Catalog location, defaults to ``<dsxml>.catalog``.
+
+    Example:
+        >>> catalog = Catalog('/erddap/content/datasets.xml')
+        >>> catalog.find(active=False)
+        >>> catalog.find(variables='salinity', fileNameRegex=re.compile(r'mooring'))
+        >>> catalog.set_active(catalog.find(attributes={'project': 'OOI'}), False, bpd)
+    """
+
+    def __init__(self, dsxml, path=None):
+        self.dsxml = os.path.abspath(dsxml)
+        self.path = path or f'{self.dsxml}.catalog'
+        self.__conn = None
+
+    def __repr__(self):
+        return f'<Catalog: {self.dsxml}>'
+
+    def __contains__(self, dsid):
+        return self.get(dsid) is not None
+
+    def __len__(self):
+        self.refresh()
+        return self.conn.execute('SELECT COUNT(*) FROM datasets').fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.find())
+
+    @property
+    def conn(self):
+        if self.__conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.create_function('REGEXP', 2, _regexp, deterministic=True)
+            row = None
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            except sqlite3.OperationalError:
+                pass
+            if row is None or row[0] != _VERSION:
+                conn.executescript('DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS datasets;'
+                                   'DROP TABLE IF EXISTS variables;'
+                                   'DROP TABLE IF EXISTS attributes;')
+                conn.executescript(_SCHEMA)
+                conn.execute("INSERT INTO meta VALUES ('version', ?)", (_VERSION,))
+            self.__conn = conn
+        return self.__conn
+
+    def close(self):
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+    def refresh(self):
+        """Bring the catalog up to date with datasets.xml.
+
+        Returns:
+            int: Number of datasets added, changed or removed.
+        """
+        conn = self.conn
+        with open(self.dsxml, 'rb') as f:
+            st = os.fstat(f.fileno())
+            stat = f'{st.st_mtime_ns}:{st.st_size}'
+            row = conn.execute("SELECT value FROM meta WHERE key = 'stat'").fetchone()
+            if row is not None and row[0] == stat:
+                return 0
+            data = f.read()
+
+        found, _ = scan_datasets(data)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            known = {dsid: (position, digest) for dsid, position, digest
+                     in conn.execute('SELECT dsid, position, digest FROM datasets')}
+            seen = set()
+            changed = 0
+            for position, (dsid, start, end) in enumerate(found):
+                # First one wins, as in the DatasetsXML index
+                if dsid is None or dsid in seen:
+                    continue
+                seen.add(dsid)
+                digest = hashlib.sha256(data[start:end]).hexdigest()
+                if dsid in known and known[dsid][1] == digest:
+                    if known[dsid][0] != position:
+                        conn.execute('UPDATE datasets SET position = ? WHERE dsid = ?',
+                                     (position, dsid))
+                    continue
+                self._store(conn, dsid, position, digest, summarize(data[start:end]))
+                changed += 1
+
+            removed = [dsid for dsid in known if dsid not in seen]
+            for dsid in removed:
+                self._delete(conn, dsid)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('stat', ?)", (stat,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return changed + len(removed)
+
+    def rebuild(self):
+        """Summarize every dataset of datasets.xml again.
+        """
+        conn = self.conn
+        conn.execute("DELETE FROM meta WHERE key = 'stat'")
+        for table in ('datasets', 'variables', 'attributes'):
+            conn.execute(f'DELETE FROM {table}')
+        return self.refresh()
+
+    @staticmethod
+    def _delete(conn, dsid):
+        for table in ('datasets', 'variables', 'attributes'):
+            conn.execute(f'DELETE FROM {table} WHERE dsid = ?', (dsid,))
+
+    def _store(self, conn, dsid, position, digest, summary):
+        self._delete(conn, dsid)
+        conn.execute('INSERT INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (dsid, position, digest, summary['type'], int(summary['active']),
+                      summary['fileDir'], summary['fileNameRegex']))
+        conn.executemany('INSERT INTO variables VALUES (?, ?)',
+                         [(dsid, name) for name in summary['variables']])
+        conn.executemany('INSERT INTO attributes VALUES (?, ?, ?)',
+                         [(dsid, k, v) for k, v in summary['attributes'].items()])
+
+    def get(self, dsid):
+        """Return the summary of the dataset dsid, see summarize, or None.
+        """
+        self.refresh()
+        row = self.conn.execute('SELECT type, active, fileDir, fileNameRegex FROM datasets '
+                                'WHERE dsid = ?', (dsid,)).fetchone()
+        if row is None:
+            return None
+        variables = [name for name, in self.conn.execute(
+            'SELECT name FROM variables WHERE dsid = ? ORDER BY rowid', (dsid,))]
+        attributes = OrderedDict(self.conn.execute(
+            'SELECT name, value FROM attributes WHERE dsid = ? ORDER BY rowid', (dsid,)))
+        return {'datasetID': dsid, 'type': row[0], 'active': bool(row[1]),
+                'fileDir': row[2], 'fileNameRegex': row[3],
+                'variables': variables, 'attributes': attributes}
+
+    def find(self, active=None, edd_type=None, fileDir=None, fileNameRegex=None,
+             variables=None, attributes=None):
+        """datasetIDs, in datasets.xml order, of the datasets matching every filter given.
+
+        String filters match exactly; a compiled regular expression matches
+        with re.search instead.
+
+        Args:
+            active (bool): Active or inactive datasets only.
+            edd_type (str or re.Pattern): Dataset type, e.g. EDDTableFromNcCFFiles.
+            fileDir (str or re.Pattern): fileDir.
+            fileNameRegex (str or re.Pattern): fileNameRegex.
+            variables (str or list): Destination name(s) the dataset must all have.
+            attributes (dict): Global attribute name -> value (str or re.Pattern),
+                among KEY_ATTRIBUTES.
+
+        Returns:
+            list: datasetIDs.
+        """
+        self.refresh()
+        where, params = [], []
+        if active is not None:
+            where.append('active = ?')
+            params.append(int(bool(active)))
+        for column, value in zip(_COLUMNS, (edd_type, fileDir, fileNameRegex)):
+            if value is not None:
+                where.append(_match(column, value))
+                params.append(_pattern(value))
+        if isinstance(variables, str):
+            variables = [variables]
+        for name in variables or ():
+            where.append('dsid IN (SELECT dsid FROM variables WHERE name = ?)')
+            params.append(name)
+        for name, value in (attributes or {}).items():
+            where.append('dsid IN (SELECT dsid FROM attributes '
+                         f'WHERE name = ? AND {_match("value", value)})')
+            params.extend([name, _pattern(value)])
+
+        sql = 'SELECT dsid FROM datasets'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return [dsid for dsid, in self.conn.execute(sql + ' ORDER BY position', params)]
+
+    def set_active(self, dsids, active, bpd=None, timeout=60.0):
+        """Activate or deactivate many datasets in one write of datasets.xml.
+
+        Datasets already in the requested state are left alone. The reload
+        flags of the datasets changed are written together when bpd is given.
+
+        Args:
+            dsids (list): datasetIDs, e.g. the result of find.
+            active (bool): New state.
+            bpd (str): Big Parent Directory location, to flag the datasets for reload.
+            timeout (float): Seconds to wait for the datasets.xml lock.
+
+        Returns:
+            OrderedDict: Status message, or the exception raised, for each dataset.
+        """
+        self.refresh()
+        results = OrderedDict()
+        txn = Transaction(self.dsxml, timeout=timeout)
+        state = 'active' if active else 'inactive'
+        for dsid in dsids:
+            summary = self.get(dsid)
+            if summary is None:
+                results[dsid] = KeyError(f'{dsid} not found in {self.dsxml}')
+            elif summary['active'] == bool(active):
+                results[dsid] = f'Dataset already {state}.'
+            else:
+                txn.toggle(dsid, bool(active))
+                results[dsid] = None
+
+        committed = txn.commit_each()
+        flags = FlagWriter(bpd) if bpd else None
+        for dsid, error in committed.items():
+            if error is None:
+                results[dsid] = f'Dataset set {state}.'
+                if flags is not None:
+                    flags.flag(dsid)
+            else:
+                results[dsid] = error
+        if flags is not None:
+            flags.flush()
+        self.refresh()
+        return results
@@ -0,0 +1,251 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import hashlib
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from netCDF4 import Dataset
+
+from erddapds.ncutils import parse_size
+
+SAMPLE_SIZE = 4096
+
+
+class VariableStats(object):
+    """Mergeable summary of the valid values of one variable.
+
+    Holds the exact minimum, maximum and count, and a uniform random sample
+    of at most sample_size values. Every value gets a random key and the
+    sample keeps the values with the smallest keys, so merging two summaries
+    and keeping the smallest keys again is a uniform sample of the union.
+
+    Args:
+        sample_size (int): Maximum number of sampled values.
+    """
+
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.values = np.empty(0, dtype='f8')
+        self.keys = np.empty(0, dtype='f8')
+
+    def __repr__(self):
+        return f'<VariableStats: {self.count} values in [{self.min}, {self.max}]>'
+
+    def _keep(self, values, keys):
+        if len(values) > self.sample_size:
+            idx = np.argpartition(keys, self.sample_size - 1)[:self.sample_size]
+            values, keys = values[idx], keys[idx]
+        self.values, self.keys = values, keys
+
+    def add(self, values, rng):
+        """Add a block of valid values.
+        """
+        values = np.asarray(values, dtype='f8').ravel()
+        if not len(values):
+            return
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._keep(np.concatenate([self.values, values]),
+                   np.concatenate([self.keys, rng.random(len(values))]))
+
+    def merge(self, other):
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._keep(np.concatenate([self.values, other.values]),
+                   np.concatenate([self.keys, other.keys]))
+        return self
+
+    def range(self, percentiles=None):
+        """Return (minimum, maximum), or the percentiles of the sample.
+
+        Args:
+            percentiles (tuple): (low, high) percentiles, e.g. (2, 98),
+                None for the exact minimum and maximum.
+        """
+        if not self.count:
+            return None
+        if percentiles is None:
+            return float(self.min), float(self.max)
+        low, high = np.percentile(self.values, percentiles)
+        return float(low), float(high)
+
+    def save(self, path):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, count=self.count, min=self.min, max=self.max,
+                     values=self.values, keys=self.keys)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, sample_size=SAMPLE_SIZE):
+        with np.load(path) as npz:
+            stats = cls(sample_size=sample_size)
+            stats.count = int(npz['count'])
+            stats.min = float(npz['min'])
+            stats.max = float(npz['max'])
+            stats.values = npz['values']
+            stats.keys = npz['keys']
+        return stats
+
+
+def range_variables(ncfile):
+    """Names of the numeric variables of ncfile a colorBar range makes sense for.
+
+    Coordinate variables of unlimited dimensions, e.g. time, are left out.
+    """
+    with Dataset(ncfile, 'r') as nc:
+        names = []
+        for name, var in nc.variables.items():
+            if var.dtype == str or getattr(var.dtype, 'kind', 'S') not in 'iuf':
+                continue
+            if (var.dimensions == (name,) and name in nc.dimensions
+                    and nc.dimensions[name].isunlimited()):
+                continue
+            if var.ndim:
+                names.append(name)
+        return names
+
+
+def variable_stats(ncfile, name, block_bytes='64MB', sample_size=SAMPLE_SIZE):
+    """Summarize the valid values of the variable name of ncfile, a block at a time.
+
+    Masked values (_FillValue, missing_value, valid_min/max) and non finite
+    ones are left out; scale_factor and add_offset are applied.
+
+    Args:
+        ncfile (str): NetCDF file.
+        name (str): Variable name.
+        block_bytes (int or str): Size of the blocks read along the first dimension.
+        sample_size (int): Maximum number of sampled values.
+
+    Returns:
+        VariableStats
+    """
+    # Seeded per file and variable so cached and recomputed samples agree
+    seed = int(hashlib.sha256(f'{os.path.abspath(ncfile)}\0{name}'.encode()).hexdigest()[:8], 16)
+    rng = np.random.default_rng(seed)
+    stats = VariableStats(sample_size=sample_size)
+    with Dataset(ncfile, 'r') as nc:
+        var = nc.variables[name]
+        if not var.ndim:
+            return stats
+        row = var.dtype.itemsize * int(np.prod(var.shape[1:], dtype='i8'))
+        step = max(1, parse_size(block_bytes) // max(row, 1))
+        for start in range(0, var.shape[0], step):
+            block = np.ma.masked_invalid(var[start:start + step])
+            stats.add(np.ma.compressed(block), rng)
+    return stats
+
+
+class RangeCache(object):
+    """On-disk cache of VariableStats, keyed by file fingerprint and variable.
+
+    A file is only scanned again once its path, size or mtime changed.
+
+    Args:
+        cache_dir (str): Cache directory.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return f'<RangeCache: {self.cache_dir}>'
+
+    def path(self, ncfile, name, sample_size=SAMPLE_SIZE):
+        st = os.stat(ncfile)
+        key = f'{os.path.abspath(ncfile)}\0{st.st_size}\0{st.st_mtime_ns}\0{name}\0{sample_size}'
+        return os.path.join(self.cache_dir, f'{hashlib.sha256(key.encode()).hexdigest()}.npz')
+
+    def get(self, ncfile, name, sample_size=SAMPLE_SIZE):
+        try:
+            return VariableStats.load(self.path(ncfile, name, sample_size), sample_size)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def put(self, ncfile, name, stats):
+        stats.save(self.path(ncfile, name, stats.sample_size))
+
+
+def _format(value):
+    return f'{value:.6g}'
+
+
+def compute_ranges(ncfiles, variables=None, percentiles=None, cache_dir=None,
+                   workers=4, block_bytes='64MB', sample_size=SAMPLE_SIZE):
+    """Compute colorBarMinimum and colorBarMaximum from the data of ncfiles.
+
+    Every (file, variable) pair is scanned in its own worker process, a
+    block at a time, and only if it is not in the cache already.
+
+    Args:
+        ncfiles (list): NetCDF files of the dataset.
+        variables (list): Variables to compute ranges for, defaults to the
+            numeric variables of every file, see range_variables.
+        percentiles (tuple): (low, high) percentiles, e.g. (2, 98), for
+            ranges robust to outliers. None for the minimum and maximum.
+        cache_dir (str): RangeCache directory, None to not cache.
+        workers (int): Worker processes, 1 to scan in this process.
+        block_bytes (int or str): Size of the blocks read at a time.
+        sample_size (int): Values sampled per variable for the percentiles.
+
+    Returns:
+        dict: Variable -> {'colorBarMinimum': str, 'colorBarMaximum': str},
+        in the form of utils.VAR_COLOUR_RANGES.
+    """
+    cache = RangeCache(cache_dir) if cache_dir else None
+    merged = {}
+    jobs = []
+    for ncfile in ncfiles:
+        names = variables or range_variables(ncfile)
+        with Dataset(ncfile, 'r') as nc:
+            names = [n for n in names if n in nc.variables]
+        for name in names:
+            stats = cache.get(ncfile, name, sample_size) if cache is not None else None
+            if stats is None:
+                jobs.append((ncfile, name))
+            else:
+                merged[name] = merged[name].merge(stats) if name in merged else stats
+
+    if workers == 1 or len(jobs) < 2:
+        results = [variable_stats(f, n, block_bytes, sample_size) for f, n in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(variable_stats, *zip(*jobs),
+                                    [block_bytes] * len(jobs), [sample_size] * len(jobs)))
+    for (ncfile, name), stats in zip(jobs, results):
+        if cache is not None:
+            cache.put(ncfile, name, stats)
+        merged[name] = merged[name].merge(stats) if name in merged else stats
+
+    ranges = {}
+    for name, stats in merged.items():
+        bounds = stats.range(percentiles)
+        if bounds is not None:
+            ranges[name] = {'colorBarMinimum': _format(bounds[0]),
+                            'colorBarMaximum': _format(bounds[1])}
+    return ranges
+
+
+def dataset_ranges(datadir, regex='.*', **kwargs):
+    """compute_ranges over the files of datadir whose name matches regex.
+    """
+    pattern = re.compile(regex or '.*')
+    ncfiles = []
+    for dirpath, dirnames, filenames in os.walk(datadir):
+        dirnames.sort()
+        ncfiles.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                       if pattern.fullmatch(f))
+    return compute_ranges(ncfiles, **kwargs)
@@ -3,18 +3,44 @@ from __future__ import (absolute_import,
                         print_function,
                         unicode_literals)
 
+import glob
+import hashlib
 import os
 import sys
 import shutil
+import tempfile
+import time
 from collections import OrderedDict
-import subprocess
 
 from lxml import etree
+import numpy as np
 import xarray as xr
 
-from erddapds.utils import (update_xml,
-                            print_tree,
+from erddapds.colorbar import dataset_ranges
+from erddapds.datasetsxml import DatasetsXML
+from erddapds.encoding import apply_profile
+from erddapds.generate import (extract_fragment,
+                               native_fragment,
+                               run_generate_datasets_xml)
+from erddapds.metrics import phase
+from erddapds.ncutils import (CHECKPOINT_BUDGET,
+                              PARTITION_FORMATS,
+                              append_netcdf,
+                              dedup_netcdf,
+                              list_partitions,
+                              merge_datasets,
+                              partition_keys,
+                              partition_path,
+                              time_block_size,
+                              write_checkpointed)
+from erddapds.transaction import (FileLock,
+                                  Transaction)
+from erddapds.transform import TransformPlan
+from erddapds.utils import (print_tree,
                             update_datasetsxml)
+from erddapds.zarrstore import (append_zarr,
+                                netcdf_to_zarr,
+                                zarr_path)
 
 METADATA = OrderedDict([
     ('infoUrl', {
@@ -62,13 +88,52 @@ METADATA = OrderedDict([
 DETAILS = OrderedDict()
 VARIABLES = OrderedDict()
 
+# gds: shell out to ERDDAP's GenerateDatasetsXml.sh
+# native: read the NetCDF headers in process, see erddapds.generate.native_fragment
+BACKENDS = ('gds', 'native')
+
+
+def _remove_ingested(newFiles):
+    """Remove the ingested newFiles, then their directories once empty.
+
+    Anything else delivered next to them is left alone, as is a merge_tmp
+    still holding a journal to resume from.
+    """
+    for newFile in newFiles:
+        if os.path.exists(newFile):
+            os.remove(newFile)
+    for newdir in sorted({os.path.dirname(os.path.abspath(f)) for f in newFiles}):
+        for path in (os.path.join(newdir, 'merge_tmp'), newdir):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+
+# Lock files of the partitioned datasets, kept out of the data directories ERDDAP scans
+LOCK_DIR = os.path.join(tempfile.gettempdir(), 'erddapds_locks')
+
+
+def _partitions_lock(datadir, fname):
+    """Lock serializing the writers and the compaction of the partitions of fname.
+    """
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    key = hashlib.sha1(os.path.join(os.path.abspath(datadir), fname).encode()).hexdigest()
+    return FileLock(os.path.join(LOCK_DIR, f'{key}.lock'), timeout=None)
+
 
 class ERDDAPDATASET(object):
-    def __init__(self, dsid, details=DETAILS, variables=VARIABLES, metadata=METADATA, **kwargs):
+    def __init__(self, dsid, details=DETAILS, variables=VARIABLES, metadata=METADATA,
+                 backend='gds', plan=None, colorbar=None, **kwargs):
         self.dsid = dsid
         self.details = details
         self.variables = variables
         self.metadata = metadata
+        self.backend = backend
+        self.plan = plan
+        # True, or dataset_ranges options such as {'percentiles': [2, 98], 'cache_dir': ...},
+        # to compute colorBar ranges from the data instead of utils.VAR_COLOUR_RANGES
+        self.colorbar = colorbar
         self.__dsfragment = None
         self.__bpd = None
 
@@ -87,43 +152,91 @@ class ERDDAPDATASET(object):
         if self.variables:
             assert isinstance(self.variables, dict), f'{self.variables} is not a dictionary'
         assert isinstance(self.metadata, dict), f'{self.metadata} is not a dictionary'
+        assert self.backend in BACKENDS, f'{self.backend} is not one of {BACKENDS}'
 
-    def generate_datasetxml(self, *args, gds_loc='', big_parent_directory=''):
+    def __gds_fragment(self, args, gds_loc, big_parent_directory, cache):
         if gds_loc:
             if os.path.basename(gds_loc) == 'GenerateDatasetsXml.sh':
                 try:
-                    os.chdir(os.path.dirname(gds_loc))
-                    prog = ['/bin/bash', gds_loc]
-                    cmd = prog + list(map(lambda x: str(x), args))
+                    with phase('generate_datasetxml', 'cache', self.dsid) as m:
+                        key = cache.key(gds_loc, args) if cache is not None else None
+                        fragment = cache.get(key) if key is not None else None
+                        if fragment is not None:
+                            m.add(nbytes=len(fragment), records=1)
 
-                    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    if fragment is not None:
+                        print(f'Dataset template for {self.dsid} found in {cache}.')
+                        return fragment
 
-                    out, err = p.communicate()
+                    with phase('generate_datasetxml', 'gds', self.dsid) as m:
+                        returncode, out, err = run_generate_datasets_xml(gds_loc, args)
+                        m.add(nbytes=len(out))
 
-                    if p.returncode == 0:
-                        self.__bpd = big_parent_directory
+                    if returncode != 0:
+                        print(f'Dataset template generation failed, '
+                              f'exit-code={int(returncode)} error = {str(err)}')
+                        return None
+
+                    # Read this run's own output, the shared log is only
+                    # a fallback since concurrent runs overwrite it
+                    fragment = extract_fragment(out)
+                    if fragment is not None:
+                        print(f'Dataset template sucessfully generated for {self.dsid}.')
+                    else:
                         outlog = os.path.join(os.path.abspath(big_parent_directory),
                                               'logs', 'GenerateDatasetsXml.out')
 
                         print(f'Dataset template sucessfully generated. See: {outlog}')
 
-                        parser = etree.XMLParser(remove_blank_text=True)
-                        tree = etree.parse(outlog, parser)
-                        self.__dsfragment = tree.getroot()
-                        # finalizing dataset fragment
-                        update_xml(root=self.__dsfragment,
-                                   datasetID=self.dsid,
-                                   metadata=self.metadata,
-                                   details=self.details,
-                                   dataset_vars=self.variables)
-
-                        return self.__dsfragment
-                    else:
-                        print(f'Dataset template generation failed, '
-                              f'exit-code={int(p.returncode)} error = {str(err)}')
+                        with open(outlog, 'rb') as f:
+                            fragment = f.read()
+                    if key is not None:
+                        cache.put(key, fragment)
+                    return fragment
 
                 except OSError as e:
-                    sys.exit(f'failed to execute program \'{prog}\': {str(e)}')
+                    sys.exit(f'failed to execute program \'{gds_loc}\': {str(e)}')
+
+    def __colour_ranges(self, datadir, regex):
+        options = {} if self.colorbar is True else dict(self.colorbar)
+        if options.get('percentiles') is not None:
+            options['percentiles'] = tuple(options['percentiles'])
+        ranges = dataset_ranges(datadir, regex, **options)
+        renames = self.variables or {}
+        return {renames.get(name, {}).get('destinationName', name): r
+                for name, r in ranges.items()}
+
+    def generate_datasetxml(self, *args, gds_loc='', big_parent_directory='', cache=None):
+        if self.backend == 'native':
+            with phase('generate_datasetxml', 'native', self.dsid) as m:
+                fragment = native_fragment(*args)
+                m.add(nbytes=len(fragment))
+            print(f'Dataset template sucessfully generated for {self.dsid}.')
+        else:
+            fragment = self.__gds_fragment(args, gds_loc, big_parent_directory, cache)
+
+        colour_ranges = None
+        if fragment is not None and self.colorbar and len(args) > 1 and os.path.isdir(args[1]):
+            with phase('generate_datasetxml', 'colorbar', self.dsid) as m:
+                colour_ranges = self.__colour_ranges(args[1], args[2] if len(args) > 2 else '.*')
+                m.add(records=len(colour_ranges))
+
+        if fragment is not None:
+            with phase('generate_datasetxml', 'transform', self.dsid) as m:
+                self.__bpd = big_parent_directory
+                parser = etree.XMLParser(remove_blank_text=True)
+                self.__dsfragment = etree.fromstring(fragment.strip(), parser)
+                # finalizing dataset fragment, same output as utils.update_xml
+                if self.plan is None:
+                    self.plan = TransformPlan(metadata=self.metadata,
+                                              details=self.details,
+                                              dataset_vars=self.variables)
+                regex = self.details.get('fileNameRegex') if self.details else None
+                self.plan.apply(self.__dsfragment, datasetID=self.dsid, fileNameRegex=regex,
+                                colour_ranges=colour_ranges)
+                m.add(nbytes=len(fragment), records=1)
+
+            return self.__dsfragment
 
     def export_datasetxml(self):
         if self.__dsfragment is not None:
@@ -138,17 +251,18 @@ class ERDDAPDATASET(object):
         if dsxml:
             if os.path.basename(dsxml) == 'datasets.xml':
                 try:
-                    with open(dsxml, 'rb') as xml:
-                        tree = etree.XML(xml.read())
-
                     if self.__dsfragment is not None:
-                        tree.append(self.__dsfragment)
-
-                    with open(dsxml, 'wb') as fil:
-                        rtree = tree.getroottree()
-                        rtree.write(fil, xml_declaration=True, encoding='ISO-8859-1')
-
-                    return update_datasetsxml(self.__bpd, self.dsid)
+                        with phase('add_to_datasetsxml', 'datasetsxml', self.dsid) as m:
+                            # Same content already there: no write, no reload
+                            if DatasetsXML(dsxml).unchanged(self.__dsfragment):
+                                print(f'Dataset {self.dsid} unchanged.')
+                                return None
+                            with Transaction(dsxml) as txn:
+                                txn.put(self.__dsfragment)
+                            m.add(nbytes=os.path.getsize(dsxml), records=1)
+
+                    with phase('add_to_datasetsxml', 'flag', self.dsid):
+                        return update_datasetsxml(self.__bpd, self.dsid)
                 except OSError as e:
                     sys.exit(f'failed to execute program {str(e)}')
 
@@ -156,44 +270,345 @@ class ERDDAPDATASET(object):
         if dsxml:
             if os.path.basename(dsxml) == 'datasets.xml':
                 try:
-                    with open(dsxml, 'rb') as xml:
-                        tree = etree.XML(xml.read())
-
-                    all_datasets = list(filter(lambda el: el.tag == 'dataset', tree.iterchildren()))
-                    dds = list(filter(lambda x: x.attrib['datasetID'] == self.dsid, all_datasets))[0]
-
                     if active:
-                        dds.attrib['active'] = active
+                        with phase('toggle_dataset', 'datasetsxml', self.dsid) as m:
+                            with Transaction(dsxml) as txn:
+                                txn.toggle(self.dsid, active)
+                            m.add(nbytes=os.path.getsize(dsxml), records=1)
 
-                    with open(dsxml, 'wb') as fil:
-                        rtree = tree.getroottree()
-                        rtree.write(fil, xml_declaration=True, encoding='ISO-8859-1')
-
-                    update_datasetsxml(bpd, self.dsid)
+                    with phase('toggle_dataset', 'flag', self.dsid):
+                        update_datasetsxml(bpd, self.dsid)
                 except OSError as e:
                     sys.exit(f'failed to execute program {str(e)}')
 
-    def update_dataset(self, datadir, newFile, bpd, dsxml):
+    def __merge_files(self, ncfile, newFiles, mode, memory_budget=None, overlap=None,
+                      encoding_profile=None):
+        if mode == 'append':
+            for newFile in newFiles:
+                with phase('update_dataset', 'append', self.dsid) as m:
+                    records = append_netcdf(ncfile, newFile, dim='time')
+                    m.add(nbytes=os.path.getsize(newFile), records=records)
+        elif mode == 'dedup':
+            for newFile in newFiles:
+                with phase('update_dataset', 'dedup', self.dsid) as m:
+                    counts = dedup_netcdf(ncfile, newFile, policy=overlap, dim='time')
+                    m.add(nbytes=os.path.getsize(newFile),
+                          records=counts['appended'] + counts['replaced'] + counts['inserted'])
+        elif mode == 'merge':
+            fname = os.path.basename(ncfile)
+            with phase('update_dataset', 'open', self.dsid) as m:
+                chunks = None
+                block = time_block_size([ncfile] + list(newFiles),
+                                        memory_budget or CHECKPOINT_BUDGET)
+                if memory_budget:
+                    # Stream the merge through dask, a block of time steps at a time
+                    chunks = {'time': block}
+                ds_old = xr.open_dataset(ncfile, decode_cf=False, chunks=chunks)
+                ds_news = [xr.open_dataset(newFile, decode_cf=False, chunks=chunks)
+                           for newFile in newFiles]
+                m.add(nbytes=sum(os.path.getsize(f) for f in [ncfile] + list(newFiles)))
+
+            with phase('update_dataset', 'merge', self.dsid) as m:
+                # Lazy: the merge itself is only computed a block at a time below
+                dsall = merge_datasets([ds_old] + ds_news, policy=overlap, dim='time',
+                                       block=block if chunks else None)
+                for ds_new in ds_news:
+                    for k, v in ds_new.variables.items():
+                        dsall[k].encoding = v.encoding
+                        dsall[k].attrs = v.attrs
+                    dsall.attrs = ds_new.attrs
+                if encoding_profile:
+                    apply_profile(dsall, encoding_profile)
+                m.add(records=dsall.sizes.get('time', 0))
+
+            # merge_tmp outlives a failed run, so that a rerun resumes the merge
+            mergetmp = os.path.join(os.path.dirname(newFiles[-1]), 'merge_tmp')
+            if not os.path.exists(mergetmp):
+                os.mkdir(mergetmp)
+            try:
+                with phase('update_dataset', 'to_netcdf', self.dsid) as m:
+                    # One block in flight at a time keeps the memory budget
+                    records = write_checkpointed(dsall, os.path.join(mergetmp, fname), ncfile,
+                                                 [ncfile] + list(newFiles), block, dim='time')
+                    m.add(nbytes=os.path.getsize(ncfile), records=records)
+            finally:
+                for ds in [ds_old] + ds_news:
+                    ds.close()
+        else:
+            raise ValueError(f'{mode} is not a valid update mode')
+
+    def __write_partitions(self, datadir, newFile, freq, mode='merge', overlap=None,
+                           encoding_profile=None):
+        fname = os.path.basename(newFile)
+        mergetmp = os.path.join(os.path.dirname(newFile), 'merge_tmp')
+        if not os.path.exists(mergetmp):
+            os.mkdir(mergetmp)
+
+        with xr.open_dataset(newFile, decode_cf=False) as ds_new, \
+                _partitions_lock(datadir, fname):
+            tvar = ds_new['time']
+            keys = partition_keys(tvar.values, tvar.attrs.get('units'),
+                                  calendar=tvar.attrs.get('calendar'), freq=freq)
+            existing = list_partitions(datadir, fname)
+            for key in OrderedDict.fromkeys(keys):
+                with phase('update_dataset', 'partition', self.dsid) as m:
+                    subset = ds_new.isel(time=np.flatnonzero(keys == key))
+                    tmpfile = os.path.join(mergetmp, f'{key}_{fname}')
+                    if encoding_profile:
+                        apply_profile(subset, encoding_profile)
+                    subset.to_netcdf(tmpfile, unlimited_dims='time')
+
+                    # A compacted, coarser partition covering key takes its records
+                    covering = [k for k in existing if key.startswith(k)]
+                    target = partition_path(datadir, fname, min(covering, key=len, default=key))
+                    if os.path.exists(target) and mode == 'dedup':
+                        dedup_netcdf(target, tmpfile, policy=overlap, dim='time')
+                        os.remove(tmpfile)
+                    elif os.path.exists(target) and mode == 'merge':
+                        # Partitions are small: rewritten whole, re-delivered records resolved
+                        mergedfile = os.path.join(mergetmp, f'merged_{key}_{fname}')
+                        with xr.open_dataset(target, decode_cf=False) as ds_old, \
+                                xr.open_dataset(tmpfile, decode_cf=False) as ds_part:
+                            dsall = merge_datasets([ds_old, ds_part], policy=overlap, dim='time')
+                            for k, v in ds_part.variables.items():
+                                dsall[k].encoding = v.encoding
+                                dsall[k].attrs = v.attrs
+                            dsall.attrs = ds_part.attrs
+                            if encoding_profile:
+                                apply_profile(dsall, encoding_profile)
+                            dsall.to_netcdf(mergedfile, unlimited_dims='time')
+                        os.replace(mergedfile, target)
+                        os.remove(tmpfile)
+                    elif os.path.exists(target):
+                        append_netcdf(target, tmpfile, dim='time')
+                        os.remove(tmpfile)
+                    else:
+                        shutil.move(tmpfile, target)
+                    m.add(nbytes=os.path.getsize(target), records=subset.sizes['time'])
+
+    def __ingest(self, datadir, ncfile, newFiles, mode, memory_budget, layout, partition,
+                 overlap=None, encoding_profile=None):
+        # Conflicting values fail a merge unless a policy is asked for
+        overlap = overlap or ('keep-newest' if mode == 'dedup' else 'no-conflicts')
+        if layout == 'partitioned':
+            for newFile in newFiles:
+                self.__write_partitions(datadir, newFile, partition, mode=mode, overlap=overlap,
+                                        encoding_profile=encoding_profile)
+        elif layout == 'single':
+            self.__merge_files(ncfile, newFiles, mode, memory_budget=memory_budget,
+                               overlap=overlap, encoding_profile=encoding_profile)
+        elif layout == 'zarr':
+            store = zarr_path(datadir, ncfile)
+            if not os.path.exists(store) and os.path.exists(ncfile):
+                # One-time migration of the NetCDF file the store replaces
+                with phase('update_dataset', 'zarr_convert', self.dsid) as m:
+                    netcdf_to_zarr(ncfile, store)
+                    m.add(nbytes=os.path.getsize(ncfile))
+                # datasets.xml still reads the NetCDF file, which is left in place
+                print(f'{ncfile} migrated to {store}, point the {self.dsid} dataset at the '
+                      f'store to serve the records appended from now on.')
+            for newFile in newFiles:
+                with phase('update_dataset', 'zarr_append', self.dsid) as m:
+                    if os.path.exists(store):
+                        records = append_zarr(store, newFile, dim='time')
+                    else:
+                        netcdf_to_zarr(newFile, store)
+                        with xr.open_dataset(newFile, decode_cf=False) as ds_new:
+                            records = ds_new.sizes.get('time', 0)
+                    m.add(nbytes=os.path.getsize(newFile), records=records)
+        else:
+            raise ValueError(f'{layout} is not a valid layout')
+
+    def compact_partitions(self, datadir, fname, bpd=None, freq='daily', older_than=3600,
+                           encoding_profile=None, overlap='keep-newest'):
+        """Merge the small partitions of fname into freq sized partitions.
+
+        Meant to run during quiet periods: a group is only compacted when none
+        of its partitions was written in the last older_than seconds. Updates
+        of the partitions wait for the compaction to finish, and the other way
+        around.
+
+        Args:
+            datadir (str): Data Directory.
+            fname (str): Dataset file name the partitions derive from.
+            bpd (str): Big Parent Directory location, to flag the dataset for reload.
+            freq (str): Partition size after compaction, daily or monthly.
+            older_than (float): Minimum age in seconds of the partitions to compact.
+            encoding_profile (str): Encoding of the compacted partitions, one of
+                encoding.PROFILES, defaults to the encoding of the partitions.
+            overlap (str): How records found in several partitions are resolved,
+                the finer partitions being the newest, see ncutils.merge_datasets.
+
+        Returns:
+            list: Paths of the compacted partitions.
+        """
+        if freq not in PARTITION_FORMATS:
+            raise ValueError(f'{freq} is not one of {list(PARTITION_FORMATS)}')
+        with _partitions_lock(datadir, fname):
+            compacted = self.__compact_partitions(datadir, fname, freq, older_than,
+                                                  encoding_profile, overlap)
+
+        if compacted and bpd:
+            update_datasetsxml(bpd, self.dsid)
+        return compacted
+
+    def __compact_partitions(self, datadir, fname, freq, older_than, encoding_profile, overlap):
+        keylen = len(time.strftime(PARTITION_FORMATS[freq], time.gmtime(0)))
+        groups = OrderedDict()
+        for key, path in list_partitions(datadir, fname).items():
+            if len(key) >= keylen:
+                groups.setdefault(key[:keylen], []).append(path)
+
+        now = time.time()
+        compacted = []
+        for coarse, paths in groups.items():
+            target = partition_path(datadir, fname, coarse)
+            if paths == [target]:
+                continue
+            if any(now - os.path.getmtime(path) < older_than for path in paths):
+                continue
+
+            with phase('compact_partitions', 'compact', self.dsid) as m:
+                datasets = [xr.open_dataset(path, decode_cf=False) for path in paths]
+                # Keys sort coarse first, e.g. 20240101 before 2024010100
+                dsall = merge_datasets(datasets, policy=overlap, dim='time')
+                for k, v in datasets[-1].variables.items():
+                    dsall[k].encoding = v.encoding
+                    dsall[k].attrs = v.attrs
+                dsall.attrs = datasets[-1].attrs
+                if encoding_profile:
+                    apply_profile(dsall, encoding_profile)
+
+                tmpfile = os.path.join(datadir, f'.compact_{os.path.basename(target)}')
+                dsall.to_netcdf(tmpfile, unlimited_dims='time')
+                for ds in datasets:
+                    ds.close()
+                os.replace(tmpfile, target)
+                for path in paths:
+                    if path != target:
+                        os.remove(path)
+                m.add(nbytes=os.path.getsize(target), records=dsall.sizes['time'])
+            compacted.append(target)
+        return compacted
+
+    def update_dataset(self, datadir, newFile, bpd, dsxml, mode='merge', memory_budget=None,
+                       layout='single', partition='daily', overlap=None,
+                       encoding_profile=None):
+        """Fold newFile into the dataset file of the same name in datadir.
+
+        newFile is removed once ingested, and its directory too when nothing
+        else is left in it.
+
+        Args:
+            datadir (str): Data Directory.
+            newFile (str): New NetCDF File to be added (full path).
+            bpd (str): Big Parent Directory location.
+            dsxml (str): datasets.xml location.
+            mode (str): 'merge' rewrites the whole file through an xarray merge,
+                'append' writes only the new records onto the unlimited time
+                dimension of the existing file, 'dedup' compares the time
+                coordinates only and writes the new records in place, resolving
+                overlapping ones by overlap.
+            memory_budget (int or str): If set, e.g. '2GB', the merge is streamed
+                through dask in blocks of time steps sized to fit the budget.
+                The merge output is written a block at a time and the progress
+                journaled in merge_tmp next to newFile, so that running the
+                same update again after a failure resumes from the last
+                block written, see ncutils.write_checkpointed.
+            layout (str): 'single' folds newFile into one ever-growing file,
+                'partitioned' writes it into time-bucketed files named after it,
+                e.g. mooring_20240131.nc, see ncutils.partition_regex, the
+                merge and dedup modes applying to each partition touched,
+                'zarr' appends it along time to the Zarr store named after it,
+                e.g. mooring.zarr, writing only the new chunks. The store is
+                created from the existing NetCDF file the first time, see
+                zarrstore.netcdf_to_zarr. That file is left as it is, for the
+                datasets.xml entry reading it until it is pointed at the store.
+            partition (str): Bucket size of the partitioned layout: hourly,
+                daily or monthly.
+            overlap (str): How the merge and dedup modes treat records already
+                present: keep-newest, keep-oldest or reject, see
+                ncutils.merge_datasets and ncutils.dedup_netcdf. By default
+                merge fails on records holding conflicting values
+                (no-conflicts) and dedup keeps the newest.
+            encoding_profile (str): Compression and chunking of the files written
+                whole (merge output, new partitions): append-optimized,
+                timeseries-read or spatial-read, see encoding.PROFILES.
+                Defaults to the encoding of the incoming file.
+
+        Returns:
+            str or Exception: Status message, or the exception raised.
+        """
         fname = os.path.basename(newFile)
         try:
             ncfile = os.path.join(datadir, fname)
-            ds_old = xr.open_dataset(ncfile, decode_cf=False)
-            ds_new = xr.open_dataset(newFile, decode_cf=False)
-
-            dsall = xr.merge([ds_old, ds_new], compat='no_conflicts')
-            for k, v in ds_new.items():
-                dsall[k].encoding = v.encoding
-                dsall[k].attrs = v.attrs
-            dsall.attrs = ds_new.attrs
+            self.__ingest(datadir, ncfile, [newFile], mode, memory_budget, layout, partition,
+                          overlap=overlap, encoding_profile=encoding_profile)
 
-            mergetmp = os.path.join(os.path.dirname(newFile), 'merge_tmp')
-            if not os.path.exists(mergetmp):
-                os.mkdir(mergetmp)
-            dsall.to_netcdf(os.path.join(mergetmp, fname), unlimited_dims='time')
-            shutil.move(os.path.join(mergetmp, fname), ncfile)
-
-            update_datasetsxml(bpd, self.dsid)
-            shutil.rmtree(os.path.dirname(newFile))
+            with phase('update_dataset', 'flag', self.dsid):
+                update_datasetsxml(bpd, self.dsid)
+            with phase('update_dataset', 'cleanup', self.dsid):
+                _remove_ingested([newFile])
             return 'NetCDF Successfully Updated.'
         except Exception as e:
             return e
+
+    def update_dataset_batch(self, datadir, newFiles, bpd, dsxml, mode='merge',
+                             memory_budget=None, layout='single', partition='daily',
+                             overlap=None, encoding_profile=None):
+        """Fold many new files into the dataset in a single pass.
+
+        New files are grouped by the dataset file they update, each group is
+        merged and written once, and the reload flag is written once at the end.
+        Files ingested are removed, as update_dataset does.
+
+        Args:
+            datadir (str): Data Directory.
+            newFiles (str or list): New NetCDF Files (full paths) or glob patterns.
+            bpd (str): Big Parent Directory location.
+            dsxml (str): datasets.xml location.
+            mode (str): 'merge', 'append' or 'dedup', see update_dataset.
+            memory_budget (int or str): Memory budget of the merge, see update_dataset.
+            layout (str): 'single', 'partitioned' or 'zarr', see update_dataset.
+            partition (str): Bucket size of the partitioned layout, see update_dataset.
+            overlap (str): Overlap policy of the merge and dedup modes, see update_dataset.
+            encoding_profile (str): Encoding profile of the output, see update_dataset.
+
+        Returns:
+            OrderedDict: Status message, or the exception raised, for each new file.
+        """
+        if isinstance(newFiles, str):
+            newFiles = [newFiles]
+        paths = []
+        for pattern in newFiles:
+            matches = sorted(glob.glob(pattern))
+            paths.extend(m for m in (matches or [pattern]) if m not in paths)
+
+        results = OrderedDict()
+        groups = OrderedDict()
+        for newFile in paths:
+            if not os.path.isfile(newFile):
+                results[newFile] = FileNotFoundError(f'{newFile} not found')
+                continue
+            ncfile = os.path.join(datadir, os.path.basename(newFile))
+            groups.setdefault(ncfile, []).append(newFile)
+
+        for ncfile, group in groups.items():
+            try:
+                self.__ingest(datadir, ncfile, group, mode, memory_budget, layout, partition,
+                              overlap=overlap, encoding_profile=encoding_profile)
+                for newFile in group:
+                    results[newFile] = 'NetCDF Successfully Updated.'
+            except Exception as e:
+                for newFile in group:
+                    results[newFile] = e
+
+        done = [f for f, r in results.items() if isinstance(r, str)]
+        if done:
+            with phase('update_dataset', 'flag', self.dsid):
+                update_datasetsxml(bpd, self.dsid)
+
+        # Only the files ingested go, whatever else sits in their directories
+        _remove_ingested(done)
+
+        return OrderedDict((f, results[f]) for f in paths)
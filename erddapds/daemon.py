@@ -0,0 +1,265 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import fnmatch
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from erddapds.core import ERDDAPDATASET
+from erddapds.flags import FlagWriter
+
+STAGING = '.ingest'
+# Staging directories of the files that kept failing, under the incoming directory
+FAILED = 'failed'
+
+
+class WatchedDataset(object):
+    """Incoming directory of one dataset and how its files are ingested.
+
+    Args:
+        dsid (str): Dataset ID.
+        incoming (str): Directory new NetCDF files are dropped into.
+        datadir (str): Data Directory of the dataset.
+        pattern (str): Glob pattern of the files to pick up.
+        mode (str): update_dataset mode, 'merge', 'append' or 'dedup'.
+        memory_budget (int or str): update_dataset memory budget.
+        layout (str): update_dataset layout, 'single', 'partitioned' or 'zarr'.
+        partition (str): Bucket size of the partitioned layout.
+        overlap (str): Overlap policy of the merge and dedup modes, see update_dataset.
+        encoding_profile (str): Encoding profile of the written files.
+        max_attempts (int): Ingests of a file before it is moved to failed/.
+        retry_delay (float): Seconds before a failed file is ingested again,
+            doubled after each further failure.
+    """
+
+    def __init__(self, dsid, incoming, datadir, pattern='*.nc', mode='merge',
+                 memory_budget=None, layout='single', partition='daily',
+                 overlap=None, encoding_profile=None, max_attempts=3,
+                 retry_delay=30.0):
+        self.dsid = dsid
+        self.incoming = os.path.abspath(incoming)
+        self.datadir = datadir
+        self.pattern = pattern
+        self.mode = mode
+        self.memory_budget = memory_budget
+        self.layout = layout
+        self.partition = partition
+        self.overlap = overlap
+        self.encoding_profile = encoding_profile
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.edd = ERDDAPDATASET(dsid)
+        self.__seen = {}
+        self.__retry = OrderedDict()
+        self.__attempts = {}
+        self.__recovered = False
+
+    def __repr__(self):
+        return f'<WatchedDataset: {self.dsid}>'
+
+    def settled(self, limit=None):
+        """Return the files that did not change since the previous scan, oldest first.
+
+        Settled files beyond limit are still remembered, and returned first
+        by the next scan.
+        """
+        current = {}
+        for dirpath, dirnames, filenames in os.walk(self.incoming):
+            dirnames[:] = [d for d in dirnames if d not in (STAGING, FAILED, 'merge_tmp')]
+            for fname in fnmatch.filter(filenames, self.pattern):
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                current[path] = (st.st_size, st.st_mtime_ns)
+
+        ready = sorted((p for p, sig in current.items() if self.__seen.get(p) == sig),
+                       key=lambda p: (current[p][1], p))[:limit]
+        taken = set(ready)
+        self.__seen = {p: sig for p, sig in current.items() if p not in taken}
+        return ready
+
+    def stage(self, files):
+        """Move each file into its own staging directory.
+
+        Staged files are out of reach of the next scans while being ingested,
+        and the emptied staging directories are removed by update_dataset_batch.
+        """
+        staged = []
+        for path in files:
+            newdir = os.path.join(self.incoming, STAGING, uuid.uuid4().hex)
+            os.makedirs(newdir)
+            target = os.path.join(newdir, os.path.basename(path))
+            shutil.move(path, target)
+            staged.append(target)
+        return staged
+
+    def staged(self):
+        """Return the staged files due to be ingested again, oldest first.
+
+        The first call also picks up the files a previous run left in staging,
+        e.g. when it was killed mid-merge, so that their merge resumes from
+        its journal.
+        """
+        if not self.__recovered:
+            self.__recovered = True
+            staging = os.path.join(self.incoming, STAGING)
+            left = []
+            for entry in sorted(os.listdir(staging)) if os.path.isdir(staging) else []:
+                newdir = os.path.join(staging, entry)
+                if os.path.isdir(newdir):
+                    left.extend(os.path.join(newdir, f)
+                                for f in fnmatch.filter(sorted(os.listdir(newdir)), self.pattern))
+            left.sort(key=lambda p: (os.path.getmtime(p), p))
+            if left:
+                print(f'{self.dsid}: {len(left)} file(s) left in staging, ingesting them again.')
+            for path in left:
+                self.__retry.setdefault(path, 0.0)
+        now = time.monotonic()
+        return [p for p, due in self.__retry.items() if due <= now]
+
+    def fail(self, path):
+        """Move the staging directory of path to failed/ under the incoming directory.
+        """
+        failed = os.path.join(self.incoming, FAILED)
+        os.makedirs(failed, exist_ok=True)
+        target = os.path.join(failed, os.path.basename(os.path.dirname(path)))
+        shutil.move(os.path.dirname(path), target)
+        print(f'{self.dsid}: {os.path.basename(path)} failed {self.max_attempts} time(s), '
+              f'moved to {target}')
+        return target
+
+    def ingest(self, bpd, dsxml, files):
+        """Ingest staged files, keeping the ones that failed for another attempt.
+
+        A failed file is due again after retry_delay, doubled at every
+        further failure. After max_attempts failures it is moved to failed/.
+        """
+        results = self.edd.update_dataset_batch(self.datadir, files, bpd, dsxml,
+                                                mode=self.mode,
+                                                memory_budget=self.memory_budget,
+                                                layout=self.layout,
+                                                partition=self.partition,
+                                                overlap=self.overlap,
+                                                encoding_profile=self.encoding_profile)
+        for path, status in results.items():
+            self.__retry.pop(path, None)
+            if isinstance(status, str) or not os.path.exists(path):
+                self.__attempts.pop(path, None)
+                continue
+            self.__attempts[path] = self.__attempts.get(path, 0) + 1
+            if self.__attempts[path] >= self.max_attempts:
+                del self.__attempts[path]
+                self.fail(path)
+            else:
+                delay = self.retry_delay * 2 ** (self.__attempts[path] - 1)
+                self.__retry[path] = time.monotonic() + delay
+        return results
+
+
+class IngestDaemon(object):
+    """Long running ingest of the files dropped in the incoming directories.
+
+    Every interval the incoming directories are scanned. Files that have
+    settled (same size and mtime over two scans) are grouped into one
+    micro-batch per dataset and folded in with update_dataset_batch, so each
+    batch costs a single merge and a single reload flag. Files that failed,
+    once their retry delay is over, and files that a previous run left in
+    staging go first in the next batch.
+    Batches of different datasets run concurrently on a bounded pool, while
+    the batches of one dataset run one after another in arrival order.
+
+    While running, the reload flags of every batch go through one FlagWriter.
+    With a debounce window, a dataset updated by many batches within the
+    window is flagged once; without, flags are written as each batch ends.
+
+    Args:
+        datasets (list): WatchedDataset objects.
+        bpd (str): Path to Big Parent Directory.
+        dsxml (str): Datasets xml file (Full path).
+        interval (float): Seconds between scans.
+        workers (int): Datasets ingested at the same time.
+        max_batch (int): Maximum number of files in one batch.
+        debounce (float): Debounce window of the reload flags in seconds.
+    """
+
+    def __init__(self, datasets, bpd, dsxml, interval=5.0, workers=4, max_batch=100,
+                 debounce=0.0):
+        self.datasets = OrderedDict((ds.dsid, ds) for ds in datasets)
+        self.bpd = bpd
+        self.dsxml = dsxml
+        self.interval = interval
+        self.max_batch = max_batch
+        self.debounce = debounce
+        self.__flags = None
+        self.__pool = ThreadPoolExecutor(max_workers=workers)
+        self.__running = {}
+        self.__stop = threading.Event()
+
+    def __repr__(self):
+        return f'<IngestDaemon: {len(self.datasets)} datasets>'
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a daemon from a config dict, see examples/daemon.yml.
+        """
+        datasets = [WatchedDataset(**ds) for ds in config['datasets']]
+        options = {k: config[k] for k in ('interval', 'workers', 'max_batch', 'debounce') if k in config}
+        return cls(datasets, config['bpd'], config['datasetsxml'], **options)
+
+    def _report(self, dsid, future):
+        flags = self.__flags
+        if flags is not None and not self.debounce:
+            flags.flush()
+        try:
+            results = future.result()
+        except Exception as e:
+            print(f'{dsid}: batch failed, error = {str(e)}')
+            return
+        for newnc, status in results.items():
+            print(f'{dsid}: {newnc}: {status}')
+
+    def scan_once(self):
+        """Submit one micro-batch for every idle dataset with settled files.
+
+        Returns:
+            dict: dsid -> Future of the batches submitted.
+        """
+        submitted = {}
+        for dsid, ds in self.datasets.items():
+            running = self.__running.get(dsid)
+            if running is not None and not running.done():
+                continue
+            retry = ds.staged()[:self.max_batch]
+            files = ds.settled(self.max_batch - len(retry))
+            if not retry and not files:
+                continue
+            staged = retry + ds.stage(files)
+            future = self.__pool.submit(ds.ingest, self.bpd, self.dsxml, staged)
+            future.add_done_callback(lambda f, dsid=dsid: self._report(dsid, f))
+            self.__running[dsid] = submitted[dsid] = future
+        return submitted
+
+    def run(self):
+        """Scan until stop() is called, then wait for the running batches.
+        """
+        print(f'Watching {len(self.datasets)} dataset(s) every {self.interval}s.')
+        with FlagWriter(self.bpd, debounce=self.debounce) as self.__flags:
+            try:
+                while not self.__stop.is_set():
+                    self.scan_once()
+                    self.__stop.wait(self.interval)
+            finally:
+                self.__pool.shutdown(wait=True)
+                self.__flags = None
+
+    def stop(self):
+        self.__stop.set()
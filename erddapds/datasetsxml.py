@@ -0,0 +1,691 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import bisect
+import copy
+import hashlib
+import json
+import os
+import re
+import tempfile
+from collections import OrderedDict
+
+from lxml import etree
+
+ENCODING = 'ISO-8859-1'
+
+# Comments and CDATA are matched first so that datasets commented out
+# in datasets.xml are skipped rather than indexed.
+_TOKENS = re.compile(
+    br'<!--.*?-->'
+    br'|<!\[CDATA\[.*?\]\]>'
+    br'|<dataset\b[^>]*?(?P<empty>/?)>'
+    br'|</dataset\s*>'
+    br'|</erddapDatasets\s*>',
+    re.DOTALL)
+_DATASETID = re.compile(br'''datasetID\s*=\s*(["'])(?P<id>.*?)\1''')
+_ACTIVE = re.compile(br'''\sactive\s*=\s*(["'])(?P<value>.*?)\1''')
+
+
+class ConflictError(RuntimeError):
+    """datasets.xml was changed by someone else while an edit was being written.
+    """
+
+
+def _to_bytes(fragment):
+    if isinstance(fragment, bytes):
+        data = fragment.strip()
+    elif isinstance(fragment, str):
+        data = fragment.strip().encode(ENCODING)
+    else:
+        data = etree.tostring(fragment, encoding=ENCODING,
+                              xml_declaration=False, pretty_print=True).strip()
+    return data + b'\n'
+
+
+def _parse(data):
+    parser = etree.XMLParser(remove_blank_text=True, encoding=ENCODING)
+    return etree.fromstring(data.strip(), parser)
+
+
+def fragment_hash(fragment):
+    """Content hash of a dataset fragment, insensitive to layout.
+
+    The fragment is canonicalized (C14N) after dropping whitespace only text,
+    so indentation, attribute order and quoting do not change the hash.
+
+    Args:
+        fragment (lxml.etree._Element, str or bytes): Dataset fragment.
+
+    Returns:
+        str: sha256 hex digest.
+    """
+    root = _parse(_to_bytes(fragment))
+    return hashlib.sha256(etree.tostring(root, method='c14n')).hexdigest()
+
+
+def _fragment_id(data):
+    m = _DATASETID.search(data[:data.index(b'>')])
+    if m is None:
+        raise ValueError('dataset fragment has no datasetID')
+    return m.group('id').decode(ENCODING)
+
+
+def _set_active(data, active):
+    """Return the dataset bytes data with its active attribute set to active.
+    """
+    if isinstance(active, bool):
+        active = 'true' if active else 'false'
+    tag = data[:data.index(b'>') + 1]
+    value = active.encode(ENCODING)
+    m = _ACTIVE.search(tag)
+    if m is not None:
+        if m.group('value') == value:
+            return data
+        newtag = tag[:m.start('value')] + value + tag[m.end('value'):]
+    else:
+        cut = len(tag) - (2 if tag.endswith(b'/>') else 1)
+        newtag = tag[:cut] + b' active="' + value + b'"' + tag[cut:]
+    return newtag + data[len(tag):]
+
+
+def scan_datasets(data):
+    """Find the byte ranges of the top level ``<dataset>`` elements in data.
+
+    Args:
+        data (bytes): Raw datasets.xml, fragment or tool output.
+
+    Returns:
+        tuple: ([(datasetID or None, start, end), ...] in order,
+        offset of the closing erddapDatasets tag or None).
+    """
+    found = []
+    end = None
+    depth = 0
+    start = dsid = None
+    for m in _TOKENS.finditer(data):
+        token = m.group(0)
+        if token.startswith(b'<!'):
+            continue
+        if token.startswith(b'</erddapDatasets'):
+            end = m.start()
+        elif token.startswith(b'</'):
+            if depth == 0:
+                continue
+            depth -= 1
+            if depth == 0:
+                found.append((dsid, start, m.end()))
+        else:
+            if depth == 0:
+                idm = _DATASETID.search(token)
+                start = m.start()
+                dsid = idm.group('id').decode(ENCODING) if idm else None
+                if m.group('empty'):
+                    found.append((dsid, start, m.end()))
+                    continue
+            elif m.group('empty'):
+                continue
+            depth += 1
+    return found, end
+
+
+class DatasetsXML(object):
+    """datasets.xml store with a persistent datasetID to byte range index.
+
+    The index maps every top level ``<dataset>`` to its byte range in the file
+    and is saved next to datasets.xml. It is trusted as long as the mtime and
+    size of datasets.xml match the ones recorded in it, and rebuilt with a
+    single byte scan otherwise. Single dataset edits splice the file bytes
+    around the target without parsing any other dataset. Content hashes of
+    the datasets, see fragment_hash, are kept in the index once computed.
+
+    Args:
+        dsxml (str): datasets.xml location.
+        index_path (str): Index location, defaults to ``<dsxml>.idx``.
+    """
+
+    def __init__(self, dsxml, index_path=None):
+        self.dsxml = os.path.abspath(dsxml)
+        self.index_path = index_path or f'{self.dsxml}.idx'
+        self.__entries = None
+        self.__end = None
+        self.__stat = None
+        self.__hashes = {}
+
+    def __repr__(self):
+        return f'<DatasetsXML: {self.dsxml}>'
+
+    def __contains__(self, dsid):
+        return dsid in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.ids())
+
+    def _file_stat(self):
+        st = os.stat(self.dsxml)
+        return [st.st_mtime_ns, st.st_size]
+
+    @property
+    def index(self):
+        """dict: datasetID -> [start, end] byte range, validated against the file.
+        """
+        stat = self._file_stat()
+        if self.__entries is None or self.__stat != stat:
+            if not self._load_index(stat):
+                self.rebuild_index()
+        return self.__entries
+
+    def _load_index(self, stat):
+        try:
+            with open(self.index_path, 'r') as f:
+                idx = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if idx.get('stat') != stat:
+            return False
+        self.__entries = {k: tuple(v) for k, v in idx['entries'].items()}
+        self.__end = idx['end']
+        self.__stat = stat
+        self.__hashes = idx.get('hashes', {})
+        return True
+
+    def _save_index(self):
+        """Persist the index, best effort: it is only a cache of datasets.xml.
+
+        The index is saved along with the stat of the datasets.xml it was
+        built from, never a later one, so a reader racing a writer can only
+        leave an index that is no longer trusted.
+        """
+        idx = {'stat': self.__stat, 'end': self.__end,
+               'entries': {k: list(v) for k, v in self.__entries.items()},
+               'hashes': {k: v for k, v in self.__hashes.items() if k in self.__entries}}
+        tmp = None
+        try:
+            # Own temp file, as readers not holding the lock save the index too
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.index_path)),
+                                       suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(idx, f)
+            os.chmod(tmp, os.stat(self.dsxml).st_mode & 0o666)
+            os.replace(tmp, self.index_path)
+        except OSError as e:
+            print(f'Could not save the index of {self.dsxml}, error = {str(e)}')
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def rebuild_index(self):
+        """Scan datasets.xml once and rebuild the datasetID index.
+        """
+        with open(self.dsxml, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+
+        entries = {}
+        found, end = scan_datasets(data)
+        for dsid, start, stop in found:
+            if dsid is not None:
+                entries.setdefault(dsid, (start, stop))
+
+        if end is None:
+            raise ValueError(f'{self.dsxml} has no closing erddapDatasets tag')
+        self.__entries = entries
+        self.__end = end
+        self.__stat = [st.st_mtime_ns, st.st_size]
+        self.__hashes = {}
+        self._save_index()
+        return self.__entries
+
+    def ids(self):
+        """Return the datasetIDs in file order.
+        """
+        index = self.index
+        return sorted(index, key=lambda k: index[k][0])
+
+    def get_bytes(self, dsid):
+        """Return the raw bytes of the dataset dsid.
+        """
+        while True:
+            start, end = self.index[dsid]
+            with open(self.dsxml, 'rb') as f:
+                st = os.fstat(f.fileno())
+                # datasets.xml may have been replaced since the index was checked
+                if [st.st_mtime_ns, st.st_size] == self.__stat:
+                    f.seek(start)
+                    return f.read(end - start)
+
+    def get(self, dsid):
+        """Return the dataset dsid as an lxml element.
+        """
+        return _parse(self.get_bytes(dsid))
+
+    def hash(self, dsid):
+        """Return the content hash of the dataset dsid, see fragment_hash.
+        """
+        self.index
+        if dsid not in self.__hashes:
+            self.__hashes[dsid] = fragment_hash(self.get_bytes(dsid))
+            self._save_index()
+        return self.__hashes[dsid]
+
+    def unchanged(self, fragment):
+        """True if a dataset with the datasetID and content of fragment is already here.
+        """
+        data = _to_bytes(fragment)
+        dsid = _fragment_id(data)
+        return dsid in self.index and self.hash(dsid) == fragment_hash(data)
+
+    def _splice(self, start, end, data):
+        """Replace bytes [start, end) of datasets.xml with data.
+        """
+        self._splice_many([(start, end, data)])
+
+        delta = len(data) - (end - start)
+        for k, (s, e) in list(self.__entries.items()):
+            if s >= end:
+                self.__entries[k] = (s + delta, e + delta)
+        if self.__end >= end:
+            self.__end += delta
+
+    def _splice_many(self, edits, expect=None):
+        """Replace several non overlapping byte ranges of datasets.xml in one write.
+
+        Everything else is copied through as raw bytes into a temporary file
+        which then atomically replaces datasets.xml.
+
+        Args:
+            edits (list): (start, end, data) tuples sorted by start.
+            expect (list): [mtime_ns, size] datasets.xml must still have right
+                before the swap, ConflictError is raised otherwise.
+
+        Returns:
+            list: Offset of the data of every edit in the new file.
+        """
+        offsets = []
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.dsxml), suffix='.tmp')
+        try:
+            with open(self.dsxml, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                pos = out = 0
+                for start, end, data in edits:
+                    remaining = start - pos
+                    while remaining > 0:
+                        block = src.read(min(remaining, 1 << 20))
+                        if not block:
+                            break
+                        dst.write(block)
+                        remaining -= len(block)
+                    out += start - pos
+                    offsets.append(out)
+                    dst.write(data)
+                    out += len(data)
+                    src.seek(end)
+                    pos = end
+                while True:
+                    block = src.read(1 << 20)
+                    if not block:
+                        break
+                    dst.write(block)
+            if os.path.exists(self.dsxml):
+                os.chmod(tmp, os.stat(self.dsxml).st_mode & 0o777)
+            if expect is not None and self._file_stat() != list(expect):
+                raise ConflictError(f'{self.dsxml} changed while it was being written')
+            st = os.stat(tmp)
+            os.replace(tmp, self.dsxml)
+            self.__stat = [st.st_mtime_ns, st.st_size]
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return offsets
+
+    def insert(self, fragment):
+        """Append a dataset fragment before the closing erddapDatasets tag.
+
+        Args:
+            fragment (lxml.etree._Element, str or bytes): Dataset fragment.
+
+        Returns:
+            str: datasetID of the inserted dataset.
+        """
+        data = _to_bytes(fragment)
+        dsid = _fragment_id(data)
+        if dsid in self.index:
+            raise ValueError(f'{dsid} is already in {self.dsxml}')
+
+        at = self.__end
+        with open(self.dsxml, 'rb') as f:
+            f.seek(max(at - 1, 0))
+            if f.read(1) != b'\n':
+                data = b'\n' + data
+        self._splice(at, at, data)
+        self.__entries[dsid] = (at + data.index(b'<'), at + len(data) - 1)
+        self.__hashes.pop(dsid, None)
+        self._save_index()
+        return dsid
+
+    def replace(self, dsid, fragment):
+        """Replace the dataset dsid with fragment.
+        """
+        start, end = self.index[dsid]
+        data = _to_bytes(fragment).rstrip(b'\n')
+        newid = _fragment_id(data)
+        if newid != dsid and newid in self.__entries:
+            raise ValueError(f'{newid} is already in {self.dsxml}')
+        self._splice(start, end, data)
+        del self.__entries[dsid]
+        self.__entries[newid] = (start, start + len(data))
+        self.__hashes.pop(dsid, None)
+        self.__hashes.pop(newid, None)
+        self._save_index()
+
+    def remove(self, dsid):
+        """Remove the dataset dsid, including the rest of its line.
+        """
+        start, end = self.index[dsid]
+        self._splice(start, self._line_end(end), b'')
+        del self.__entries[dsid]
+        self.__hashes.pop(dsid, None)
+        self._save_index()
+
+    def toggle(self, dsid, active):
+        """Set the active attribute of the dataset dsid, editing its opening tag only.
+
+        Args:
+            dsid (str): Dataset ID.
+            active (bool or str): New value of the active attribute.
+        """
+        start, end = self.index[dsid]
+        with open(self.dsxml, 'rb') as f:
+            f.seek(start)
+            head = f.read(end - start)
+        tag = head[:head.index(b'>') + 1]
+        newtag = _set_active(tag, active)
+        if newtag == tag:
+            return
+
+        self._splice(start, start + len(tag), newtag)
+        self.__entries[dsid] = (start, end + len(newtag) - len(tag))
+        self.__hashes.pop(dsid, None)
+        self._save_index()
+
+    def _line_end(self, end):
+        """Extend end over the whitespace and newline that follow it on its line.
+        """
+        with open(self.dsxml, 'rb') as f:
+            f.seek(end)
+            tail = f.read(256)
+        stripped = len(tail) - len(tail.lstrip(b' \t\r\n'))
+        newline = tail.find(b'\n')
+        if 0 <= newline < stripped:
+            end += newline + 1
+        return end
+
+    def _current(self, staged, dsid):
+        if dsid in staged:
+            return staged[dsid]
+        if dsid in self.__entries:
+            return self.get_bytes(dsid)
+        return None
+
+    def _stage(self, staged, op, *args):
+        if op == 'insert':
+            data = _to_bytes(args[0])
+            dsid = _fragment_id(data)
+            _parse(data)
+            if self._current(staged, dsid) is not None:
+                raise ValueError(f'{dsid} is already in {self.dsxml}')
+            staged[dsid] = data
+        elif op == 'replace':
+            dsid, data = args[0], _to_bytes(args[1])
+            if _fragment_id(data) != dsid:
+                raise ValueError(f'replacement of {dsid} has a different datasetID')
+            _parse(data)
+            if self._current(staged, dsid) is None:
+                raise KeyError(dsid)
+            staged[dsid] = data
+        elif op == 'remove':
+            if self._current(staged, args[0]) is None:
+                raise KeyError(args[0])
+            staged[args[0]] = None
+        elif op == 'put':
+            data = _to_bytes(args[0])
+            dsid = _fragment_id(data)
+            new = fragment_hash(data)
+            current = self._current(staged, dsid)
+            try:
+                same = current is not None and fragment_hash(current) == new
+            except etree.XMLSyntaxError:
+                same = False
+            if not same:
+                staged[dsid] = data
+        elif op == 'toggle':
+            data = self._current(staged, args[0])
+            if data is None:
+                raise KeyError(args[0])
+            staged[args[0]] = _set_active(data, args[1])
+        else:
+            raise ValueError(f'{op} is not a valid datasets.xml operation')
+
+    def apply(self, transactions, written=None):
+        """Apply groups of edits to datasets.xml in a single write.
+
+        Each group is all or nothing: if one of its operations fails, none of
+        them is applied, while the other groups still are. Operations are
+        ('insert', fragment), ('replace', dsid, fragment), ('remove', dsid),
+        ('toggle', dsid, active) and ('put', fragment), which inserts the
+        fragment, replaces the dataset of the same datasetID in place, or does
+        nothing if that dataset has the same content.
+
+        A fragment lxml cannot parse fails its own group with a ValueError.
+        Once datasets.xml is replaced, updating the index can no longer fail
+        the edit: the index is only a cache and is rebuilt when it is needed.
+
+        Args:
+            transactions (list): Lists of operations.
+            written (callable): Called with the results as soon as datasets.xml
+                is replaced, or found to need no change, before the index is
+                updated.
+
+        Returns:
+            list: None or the exception raised, for every group.
+
+        Raises:
+            ConflictError: If datasets.xml was changed by a writer not holding
+                the lock while the new file was being written.
+        """
+        self.index
+        expect = self.__stat
+        state = OrderedDict()
+        results = []
+        for ops in transactions:
+            staged = OrderedDict(state)
+            try:
+                for op in ops:
+                    self._stage(staged, *op)
+            except (KeyError, ValueError) as e:
+                results.append(e)
+                continue
+            except etree.XMLSyntaxError as e:
+                results.append(ValueError(f'malformed dataset fragment: {e}'))
+                continue
+            state = staged
+            results.append(None)
+
+        edits = []
+        inserts = []
+        for dsid, data in state.items():
+            if dsid in self.__entries:
+                start, end = self.__entries[dsid]
+                if data is None:
+                    edits.append((start, self._line_end(end), b'', dsid))
+                elif data.rstrip(b'\n') != self.get_bytes(dsid):
+                    edits.append((start, end, data.rstrip(b'\n'), dsid))
+            elif data is not None:
+                inserts.append((dsid, data))
+        if inserts:
+            at = self.__end
+            with open(self.dsxml, 'rb') as f:
+                f.seek(max(at - 1, 0))
+                blob = b'' if f.read(1) == b'\n' else b'\n'
+            placed = []
+            for dsid, data in inserts:
+                placed.append((dsid, len(blob), len(blob) + len(data) - 1))
+                blob += data
+            edits.append((at, at, blob, None))
+        if not edits:
+            if written is not None:
+                written(results)
+            return results
+
+        edits.sort(key=lambda e: e[0])
+        offsets = self._splice_many([e[:3] for e in edits], expect=expect)
+        if written is not None:
+            written(results)
+        try:
+            self._update_index(edits, offsets, placed if inserts else [])
+        except Exception as e:
+            print(f'Could not update the index of {self.dsxml}, error = {str(e)}')
+            self.__entries = None
+        return results
+
+    def _update_index(self, edits, offsets, placed):
+        """Shift the index over the edits just written by _splice_many.
+        """
+        ends = [e[1] for e in edits]
+        shifts = [0]
+        for start, end, data, _ in edits:
+            shifts.append(shifts[-1] + len(data) - (end - start))
+        edited = {e[3] for e in edits}
+        for dsid in edited:
+            self.__hashes.pop(dsid, None)
+        for k, (s, e) in list(self.__entries.items()):
+            if k not in edited:
+                shift = shifts[bisect.bisect_right(ends, s)]
+                self.__entries[k] = (s + shift, e + shift)
+        for (start, end, data, dsid), offset in zip(edits, offsets):
+            if dsid is None:
+                for newid, s, e in placed:
+                    self.__entries[newid] = (offset + s, offset + e)
+            elif data:
+                self.__entries[dsid] = (offset, offset + len(data))
+            else:
+                del self.__entries[dsid]
+        self.__end += shifts[-1]
+        self._save_index()
+
+
+def iter_children(dsxml):
+    """Stream the top level children of datasets.xml with bounded memory.
+
+    Elements are yielded one at a time once fully parsed and are cleared
+    as soon as the caller moves on, so only one dataset is held in memory.
+
+    Args:
+        dsxml (str): datasets.xml location.
+
+    Yields:
+        tuple: (root, child) where child is a top level element or comment.
+    """
+    context = etree.iterparse(dsxml, events=('start', 'end', 'comment'),
+                              remove_blank_text=True, huge_tree=True)
+    root = None
+    depth = 0
+    for event, el in context:
+        if event == 'start':
+            if root is None:
+                root = el
+            depth += 1
+        elif event == 'end':
+            depth -= 1
+            if depth == 1:
+                yield root, el
+                el.clear()
+                root.remove(el)
+        elif depth == 1:
+            yield root, el
+            root.remove(el)
+    del context
+
+
+def iter_datasets(dsxml):
+    """Stream the top level ``<dataset>`` elements of datasets.xml.
+
+    Args:
+        dsxml (str): datasets.xml location.
+
+    Yields:
+        lxml.etree._Element: One dataset element at a time.
+    """
+    for _, el in iter_children(dsxml):
+        if el.tag == 'dataset':
+            yield el
+
+
+def list_datasets(dsxml):
+    """Return (datasetID, type, active) for every dataset in datasets.xml.
+    """
+    return [(el.get('datasetID'), el.get('type'), el.get('active', 'true'))
+            for el in iter_datasets(dsxml)]
+
+
+def find_dataset(dsxml, dsid):
+    """Return a copy of the dataset dsid, or None if it is not in datasets.xml.
+    """
+    for el in iter_datasets(dsxml):
+        if el.get('datasetID') == dsid:
+            return copy.deepcopy(el)
+    return None
+
+
+def stream_edit(dsxml, edit=None, append=(), out=None):
+    """Rewrite datasets.xml one top level element at a time.
+
+    Untouched children, including comments and non dataset settings,
+    are copied through as they are.
+
+    Args:
+        dsxml (str): datasets.xml location.
+        edit (callable): Called with each dataset element, returns the element
+            to write in its place, or None to drop it.
+        append (list): Dataset fragments to add before the closing tag.
+        out (str): Output location, defaults to replacing dsxml atomically.
+
+    Returns:
+        int: Number of datasets written.
+    """
+    target = out or dsxml
+    for _, root in etree.iterparse(dsxml, events=('start',), huge_tree=True):
+        tag, attrib = root.tag, dict(root.attrib)
+        break
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)), suffix='.tmp')
+    count = 0
+    try:
+        with os.fdopen(fd, 'wb') as f, etree.xmlfile(f, encoding=ENCODING) as xf:
+            xf.write_declaration()
+            with xf.element(tag, attrib):
+                xf.write('\n')
+                for _, el in iter_children(dsxml):
+                    if el.tag == 'dataset' and edit is not None:
+                        el = edit(el)
+                        if el is None:
+                            continue
+                    if el.tag == 'dataset':
+                        count += 1
+                    el.tail = None
+                    xf.write(el, pretty_print=True)
+                for el in append:
+                    if not isinstance(el, etree._Element):
+                        el = etree.fromstring(_to_bytes(el), etree.XMLParser(remove_blank_text=True))
+                    xf.write(el, pretty_print=True)
+                    count += 1
+        os.replace(tmp, target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return count
@@ -0,0 +1,115 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+from collections import OrderedDict
+
+import numpy as np
+
+from erddapds.ncutils import parse_size
+
+# complevel: zlib deflate level
+# time_budget: share of chunk_bytes given to the time dimension, the rest
+#     of each chunk spans the other dimensions
+# other_dim: chunk length of the non time dimensions, None for their full size
+# max_time: longest chunk along time
+PROFILES = OrderedDict([
+    # Small chunks along time, cheap compression: an append only rewrites
+    # the last, partly filled chunk
+    ('append-optimized', {'complevel': 1, 'shuffle': True, 'other_dim': None,
+                          'max_time': 64}),
+    # Long, narrow chunks: all time steps at a point or station in few reads
+    ('timeseries-read', {'complevel': 4, 'shuffle': True, 'other_dim': 8,
+                         'max_time': 65536}),
+    # One time step per chunk spanning the whole grid: maps and time slices
+    ('spatial-read', {'complevel': 4, 'shuffle': True, 'other_dim': None,
+                      'max_time': 1}),
+])
+
+# Encoding keys replaced by a profile, so that none of the source file's
+# layout leaks through
+_LAYOUT_KEYS = ('zlib', 'complevel', 'shuffle', 'chunksizes', 'contiguous',
+                'compression', 'fletcher32', 'original_shape', 'preferred_chunks')
+
+
+def chunk_shape(dims, shape, itemsize, profile, dim='time', chunk_bytes='1MB'):
+    """Chunk shape of a variable under profile.
+
+    Args:
+        dims (tuple): Dimension names of the variable.
+        shape (tuple): Current shape of the variable.
+        itemsize (int): Size of one value in bytes.
+        profile (str): One of PROFILES.
+        dim (str): Record dimension.
+        chunk_bytes (int or str): Target size of a chunk.
+
+    Returns:
+        tuple: Chunk length of every dimension.
+    """
+    settings = PROFILES[profile]
+    target = parse_size(chunk_bytes)
+    chunks = []
+    for d, size in zip(dims, shape):
+        if d == dim:
+            chunks.append(None)
+        elif settings['other_dim'] is None:
+            chunks.append(max(1, size))
+        else:
+            chunks.append(max(1, min(size, settings['other_dim'])))
+
+    # Halve the largest non time dimension until a single record fits
+    record = itemsize * int(np.prod([c for c in chunks if c is not None], dtype='i8'))
+    while record > target:
+        i = max((i for i, c in enumerate(chunks) if c is not None and c > 1),
+                key=lambda i: chunks[i], default=None)
+        if i is None:
+            break
+        chunks[i] = (chunks[i] + 1) // 2
+        record = itemsize * int(np.prod([c for c in chunks if c is not None], dtype='i8'))
+
+    if None in chunks:
+        max_time = settings['max_time']
+        if len(dims) == 1:
+            # The record coordinate itself is read whole, keep it in long chunks
+            max_time = PROFILES['timeseries-read']['max_time']
+        chunks[chunks.index(None)] = int(min(max_time, max(1, target // max(record, 1))))
+    return tuple(chunks)
+
+
+def profile_encoding(ds, profile, dim='time', chunk_bytes='1MB'):
+    """Encoding of every variable of ds under the named profile.
+
+    Args:
+        ds (xarray.Dataset): Dataset about to be written.
+        profile (str): One of PROFILES.
+        dim (str): Record dimension.
+        chunk_bytes (int or str): Target size of a chunk.
+
+    Returns:
+        dict: Variable name -> encoding for Dataset.to_netcdf.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f'{profile} is not one of {list(PROFILES)}')
+    settings = PROFILES[profile]
+    encoding = {}
+    for name, var in ds.variables.items():
+        enc = {k: v for k, v in var.encoding.items() if k not in _LAYOUT_KEYS}
+        if var.ndim and var.dtype.kind in 'iuf':
+            enc.update(zlib=True, complevel=settings['complevel'],
+                       shuffle=settings['shuffle'],
+                       chunksizes=chunk_shape(var.dims, var.shape, var.dtype.itemsize,
+                                              profile, dim=dim, chunk_bytes=chunk_bytes))
+        encoding[name] = enc
+    return encoding
+
+
+def apply_profile(ds, profile, dim='time', chunk_bytes='1MB'):
+    """Set the encoding of every variable of ds to the profile in place.
+
+    Returns:
+        xarray.Dataset: ds
+    """
+    for name, enc in profile_encoding(ds, profile, dim=dim, chunk_bytes=chunk_bytes).items():
+        ds[name].encoding = enc
+    return ds
@@ -0,0 +1,119 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import os
+import threading
+from collections import OrderedDict
+
+_ACTIVE = {}
+_ACTIVE_LOCK = threading.Lock()
+
+
+def write_flag(bpd, dsid):
+    """Create or touch <bpd>/flag/<dsid> so ERDDAP reloads the dataset.
+
+    Args:
+        bpd (str): Big Parent Directory location.
+        dsid (str): Dataset ID
+
+    Raises:
+        OSError: If the flag cannot be written.
+    """
+    path = os.path.join(os.path.abspath(bpd), 'flag', dsid)
+    with open(path, 'a'):
+        pass
+    os.utime(path, None)
+    return path
+
+
+def active_writer(bpd):
+    """Return the FlagWriter currently collecting flags for bpd, if any.
+    """
+    return _ACTIVE.get(os.path.abspath(bpd)) if bpd else None
+
+
+class FlagWriter(object):
+    """Coalescing writer of ERDDAP reload flags.
+
+    Flags are collected per datasetID and written together by flush(),
+    so a dataset updated many times gets a single flag. With a debounce
+    window, pending flags are flushed automatically once the window after
+    the first pending flag has passed. Used as a context manager, the writer
+    also collects the flags of every update_datasetsxml call made for bpd
+    in the block, from any thread, and writes them on exit. A writer nested
+    in another one for the same bpd hands its flags over to the outer writer
+    on exit instead, so they follow the outer debounce window.
+
+    Args:
+        bpd (str): Big Parent Directory location.
+        debounce (float): Debounce window in seconds, 0 to only flush explicitly.
+    """
+
+    def __init__(self, bpd, debounce=0.0):
+        self.bpd = os.path.abspath(bpd)
+        self.debounce = debounce
+        self.__pending = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__timer = None
+        self.__previous = None
+
+    def __repr__(self):
+        return f'<FlagWriter: {self.bpd}>'
+
+    def __enter__(self):
+        with _ACTIVE_LOCK:
+            self.__previous = _ACTIVE.get(self.bpd)
+            _ACTIVE[self.bpd] = self
+        return self
+
+    def __exit__(self, *exc):
+        with _ACTIVE_LOCK:
+            previous = self.__previous
+            if previous is None:
+                _ACTIVE.pop(self.bpd, None)
+            else:
+                _ACTIVE[self.bpd] = previous
+        if previous is None:
+            self.flush()
+        else:
+            for dsid in self.__take():
+                previous.flag(dsid)
+
+    @property
+    def pending(self):
+        with self.__lock:
+            return list(self.__pending)
+
+    def flag(self, dsid):
+        """Ask for a reload of dsid, written on the next flush.
+        """
+        with self.__lock:
+            self.__pending[dsid] = True
+            if self.debounce and self.__timer is None:
+                self.__timer = threading.Timer(self.debounce, self.flush)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def __take(self):
+        with self.__lock:
+            pending = list(self.__pending)
+            self.__pending.clear()
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+        return pending
+
+    def flush(self):
+        """Write every pending flag once.
+
+        Returns:
+            list: datasetIDs flagged.
+        """
+        pending = self.__take()
+        for dsid in pending:
+            write_flag(self.bpd, dsid)
+        if pending:
+            print(f'Reload flags written for {len(pending)} dataset(s).')
+        return pending
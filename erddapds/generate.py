@@ -0,0 +1,392 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree
+from netCDF4 import Dataset
+
+from erddapds.datasetsxml import (ENCODING,
+                                  scan_datasets)
+from erddapds.ncutils import parse_size
+
+
+def run_generate_datasets_xml(gds_loc, args):
+    """Run GenerateDatasetsXml.sh once and capture its own output.
+
+    The script is started with its directory as working directory through
+    the subprocess rather than by changing the directory of this process,
+    so several runs can go on at once from threads.
+
+    Args:
+        gds_loc (str): GenerateDatasetsXml.sh (Full path).
+        args (list): Arguments answering the GenerateDatasetsXml prompts.
+
+    Returns:
+        tuple: (returncode, stdout bytes, stderr bytes)
+    """
+    cmd = ['/bin/bash', gds_loc] + [str(x) for x in args]
+    p = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(gds_loc)),
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return p.returncode, out, err
+
+
+def extract_fragment(output):
+    """Return the last top level ``<dataset>`` fragment in GenerateDatasetsXml output.
+
+    Args:
+        output (bytes): Captured stdout or content of GenerateDatasetsXml.out.
+
+    Returns:
+        bytes or None: The dataset fragment, None if there is none.
+    """
+    found, _ = scan_datasets(output)
+    if not found:
+        return None
+    _, start, end = found[-1]
+    return output[start:end]
+
+
+def generate_datasetxml_batch(jobs, gds_loc='', big_parent_directory='', workers=4,
+                              cache=None):
+    """Run ERDDAPDATASET.generate_datasetxml for many datasets at once.
+
+    Args:
+        jobs (list): (ERDDAPDATASET, args) pairs, args being the positional
+            arguments of generate_datasetxml.
+        gds_loc (str): GenerateDatasetsXml.sh (Full path).
+        big_parent_directory (str): Path to Big Parent Directory.
+        workers (int): Number of generations running at the same time.
+        cache (FragmentCache): Optional fragment cache shared by the jobs.
+
+    Returns:
+        list: (ERDDAPDATASET, fragment root or the exception raised) pairs,
+        in the order of jobs.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(edd, pool.submit(edd.generate_datasetxml, *args,
+                                     gds_loc=gds_loc,
+                                     big_parent_directory=big_parent_directory,
+                                     cache=cache))
+                   for edd, args in jobs]
+
+    results = []
+    for edd, future in futures:
+        try:
+            results.append((edd, future.result()))
+        except BaseException as e:
+            results.append((edd, e))
+    return results
+
+
+def gds_version(gds_loc):
+    """Fingerprint of the GenerateDatasetsXml installation at gds_loc.
+
+    Combines the script content with the modification time of the compiled
+    GenerateDatasetsXml class, which changes whenever ERDDAP is upgraded.
+    """
+    h = hashlib.sha256()
+    with open(gds_loc, 'rb') as f:
+        h.update(f.read())
+    klass = os.path.join(os.path.dirname(os.path.abspath(gds_loc)), 'classes',
+                         'gov', 'noaa', 'pfel', 'erddap', 'GenerateDatasetsXml.class')
+    if os.path.exists(klass):
+        h.update(str(os.stat(klass).st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def files_fingerprint(datadir, regex='.*'):
+    """Fingerprint the names, sizes and mtimes of the files matching regex in datadir.
+    """
+    pattern = re.compile(regex or '.*')
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(datadir):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if not pattern.fullmatch(fname):
+                continue
+            path = os.path.join(dirpath, fname)
+            st = os.stat(path)
+            h.update(f'{path}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+
+class FragmentCache(object):
+    """On-disk cache of raw GenerateDatasetsXml fragments.
+
+    Entries are keyed by the GenerateDatasetsXml arguments, the installation
+    fingerprint and, when the second argument is a data directory, a
+    fingerprint of the files matching the fileNameRegex (third argument).
+    Least recently used entries are evicted once the cache exceeds max_bytes.
+
+    Args:
+        cache_dir (str): Cache directory.
+        max_bytes (int or str): Size limit of the cache, e.g. '100MB'.
+    """
+
+    def __init__(self, cache_dir, max_bytes='100MB'):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = parse_size(max_bytes)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return f'<FragmentCache: {self.cache_dir}>'
+
+    def key(self, gds_loc, args):
+        args = [str(x) for x in args]
+        parts = {'args': args, 'gds': gds_version(gds_loc)}
+        if len(args) > 1 and os.path.isdir(args[1]):
+            regex = args[2] if len(args) > 2 else '.*'
+            parts['files'] = files_fingerprint(args[1], regex)
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.xml')
+
+    def get(self, key):
+        """Return the cached fragment bytes for key, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                fragment = f.read()
+        except OSError:
+            return None
+        os.utime(path)
+        return fragment
+
+    def put(self, key, fragment):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(fragment)
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits max_bytes.
+        """
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.xml'):
+                st = os.stat(os.path.join(self.cache_dir, fname))
+                entries.append((st.st_mtime_ns, st.st_size, fname))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, fname))
+            total -= size
+
+    def invalidate(self, gds_loc=None, args=None):
+        """Drop the entry for (gds_loc, args), or every entry when called without arguments.
+        """
+        if gds_loc is None:
+            for fname in os.listdir(self.cache_dir):
+                if fname.endswith('.xml'):
+                    os.remove(os.path.join(self.cache_dir, fname))
+            return
+        path = self._path(self.key(gds_loc, args))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+NATIVE_TYPES = ('EDDTableFromNcCFFiles', 'EDDGridFromNcFiles')
+
+_DATA_TYPES = {
+    'i1': 'byte', 'u1': 'ubyte', 'i2': 'short', 'u2': 'ushort',
+    'i4': 'int', 'u4': 'uint', 'i8': 'long', 'u8': 'ulong',
+    'f4': 'float', 'f8': 'double',
+}
+
+_FEATURE_TYPES = {
+    'point': 'Point', 'timeseries': 'TimeSeries', 'profile': 'Profile',
+    'trajectory': 'Trajectory', 'timeseriesprofile': 'TimeSeriesProfile',
+    'trajectoryprofile': 'TrajectoryProfile',
+}
+
+_CF_ROLES = {
+    'timeseries_id': 'cdm_timeseries_variables',
+    'profile_id': 'cdm_profile_variables',
+    'trajectory_id': 'cdm_trajectory_variables',
+}
+
+
+def _data_type(var):
+    dtype = getattr(var.dtype, 'str', None)
+    if dtype is None or dtype[1] in 'SUO':
+        return 'String'
+    return _DATA_TYPES.get(dtype[1:], 'double')
+
+
+def _att(parent, name, value):
+    e = etree.SubElement(parent, 'att', name=name)
+    if isinstance(value, bytes):
+        value = value.decode(ENCODING)
+    if isinstance(value, str):
+        e.text = value
+        return e
+
+    values = value.tolist() if hasattr(value, 'tolist') else value
+    if not isinstance(values, list):
+        values = [values]
+    dtype = getattr(value, 'dtype', None)
+    att_type = _DATA_TYPES.get(dtype.str[1:], 'double') if dtype is not None else 'double'
+    e.attrib['type'] = att_type + ('List' if len(values) > 1 else '')
+    e.text = ' '.join(str(v) for v in values)
+    return e
+
+
+def _destination_name(name, var):
+    standard_name = var.__dict__.get('standard_name', '')
+    for dest in ('time', 'latitude', 'longitude'):
+        if standard_name == dest:
+            return dest
+    return {'lat': 'latitude', 'lon': 'longitude'}.get(name, name)
+
+
+def _variable(parent, tag, name, var, with_type=True):
+    el = etree.SubElement(parent, tag)
+    etree.SubElement(el, 'sourceName').text = name
+    etree.SubElement(el, 'destinationName').text = _destination_name(name, var)
+    if with_type:
+        etree.SubElement(el, 'dataType').text = _data_type(var)
+    _default_attributes(etree.SubElement(el, 'addAttributes'), name, var.__dict__)
+    return el
+
+
+def _default_attributes(attrs, name, source):
+    """Add the attributes GenerateDatasetsXml adds to a variable lacking them.
+    """
+    if 'ioos_category' not in source:
+        _att(attrs, 'ioos_category', 'Time' if name == 'time' else 'Unknown')
+    if 'long_name' not in source:
+        _att(attrs, 'long_name', name.replace('_', ' ').title())
+    if name in ('x', 'y'):
+        # Mirror GenerateDatasetsXml, which guesses grid indices x/y are lon/lat
+        _att(attrs, 'source_name', name)
+        _att(attrs, 'standard_name', 'longitude' if name == 'x' else 'latitude')
+        _att(attrs, 'units', 'count')
+    return attrs
+
+
+def sample_file(datadir, regex='.*'):
+    """Return the most recently modified file in datadir matching regex.
+    """
+    pattern = re.compile(regex or '.*')
+    newest = None
+    for dirpath, _, filenames in os.walk(datadir):
+        for fname in filenames:
+            if pattern.fullmatch(fname):
+                path = os.path.join(dirpath, fname)
+                mtime = os.stat(path).st_mtime_ns
+                if newest is None or mtime > newest[0]:
+                    newest = (mtime, path)
+    if newest is None:
+        raise FileNotFoundError(f'no file matching {regex} in {datadir}')
+    return newest[1]
+
+
+def native_fragment(edd_type, datadir, regex='.*', sample='', *args):
+    """Generate a dataset fragment from NetCDF headers, without ERDDAP.
+
+    Only the dimensions, variables and attributes of one sample file are read.
+    The arguments follow GenerateDatasetsXml, so the same argument list can be
+    used with either backend; extra arguments are ignored.
+
+    Args:
+        edd_type (str): EDDTableFromNcCFFiles or EDDGridFromNcFiles.
+        datadir (str): Data Directory.
+        regex (str): fileNameRegex.
+        sample (str): Sample file, defaults to the newest file matching regex.
+
+    Returns:
+        bytes: The dataset fragment.
+    """
+    if edd_type not in NATIVE_TYPES:
+        raise ValueError(f'{edd_type} is not supported by the native backend, '
+                         f'use one of {NATIVE_TYPES}')
+    sample = sample or sample_file(datadir, regex)
+    datadir = os.path.join(os.path.abspath(datadir), '')
+
+    root = etree.Element('dataset', type=edd_type, datasetID=os.path.basename(datadir[:-1]),
+                         active='true')
+    etree.SubElement(root, 'reloadEveryNMinutes').text = '10080' if edd_type.startswith('EDDTable') else '1440'
+    etree.SubElement(root, 'updateEveryNMillis').text = '10000'
+    etree.SubElement(root, 'fileDir').text = datadir
+    etree.SubElement(root, 'fileNameRegex').text = regex
+    etree.SubElement(root, 'recursive').text = 'true'
+    etree.SubElement(root, 'pathRegex').text = '.*'
+    etree.SubElement(root, 'metadataFrom').text = 'last'
+    if edd_type == 'EDDTableFromNcCFFiles':
+        etree.SubElement(root, 'preExtractRegex')
+        etree.SubElement(root, 'postExtractRegex')
+        etree.SubElement(root, 'extractRegex')
+        etree.SubElement(root, 'columnNameForExtract')
+        etree.SubElement(root, 'sortFilesBySourceNames')
+    etree.SubElement(root, 'fileTableInMemory').text = 'false'
+    etree.SubElement(root, 'accessibleViaFiles').text = 'false'
+    attrs = etree.SubElement(root, 'addAttributes')
+
+    with Dataset(sample, 'r') as nc:
+        gatts = nc.__dict__
+        if edd_type == 'EDDGridFromNcFiles':
+            cdm_data_type = 'Grid'
+        else:
+            feature = str(gatts.get('featureType', '')).lower()
+            cdm_data_type = _FEATURE_TYPES.get(feature, 'Other')
+
+        defaults = OrderedDict([
+            ('cdm_data_type', cdm_data_type),
+            ('Conventions', 'CF-1.6, ACDD-1.3'),
+            ('infoUrl', '???'),
+            ('institution', '???'),
+            ('keywords', ', '.join(sorted(nc.variables))),
+            ('license', '[standard]'),
+            ('sourceUrl', '(local files)'),
+            ('standard_name_vocabulary', 'CF Standard Name Table v55'),
+            ('summary', os.path.basename(datadir[:-1])),
+            ('title', os.path.basename(datadir[:-1])),
+        ])
+        for name, value in defaults.items():
+            _att(attrs, name, gatts.get(name, value) if name != 'cdm_data_type' else value)
+
+        if edd_type == 'EDDGridFromNcFiles':
+            ndim = max(v.ndim for v in nc.variables.values())
+            data_vars = [k for k, v in nc.variables.items() if v.ndim == ndim and ndim > 0]
+            dims = nc.variables[data_vars[0]].dimensions
+            for dim in dims:
+                var = nc.variables.get(dim)
+                if var is None:
+                    el = etree.SubElement(root, 'axisVariable')
+                    etree.SubElement(el, 'sourceName').text = dim
+                    etree.SubElement(el, 'destinationName').text = dim
+                    # No coordinate variable, e.g. x and y grid indices
+                    _default_attributes(etree.SubElement(el, 'addAttributes'), dim, {})
+                else:
+                    _variable(root, 'axisVariable', dim, var, with_type=False)
+            for name in data_vars:
+                if nc.variables[name].dimensions == dims:
+                    _variable(root, 'dataVariable', name, nc.variables[name])
+        else:
+            roles = OrderedDict()
+            for name, var in nc.variables.items():
+                _variable(root, 'dataVariable', name, var)
+                role = var.__dict__.get('cf_role')
+                if role in _CF_ROLES:
+                    roles.setdefault(_CF_ROLES[role], []).append(name)
+            for att_name, names in roles.items():
+                _att(attrs, att_name, ', '.join(names))
+                _att(attrs, 'subsetVariables', ', '.join(names))
+
+    return etree.tostring(root, encoding=ENCODING, xml_declaration=False, pretty_print=True)
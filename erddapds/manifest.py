@@ -0,0 +1,156 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import os
+from collections import OrderedDict
+
+import yaml
+
+from erddapds.core import ERDDAPDATASET
+from erddapds.datasetsxml import DatasetsXML
+from erddapds.flags import FlagWriter
+from erddapds.generate import (FragmentCache,
+                               generate_datasetxml_batch)
+from erddapds.metrics import phase
+from erddapds.transaction import Transaction
+
+EDD_TYPE = 'EDDTableFromNcCFFiles'
+
+# ERDDAPDATASET arguments an entry, or its config file, may set
+DATASET_KEYS = ('details', 'metadata', 'variables', 'backend', 'colorbar')
+
+
+def load_manifest(manifest_file):
+    """Read a manifest yaml file, see examples/manifest.yml.
+
+    Config files of the entries are read too, relative paths being taken
+    from the directory of the manifest.
+    """
+    with open(manifest_file, 'r') as yml:
+        manifest = yaml.safe_load(yml.read())
+    assert 'datasets' in manifest, f'{manifest_file} has no datasets section'
+
+    base = os.path.dirname(os.path.abspath(manifest_file))
+    defaults = manifest.get('defaults') or {}
+    entries = []
+    for entry in manifest['datasets']:
+        entry = dict(defaults, **entry)
+        if 'config' in entry:
+            with open(os.path.join(base, entry['config']), 'r') as yml:
+                config = yaml.safe_load(yml.read())
+            for key in DATASET_KEYS:
+                if key in config and key not in entry:
+                    entry[key] = config[key]
+        assert 'dsid' in entry and 'datadir' in entry, f'{entry} needs a dsid and a datadir'
+        assert 'details' in entry, f'{entry["dsid"]} has no details'
+        entries.append(entry)
+    manifest['datasets'] = entries
+    return manifest
+
+
+def default_gds_args(edd_type, datadir, regex, infourl='http://example.com',
+                     institution='Some Organization', summary='This is Some Data',
+                     title='NetCDF File'):
+    """GenerateDatasetsXml arguments answering the prompts of edd_type.
+
+    Only the EDDTableFrom...Files and EDDGridFromNcFiles(Unpacked) prompts are
+    known; the grid prompts have no infoUrl, institution, summary or title.
+
+    Raises:
+        ValueError: For the other types, whose arguments must be listed in full.
+    """
+    if edd_type.startswith('EDDTableFrom') and edd_type.endswith('Files'):
+        # sampleFileName, reloadEveryNMinutes, pre/post/extractRegex,
+        # columnNameForExtract, sortFilesBySourceNames left to their default
+        return [edd_type, datadir, regex,
+                '', '', '', '', '', '', '',
+                infourl, institution, summary, title]
+    if edd_type in ('EDDGridFromNcFiles', 'EDDGridFromNcFilesUnpacked'):
+        # sampleFileName, group, dimensionsCSV, reloadEveryNMinutes, cacheFromUrl
+        return [edd_type, datadir, regex, '', '', '', '', '']
+    raise ValueError(f'No default GenerateDatasetsXml arguments for {edd_type}, '
+                     f'list them under args')
+
+
+def gds_args(entry):
+    """GenerateDatasetsXml arguments of a manifest entry.
+
+    An entry can list them in full under args. Otherwise they answer the
+    prompts of its type, see default_gds_args.
+    """
+    edd_type = entry.get('type', EDD_TYPE)
+    if 'args' in entry:
+        return [edd_type] + [str(x) for x in entry['args']]
+    options = {k: entry[k] for k in ('infourl', 'institution', 'summary', 'title') if k in entry}
+    return default_gds_args(edd_type, entry['datadir'], entry['details']['fileNameRegex'],
+                            **options)
+
+
+def create_datasets(manifest, gds_loc=None, dsxml=None, bpd=None, workers=None):
+    """Create every dataset of a manifest at once.
+
+    Fragments are generated concurrently, then all of them are added to
+    datasets.xml in a single write and the reload flags are written once.
+    Datasets already in datasets.xml are replaced in place, or left alone
+    and not flagged when their content is unchanged.
+
+    Args:
+        manifest (dict or str): Manifest, or manifest yaml file.
+        gds_loc (str): GenerateDatasetsXml.sh (Full path), overrides gdsloc.
+        dsxml (str): datasets.xml location, overrides datasetsxml.
+        bpd (str): Big Parent Directory, overrides bpd.
+        workers (int): Concurrent generations, overrides workers (default 4).
+
+    Returns:
+        OrderedDict: Status message, or the exception raised, for each dataset.
+    """
+    if isinstance(manifest, str):
+        manifest = load_manifest(manifest)
+    gds_loc = gds_loc or manifest.get('gdsloc', '')
+    dsxml = dsxml or manifest['datasetsxml']
+    bpd = bpd or manifest['bpd']
+    workers = workers or manifest.get('workers', 4)
+    cache = FragmentCache(manifest['cache_dir']) if manifest.get('cache_dir') else None
+
+    jobs = []
+    results = OrderedDict()
+    for entry in manifest['datasets']:
+        edd = ERDDAPDATASET(entry['dsid'], **{k: entry[k] for k in DATASET_KEYS if k in entry})
+        try:
+            jobs.append((edd, gds_args(entry)))
+            results[edd.dsid] = None
+        except ValueError as e:
+            results[edd.dsid] = e
+
+    with phase('create_datasets', 'generate') as m:
+        generated = generate_datasetxml_batch(jobs, gds_loc=gds_loc, big_parent_directory=bpd,
+                                              workers=workers, cache=cache)
+        m.add(records=len(generated))
+
+    store = DatasetsXML(dsxml)
+    txn = Transaction(dsxml)
+    for edd, root in generated:
+        if isinstance(root, BaseException):
+            results[edd.dsid] = root
+        elif root is None:
+            results[edd.dsid] = RuntimeError(f'Dataset template generation failed for {edd.dsid}')
+        elif store.unchanged(root):
+            results[edd.dsid] = 'Dataset unchanged.'
+        else:
+            txn.put(root)
+            results[edd.dsid] = None
+
+    with phase('create_datasets', 'datasetsxml') as m:
+        committed = txn.commit_each()
+        m.add(nbytes=os.path.getsize(dsxml), records=len(committed))
+
+    with FlagWriter(bpd) as flags:
+        for dsid, error in committed.items():
+            if error is None:
+                flags.flag(dsid)
+                results[dsid] = 'Dataset sucessfully added.'
+            else:
+                results[dsid] = error
+    return results
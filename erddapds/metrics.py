@@ -0,0 +1,207 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import json
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_LISTENERS = []
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def add(self, nbytes=0, records=0):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class Phase(object):
+    """Measurements of one phase, passed to listeners once it finishes.
+
+    Attributes:
+        operation (str): ERDDAPDATASET operation, e.g. update_dataset.
+        name (str): Phase within the operation, e.g. to_netcdf.
+        dsid (str): Dataset ID.
+        seconds (float): Wall time of the phase.
+        nbytes (int): Bytes read or written.
+        records (int): Records (time steps, datasets) handled.
+        process_peak_rss_kb (int): Peak resident memory of the process so far,
+            since it started, not just over the phase.
+        peak_rss_delta_kb (int): How much the phase raised that peak, 0 when
+            it stayed under an earlier peak. Concurrent phases share it.
+        error (str): Exception type name if the phase raised.
+    """
+    __slots__ = ('operation', 'name', 'dsid', 'seconds', 'nbytes', 'records',
+                 'process_peak_rss_kb', 'peak_rss_delta_kb', 'error')
+
+    def __init__(self, operation, name, dsid):
+        self.operation = operation
+        self.name = name
+        self.dsid = dsid
+        self.seconds = 0.0
+        self.nbytes = 0
+        self.records = 0
+        self.process_peak_rss_kb = 0
+        self.peak_rss_delta_kb = 0
+        self.error = None
+
+    def add(self, nbytes=0, records=0):
+        self.nbytes += int(nbytes)
+        self.records += int(records)
+
+    def as_dict(self):
+        return OrderedDict((k, getattr(self, k)) for k in self.__slots__)
+
+
+def add_listener(listener):
+    """Register listener, a callable receiving every finished Phase.
+    """
+    _LISTENERS.append(listener)
+    return listener
+
+
+def remove_listener(listener):
+    if listener in _LISTENERS:
+        _LISTENERS.remove(listener)
+
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+@contextmanager
+def phase(operation, name, dsid=None):
+    """Time a phase of an operation and report it to the listeners.
+
+    With no listener registered nothing is measured, so instrumented
+    code pays close to nothing.
+
+    Yields:
+        Phase: call its add() to record bytes and records.
+    """
+    if not _LISTENERS:
+        yield _NULL_PHASE
+        return
+
+    p = Phase(operation, name, dsid)
+    peak = _peak_rss_kb()
+    start = time.perf_counter()
+    try:
+        yield p
+    except BaseException as e:
+        p.error = type(e).__name__
+        raise
+    finally:
+        p.seconds = time.perf_counter() - start
+        p.process_peak_rss_kb = _peak_rss_kb()
+        p.peak_rss_delta_kb = p.process_peak_rss_kb - peak
+        for listener in list(_LISTENERS):
+            try:
+                listener(p)
+            except Exception as e:
+                print(f'metrics listener {listener} failed: {str(e)}')
+
+
+class JSONLogListener(object):
+    """Write every phase as one JSON object per line.
+
+    Args:
+        stream (file): Open text file, defaults to stderr.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.__lock = threading.Lock()
+
+    def __call__(self, p):
+        line = json.dumps(p.as_dict())
+        with self.__lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+class PrometheusCollector(object):
+    """Aggregate phases into Prometheus text exposition format counters.
+    """
+
+    def __init__(self, prefix='erddapds'):
+        self.prefix = prefix
+        self.__lock = threading.Lock()
+        self.__totals = OrderedDict()
+        self.__peak_rss_kb = 0
+
+    def __call__(self, p):
+        key = (p.operation, p.name, p.dsid or '', 'false' if p.error is None else 'true')
+        with self.__lock:
+            t = self.__totals.setdefault(key, [0, 0.0, 0, 0])
+            t[0] += 1
+            t[1] += p.seconds
+            t[2] += p.nbytes
+            t[3] += p.records
+            self.__peak_rss_kb = max(self.__peak_rss_kb, p.process_peak_rss_kb)
+
+    def render(self):
+        """Return the collected metrics in Prometheus text format.
+        """
+        series = (('phase_total', 'counter', 'Phases run', 0),
+                  ('phase_seconds_total', 'counter', 'Wall time spent in phases', 1),
+                  ('phase_bytes_total', 'counter', 'Bytes handled by phases', 2),
+                  ('phase_records_total', 'counter', 'Records handled by phases', 3))
+        lines = []
+        with self.__lock:
+            for metric, kind, helptext, i in series:
+                name = f'{self.prefix}_{metric}'
+                lines.append(f'# HELP {name} {helptext}')
+                lines.append(f'# TYPE {name} {kind}')
+                for (operation, phase_name, dsid, error), t in self.__totals.items():
+                    labels = (f'operation="{operation}",phase="{phase_name}",'
+                              f'dataset="{dsid}",error="{error}"')
+                    lines.append(f'{name}{{{labels}}} {t[i]}')
+            name = f'{self.prefix}_peak_rss_bytes'
+            lines.append(f'# HELP {name} Peak resident memory of the process')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {self.__peak_rss_kb * 1024}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.render())
+
+
+@contextmanager
+def collect(json_path=None, prom_path=None):
+    """Register the listeners asked for on a command line for the duration of a block.
+
+    Args:
+        json_path (str): Append JSON lines to this file ('-' for stderr).
+        prom_path (str): Write a Prometheus text dump here on exit.
+    """
+    listeners = []
+    stream = None
+    if json_path:
+        stream = sys.stderr if json_path == '-' else open(json_path, 'a')
+        listeners.append(add_listener(JSONLogListener(stream)))
+    collector = None
+    if prom_path:
+        collector = add_listener(PrometheusCollector())
+        listeners.append(collector)
+    try:
+        yield collector
+    finally:
+        for listener in listeners:
+            remove_listener(listener)
+        if stream is not None and stream is not sys.stderr:
+            stream.close()
+        if collector is not None:
+            collector.dump(prom_path)
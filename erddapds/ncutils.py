@@ -0,0 +1,552 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from netCDF4 import (Dataset,
+                     num2date)
+import xarray as xr
+
+
+def _changed_atts(src, dst, skip=('_FillValue',)):
+    """Return the attributes of src that are missing or different on dst.
+    """
+    current = {k: dst.getncattr(k) for k in dst.ncattrs()}
+    changed = {}
+    for k in src.ncattrs():
+        if k in skip:
+            continue
+        v = src.getncattr(k)
+        if k not in current or str(current[k]) != str(v):
+            changed[k] = v
+    return changed
+
+
+def check_schema(dst, src, dim='time'):
+    """Check that the records of src can be appended onto dst along dim.
+
+    Args:
+        dst (netCDF4.Dataset): Existing dataset.
+        src (netCDF4.Dataset): Dataset holding the new records.
+        dim (str): Name of the unlimited dimension.
+
+    Raises:
+        ValueError: If the two schemas do not match.
+    """
+    if dim not in dst.dimensions or not dst.dimensions[dim].isunlimited():
+        raise ValueError(f'{dim} is not an unlimited dimension of the existing file')
+    if dim not in src.dimensions:
+        raise ValueError(f'{dim} dimension not found in new file')
+
+    for name, d in src.dimensions.items():
+        if name == dim:
+            continue
+        if name not in dst.dimensions:
+            raise ValueError(f'{name} dimension not found in existing file')
+        if len(d) != len(dst.dimensions[name]):
+            raise ValueError(f'{name} dimension size mismatch: '
+                             f'{len(dst.dimensions[name])} != {len(d)}')
+
+    for name, var in src.variables.items():
+        if name not in dst.variables:
+            raise ValueError(f'{name} variable not found in existing file')
+        old = dst.variables[name]
+        if old.dimensions != var.dimensions:
+            raise ValueError(f'{name} dimensions mismatch: {old.dimensions} != {var.dimensions}')
+        if old.dtype != var.dtype:
+            raise ValueError(f'{name} dtype mismatch: {old.dtype} != {var.dtype}')
+
+    for name, old in dst.variables.items():
+        if dim in old.dimensions and name not in src.variables:
+            raise ValueError(f'{name} variable not found in new file')
+
+
+def append_netcdf(ncfile, newFile, dim='time'):
+    """Append the records of newFile onto ncfile in place along dim.
+
+    Only the new records are written, so the cost of an append depends
+    on the size of newFile and not on the size of ncfile.
+    Variable and global attributes are carried over from newFile.
+    The file is kept in time order: every record of newFile must come after
+    the last one of ncfile, see dedup_netcdf for re-delivered records.
+
+    Args:
+        ncfile (str): Existing NetCDF file, with dim unlimited.
+        newFile (str): NetCDF file holding the new records.
+        dim (str): Name of the unlimited dimension.
+
+    Returns:
+        int: Number of records appended.
+
+    Raises:
+        ValueError: If the schemas or time units differ, or if newFile has
+            records at or before the last one of ncfile or out of order.
+    """
+    with Dataset(ncfile, 'a') as dst, Dataset(newFile, 'r') as src:
+        dst.set_auto_maskandscale(False)
+        src.set_auto_maskandscale(False)
+        check_schema(dst, src, dim=dim)
+
+        start = len(dst.dimensions[dim])
+        count = len(src.dimensions[dim])
+        if dim in src.variables and count:
+            old_units = getattr(dst.variables[dim], 'units', None)
+            new_units = getattr(src.variables[dim], 'units', None)
+            if old_units != new_units:
+                raise ValueError(f'{dim} units mismatch: {old_units} != {new_units}')
+            times = np.asarray(src.variables[dim][:])
+            if (np.diff(times) <= 0).any():
+                raise ValueError(f'{newFile} records are not in increasing {dim} order')
+            if start and times[0] <= dst.variables[dim][start - 1]:
+                raise ValueError(f'{newFile} has records at or before the last one in {ncfile}, '
+                                 f'use the dedup mode for re-delivered records')
+        for name, var in src.variables.items():
+            old = dst.variables[name]
+            if dim in var.dimensions and count:
+                idx = [slice(None)] * var.ndim
+                idx[var.dimensions.index(dim)] = slice(start, start + count)
+                old[tuple(idx)] = var[:]
+
+            atts = _changed_atts(var, old)
+            if atts:
+                old.setncatts(atts)
+
+        atts = _changed_atts(src, dst, skip=())
+        if atts:
+            dst.setncatts(atts)
+
+        return count
+
+
+OVERLAP_POLICIES = ('keep-newest', 'keep-oldest', 'reject')
+# merge_datasets also takes no-conflicts, the historical xr.merge behaviour
+MERGE_POLICIES = ('no-conflicts',) + OVERLAP_POLICIES
+
+
+def time_overlap(old, new, policy='keep-newest'):
+    """Classify the new time values against the existing ones.
+
+    Only the two time coordinates are looked at. Records repeated within
+    new are reduced to the last (keep-newest) or first occurrence.
+
+    Args:
+        old (numpy.ndarray): Existing raw time values.
+        new (numpy.ndarray): New raw time values, in the same units.
+        policy (str): keep-newest, keep-oldest or reject.
+
+    Returns:
+        tuple: Indices into new of the records to append after the last
+        existing one, sorted by time; (new, old) index pairs of the records
+        already present, sorted by old index; and indices into new of the
+        records falling between existing ones, sorted by time.
+    """
+    if policy not in OVERLAP_POLICIES:
+        raise ValueError(f'{policy} is not one of {list(OVERLAP_POLICIES)}')
+    old = np.asarray(old)
+    new = np.asarray(new)
+
+    if policy == 'keep-newest':
+        # np.unique keeps the first occurrence, so look at new reversed
+        _, last = np.unique(new[::-1], return_index=True)
+        keep = len(new) - 1 - last
+    else:
+        _, keep = np.unique(new, return_index=True)
+    # keep is sorted by time as np.unique sorts the values
+    values = new[keep]
+
+    order = np.argsort(old, kind='stable')
+    sorted_old = old[order]
+    pos = np.searchsorted(sorted_old, values)
+    found = np.zeros(len(values), dtype=bool)
+    if len(sorted_old):
+        found = sorted_old[np.minimum(pos, len(sorted_old) - 1)] == values
+
+    matched_new = keep[found]
+    matched_old = order[pos[found]]
+    by_old = np.argsort(matched_old, kind='stable')
+    matched = (matched_new[by_old], matched_old[by_old])
+
+    rest = ~found
+    later = values > sorted_old[-1] if len(sorted_old) else np.ones(len(values), dtype=bool)
+    return keep[rest & later], matched, keep[rest & ~later]
+
+
+def _check_conflicts(datasets, dim):
+    """Raise a ValueError if records found in two datasets hold different values.
+
+    Like xr.merge with compat='no_conflicts', missing values conflict with
+    nothing. Only the records in both datasets are read.
+    """
+    for i, old in enumerate(datasets):
+        for new in datasets[i + 1:]:
+            common = np.intersect1d(old[dim].values, new[dim].values)
+            if not len(common):
+                continue
+            a = old.sel({dim: common})
+            b = new.sel({dim: common})
+            for name in a.data_vars:
+                if name not in b.data_vars or dim not in a[name].dims:
+                    continue
+                conflict = (a[name] != b[name]) & a[name].notnull() & b[name].notnull()
+                other = [d for d in conflict.dims if d != dim]
+                records = int((conflict.any(other) if other else conflict).sum())
+                if records:
+                    raise ValueError(f'conflicting values for variable {name!r} in {records} '
+                                     f'records found in more than one file')
+
+
+def merge_datasets(datasets, policy='no-conflicts', dim='time', block=None):
+    """Outer merge of datasets along dim, records found twice resolved by policy.
+
+    no-conflicts fails if a record found twice holds different values, as
+    xr.merge with compat='no_conflicts' does, only reading those records;
+    keep-newest takes the values of the later dataset, the earlier ones only
+    filling its missing values; keep-oldest does the reverse; reject fails if
+    any time value is in more than one dataset. Dask backed datasets stay
+    lazy and are only read a block at a time when written.
+
+    Args:
+        datasets (list): xarray Datasets opened with decode_cf=False, oldest first.
+        policy (str): no-conflicts, keep-newest, keep-oldest or reject.
+        dim (str): Name of the record dimension.
+        block (int): Chunk length of the result along dim, None to leave it.
+
+    Returns:
+        xarray.Dataset: Merged dataset, sorted along dim.
+    """
+    if policy not in MERGE_POLICIES:
+        raise ValueError(f'{policy} is not one of {list(MERGE_POLICIES)}')
+    if policy == 'no-conflicts':
+        _check_conflicts(datasets, dim)
+    elif policy == 'reject':
+        seen = np.asarray(datasets[0][dim].values)
+        for ds in datasets[1:]:
+            times = np.asarray(ds[dim].values)
+            overlap = np.intersect1d(seen, times)
+            if len(overlap):
+                raise ValueError(f'{len(overlap)} records are in more than one file')
+            seen = np.union1d(seen, times)
+
+    ordered = list(datasets if policy == 'keep-oldest' else datasets[::-1])
+    merged = ordered[0]
+    for ds in ordered[1:]:
+        merged = merged.combine_first(ds)
+    if not merged.indexes[dim].is_monotonic_increasing:
+        merged = merged.sortby(dim)
+
+    # Aligning on the union of the time values turns integers into floats
+    for name, var in list(merged.variables.items()):
+        src = next(ds[name] for ds in ordered if name in ds.variables)
+        if var.dtype != src.dtype and src.dtype.kind in 'iu':
+            fill = src.attrs.get('_FillValue', src.attrs.get('missing_value'))
+            data = merged[name] if fill is None else merged[name].fillna(fill)
+            merged[name] = data.astype(src.dtype)
+    if block:
+        merged = merged.chunk({dim: block})
+    return merged
+
+
+def dedup_netcdf(ncfile, newFile, policy='keep-newest', dim='time'):
+    """Fold the records of newFile into ncfile, resolving time overlaps by policy.
+
+    Unlike an xarray merge with compat='no_conflicts', only the time
+    coordinates of both files are compared. Records after the last existing
+    time step are appended in place. Records already present are overwritten
+    in place (keep-newest), skipped (keep-oldest) or make the update fail
+    (reject). Only records falling between existing time steps need the
+    file to be rewritten, in time order.
+
+    Args:
+        ncfile (str): Existing NetCDF file, with dim unlimited.
+        newFile (str): NetCDF file holding the new records.
+        policy (str): keep-newest, keep-oldest or reject.
+        dim (str): Name of the unlimited dimension and of its coordinate.
+
+    Returns:
+        dict: Number of records appended, replaced, skipped and inserted.
+
+    Raises:
+        ValueError: If the schemas or time units differ, or if records
+            overlap with the reject policy.
+    """
+    with Dataset(ncfile, 'a') as dst, Dataset(newFile, 'r') as src:
+        dst.set_auto_maskandscale(False)
+        src.set_auto_maskandscale(False)
+        check_schema(dst, src, dim=dim)
+        old_units = getattr(dst.variables[dim], 'units', None)
+        new_units = getattr(src.variables[dim], 'units', None)
+        if old_units != new_units:
+            raise ValueError(f'{dim} units mismatch: {old_units} != {new_units}')
+
+        appended, (new_idx, old_idx), inserted = time_overlap(
+            dst.variables[dim][:], src.variables[dim][:], policy=policy)
+        if policy == 'reject' and len(new_idx):
+            raise ValueError(f'{len(new_idx)} records of {newFile} are already in {ncfile}')
+
+        counts = {'appended': len(appended), 'inserted': len(inserted),
+                  'replaced': len(new_idx) if policy == 'keep-newest' else 0,
+                  'skipped': len(src.dimensions[dim]) - len(appended) - len(inserted)}
+        counts['skipped'] -= counts['replaced']
+
+        start = len(dst.dimensions[dim])
+        for name, var in src.variables.items():
+            old = dst.variables[name]
+            if dim in var.dimensions:
+                axis = var.dimensions.index(dim)
+                data = var[:]
+                idx = [slice(None)] * var.ndim
+                if len(appended):
+                    idx[axis] = slice(start, start + len(appended))
+                    old[tuple(idx)] = np.take(data, appended, axis=axis)
+                if counts['replaced']:
+                    idx[axis] = old_idx
+                    old[tuple(idx)] = np.take(data, new_idx, axis=axis)
+
+            atts = _changed_atts(var, old)
+            if atts:
+                old.setncatts(atts)
+
+        atts = _changed_atts(src, dst, skip=())
+        if atts:
+            dst.setncatts(atts)
+
+    if len(inserted):
+        _insert_records(ncfile, newFile, inserted, dim=dim)
+    return counts
+
+
+def _insert_records(ncfile, newFile, index, dim='time'):
+    """Rewrite ncfile with the records index of newFile inserted in time order.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ncfile)), suffix='.tmp')
+    os.close(fd)
+    try:
+        with xr.open_dataset(ncfile, decode_cf=False) as ds_old, \
+                xr.open_dataset(newFile, decode_cf=False) as ds_new:
+            dsall = xr.concat([ds_old, ds_new.isel({dim: index})], dim=dim,
+                              data_vars='minimal', coords='minimal', compat='override')
+            dsall = dsall.isel({dim: np.argsort(dsall[dim].values, kind='stable')})
+            for k, v in ds_old.variables.items():
+                dsall[k].encoding = v.encoding
+            dsall.to_netcdf(tmp, unlimited_dims=dim)
+        os.replace(tmp, ncfile)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def parse_size(size):
+    """Convert a size such as 2048, '512MB' or '2GB' to a number of bytes.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = str(size).strip().upper().rstrip('B').rstrip('I')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+
+def time_block_size(ncfiles, memory_budget, dim='time'):
+    """Number of records along dim to process at a time within memory_budget.
+
+    The size of one record is read from the NetCDF headers only.
+    The budget is shared between two blocks of every input file (as read and
+    aligned on the merged time values) and two blocks of the output (merged
+    and being written), with a factor of two headroom for temporaries.
+
+    Args:
+        ncfiles (list): NetCDF files taking part in the merge.
+        memory_budget (int or str): Memory budget, e.g. 2147483648 or '2GB'.
+        dim (str): Name of the record dimension.
+
+    Returns:
+        int: Block size along dim, at least 1.
+    """
+    record_bytes = 0
+    for ncfile in ncfiles:
+        with Dataset(ncfile, 'r') as nc:
+            nbytes = 0
+            for var in nc.variables.values():
+                if dim not in var.dimensions:
+                    continue
+                size = var.dtype.itemsize if hasattr(var.dtype, 'itemsize') else 8
+                for d in var.dimensions:
+                    if d != dim:
+                        size *= len(nc.dimensions[d])
+                nbytes += size
+            record_bytes = max(record_bytes, nbytes)
+
+    budget = parse_size(memory_budget)
+    return max(1, budget // (max(record_bytes, 1) * (2 * len(ncfiles) + 2) * 2))
+
+
+# Block size of a checkpointed write when no memory budget is given
+CHECKPOINT_BUDGET = '1GB'
+
+
+def _fingerprint(ds, inputs):
+    """What a partial output depends on: the inputs and the layout of ds.
+    """
+    files = []
+    for f in inputs:
+        st = os.stat(f)
+        files.append([os.path.abspath(f), st.st_size, st.st_mtime_ns])
+    layout = repr(sorted((name, var.dims, var.shape, str(var.dtype),
+                          sorted((k, str(v)) for k, v in var.encoding.items()
+                                 if k != 'source'))
+                         for name, var in ds.variables.items()))
+    return {'inputs': files, 'layout': hashlib.sha256(layout.encode()).hexdigest()}
+
+
+def _read_journal(journal):
+    try:
+        with open(journal, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_journal(journal, key, done):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(journal)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'key': key, 'done': done}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, journal)
+
+
+def _records(path, dim):
+    """Records along dim of the partial output path, None if it cannot be read.
+    """
+    try:
+        with Dataset(path, 'r') as nc:
+            return len(nc.dimensions[dim])
+    except (OSError, KeyError, RuntimeError):
+        return None
+
+
+def write_checkpointed(ds, path, target, inputs, block, dim='time'):
+    """Write ds to path a block of records at a time, then move it onto target.
+
+    The number of records written is recorded in the journal path.journal
+    after every block, along with the size and mtime of the inputs and the
+    layout of ds. A rerun on the same inputs continues after the last block
+    recorded; a partial output of other inputs, or one left unreadable or
+    shorter than recorded by a crash, is started over. Blocks are
+    written by position, so a block written but not yet recorded is only
+    written again. The journal is removed once path is moved onto target;
+    a journal left behind no longer matches target and is ignored.
+
+    Args:
+        ds (xarray.Dataset): Dataset to write, possibly dask backed.
+        path (str): Partial output, kept between runs.
+        target (str): Final location of the output.
+        inputs (list): Files ds is read from.
+        block (int): Records per block.
+        dim (str): Name of the unlimited dimension.
+
+    Returns:
+        int: Number of records written by this run, the others being resumed.
+    """
+    journal = f'{path}.journal'
+    key = _fingerprint(ds, inputs)
+    total = ds.sizes.get(dim, 0)
+    state = _read_journal(journal)
+    done = 0
+    if state and state.get('key') == key and os.path.exists(path):
+        done = min(state['done'], total)
+        records = _records(path, dim)
+        if records is None or records < done:
+            print(f'{path} is damaged, writing it again from the start.')
+            done = 0
+    if not done and os.path.exists(path):
+        os.remove(path)
+
+    resumed = done
+    if not done:
+        # The first block creates the file, along with the variables without dim
+        head = ds.isel({dim: slice(0, block)}).compute(scheduler='synchronous')
+        head.to_netcdf(path, unlimited_dims=dim)
+        done = head.sizes.get(dim, 0)
+        _write_journal(journal, key, done)
+
+    while done < total:
+        end = min(done + block, total)
+        part = ds.isel({dim: slice(done, end)}).compute(scheduler='synchronous')
+        with Dataset(path, 'a') as nc:
+            nc.set_auto_maskandscale(False)
+            for name, var in part.variables.items():
+                if dim in var.dims:
+                    idx = [slice(None)] * var.ndim
+                    idx[var.dims.index(dim)] = slice(done, end)
+                    nc.variables[name][tuple(idx)] = var.values
+        _write_journal(journal, key, end)
+        done = end
+
+    shutil.move(path, target)
+    os.remove(journal)
+    return total - resumed
+
+
+PARTITION_FORMATS = OrderedDict([
+    ('hourly', '%Y%m%d%H'),
+    ('daily', '%Y%m%d'),
+    ('monthly', '%Y%m'),
+])
+
+
+def partition_keys(times, units, calendar='standard', freq='daily'):
+    """Return the partition key of every raw time value.
+
+    Args:
+        times (numpy.ndarray): Raw, not decoded, time values.
+        units (str): CF time units, e.g. 'seconds since 1970-01-01'.
+        calendar (str): CF calendar.
+        freq (str): hourly, daily or monthly.
+
+    Returns:
+        numpy.ndarray: Keys such as '20240131' for daily partitions.
+    """
+    if freq not in PARTITION_FORMATS:
+        raise ValueError(f'{freq} is not one of {list(PARTITION_FORMATS)}')
+    fmt = PARTITION_FORMATS[freq]
+    dates = num2date(np.asarray(times), units, calendar=calendar or 'standard')
+    return np.array([d.strftime(fmt) for d in np.atleast_1d(dates)])
+
+
+def partition_path(datadir, fname, key):
+    """Path of the partition key of the dataset file fname, e.g. mooring_20240131.nc.
+    """
+    stem, ext = os.path.splitext(os.path.basename(fname))
+    return os.path.join(datadir, f'{stem}_{key}{ext}')
+
+
+def partition_regex(fname):
+    """fileNameRegex matching every partition of fname, whatever its frequency.
+    """
+    stem, ext = os.path.splitext(os.path.basename(fname))
+    return f'{re.escape(stem)}_[0-9]{{6,10}}{re.escape(ext)}'
+
+
+def list_partitions(datadir, fname):
+    """Return {key: path} of the existing partitions of fname in datadir.
+    """
+    stem, ext = os.path.splitext(os.path.basename(fname))
+    pattern = re.compile(f'{re.escape(stem)}_(?P<key>[0-9]{{6,10}}){re.escape(ext)}$')
+    found = OrderedDict()
+    for entry in sorted(os.listdir(datadir)):
+        m = pattern.match(entry)
+        if m:
+            found[m.group('key')] = os.path.join(datadir, entry)
+    return found
@@ -0,0 +1,63 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import argparse
+
+import erddapds
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Compact time-partitioned ERDDAP Dataset files')
+    parser.add_argument('dsid', metavar='DATASETID', type=str,
+                        help='Dataset ID')
+    parser.add_argument('bpd', metavar='BIGPARENTDIRECTORY', type=str,
+                        help='Path to Big Parent Directory')
+    parser.add_argument('datadir', metavar='DATADIRECTORY', type=str,
+                        help='Data Directory')
+    parser.add_argument('fname', metavar='FILENAME', type=str,
+                        help='Dataset file name the partitions derive from')
+
+    parser.add_argument('--freq',
+                        metavar='FREQ',
+                        type=str,
+                        choices=['daily', 'monthly'],
+                        default='daily',
+                        help='Partition size after compaction')
+    parser.add_argument('--older-than',
+                        metavar='SECONDS',
+                        type=float,
+                        default=3600,
+                        help='Only compact partitions not written for this many seconds')
+    parser.add_argument('--encoding-profile',
+                        metavar='PROFILE',
+                        type=str,
+                        choices=['append-optimized', 'timeseries-read', 'spatial-read'],
+                        default=None,
+                        help='Compression and chunking of the compacted files')
+    parser.add_argument('--overlap',
+                        metavar='OVERLAP',
+                        type=str,
+                        choices=['keep-newest', 'keep-oldest', 'reject'],
+                        default='keep-newest',
+                        help='How records found in several partitions are resolved')
+    parser.add_argument('--version', action='version', version=erddapds.__version__)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    print(args)
+    edd = erddapds.ERDDAPDATASET(args.dsid)
+    out = edd.compact_partitions(args.datadir, args.fname, bpd=args.bpd,
+                                 freq=args.freq, older_than=args.older_than,
+                                 encoding_profile=args.encoding_profile,
+                                 overlap=args.overlap)
+    for path in out:
+        print(f'Compacted: {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import argparse
+
+import erddapds
+from erddapds.zarrstore import netcdf_to_zarr
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Convert an ERDDAP Dataset from NetCDF files to a Zarr store')
+    parser.add_argument('ncfiles', metavar='NCFILE', type=str, nargs='+',
+                        help='NetCDF File(s) of the dataset, in time order (full path)')
+    parser.add_argument('store', metavar='ZARRSTORE', type=str,
+                        help='Zarr store directory to create (full path)')
+
+    parser.add_argument('--chunk-bytes',
+                        metavar='CHUNKBYTES',
+                        type=str,
+                        default='8MB',
+                        help='Largest chunk of a variable, e.g. 8MB')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Replace an existing store')
+    parser.add_argument('--version', action='version', version=erddapds.__version__)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    print(args)
+    store = netcdf_to_zarr(args.ncfiles, args.store, chunk_bytes=args.chunk_bytes,
+                           overwrite=args.overwrite)
+    print(f'Zarr store written: {store}')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,25 +8,37 @@ import argparse
 import yaml
 
 import erddapds
+from erddapds.flags import FlagWriter
+from erddapds.manifest import (EDD_TYPE,
+                               create_datasets,
+                               default_gds_args,
+                               load_manifest)
+from erddapds.metrics import (collect,
+                              phase)
 
 
 def get_arguments():
     parser = argparse.ArgumentParser(description='Create new ERDDAP Dataset')
-    parser.add_argument('dsid', metavar='DATASETID', type=str,
+    parser.add_argument('dsid', metavar='DATASETID', type=str, nargs='?',
                         help='Dataset ID')
-    parser.add_argument('configfile', metavar='CONFIGFILE',
+    parser.add_argument('configfile', metavar='CONFIGFILE', nargs='?',
                         help='Config yaml file')
-    parser.add_argument('gdsloc', metavar='GDSLOC', type=str,
+    parser.add_argument('gdsloc', metavar='GDSLOC', type=str, nargs='?',
                         help='GenerateDatasetsXml.sh (Full path)')
-    parser.add_argument('datasetsxml', metavar='DATASETSXML', type=str,
+    parser.add_argument('datasetsxml', metavar='DATASETSXML', type=str, nargs='?',
                         help='Datasets xml file (Full path)')
-    parser.add_argument('bpd', metavar='BIGPARENTDIRECTORY', type=str,
+    parser.add_argument('bpd', metavar='BIGPARENTDIRECTORY', type=str, nargs='?',
                         help='Path to Big Parent Directory')
-    parser.add_argument('datadir', metavar='DATADIRECTORY', type=str,
+    parser.add_argument('datadir', metavar='DATADIRECTORY', type=str, nargs='?',
                         help='Data Directory')
 
     # Optionals
     parser.add_argument('-v','--version', action='version', version=erddapds.__version__)
+    parser.add_argument('--type',
+                        metavar='TYPE',
+                        type=str,
+                        default=EDD_TYPE,
+                        help='Dataset type, EDDTableFrom...Files or EDDGridFromNcFiles')
     parser.add_argument('--infourl',
                         metavar='INFOURL',
                         type=str,
@@ -47,8 +59,43 @@ def get_arguments():
                         type=str,
                         default='NETCDF File',
                         help='title')
+    parser.add_argument('--manifest',
+                        metavar='MANIFEST',
+                        type=str,
+                        default=None,
+                        help='Manifest yaml file listing many datasets, see examples/manifest.yml')
+    parser.add_argument('--workers',
+                        metavar='WORKERS',
+                        type=int,
+                        default=None,
+                        help='Fragments generated at the same time in manifest mode')
+    parser.add_argument('--debounce',
+                        metavar='SECONDS',
+                        type=float,
+                        default=0.0,
+                        help='Coalesce the reload flags written within this window, '
+                             'the rest are written on exit')
+    parser.add_argument('--metrics-json',
+                        metavar='METRICSJSON',
+                        type=str,
+                        default=None,
+                        help='Append per-phase metrics as JSON lines to this file (- for stderr)')
+    parser.add_argument('--metrics-prom',
+                        metavar='METRICSPROM',
+                        type=str,
+                        default=None,
+                        help='Write a Prometheus text dump of the metrics to this file')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.manifest is None and args.datadir is None:
+        parser.error('DATASETID CONFIGFILE GDSLOC DATASETSXML BIGPARENTDIRECTORY DATADIRECTORY '
+                     'are required without --manifest')
+    if args.manifest is None:
+        try:
+            default_gds_args(args.type, '', '')
+        except ValueError as e:
+            parser.error(f'{e} of a --manifest entry')
+    return args
 
 
 def parse_yaml(yaml_file):
@@ -60,30 +107,38 @@ def parse_yaml(yaml_file):
     return ymldct
 
 
+def main_manifest(args):
+    # Positionals, if given, override the locations in the manifest
+    manifest = load_manifest(args.manifest)
+    with FlagWriter(args.bpd or manifest['bpd'], debounce=args.debounce), \
+            collect(args.metrics_json, args.metrics_prom):
+        with phase('create_dataset_cli', 'total') as m:
+            out = create_datasets(manifest, gds_loc=args.gdsloc, dsxml=args.datasetsxml,
+                                  bpd=args.bpd, workers=args.workers)
+            m.add(records=len(out))
+    for dsid, status in out.items():
+        print(f'{dsid}: {status}')
+
+
 def main():
     args = get_arguments()
     print(args)
+    if args.manifest is not None:
+        return main_manifest(args)
     ymldct = parse_yaml(args.configfile)
-    edd = erddapds.ERDDAPDATASET(args.dsid, **ymldct)
-    # TODO: Generalize this for other Type of EDD
-    tree = edd.generate_datasetxml('EDDTableFromNcCFFiles',
-                                   args.datadir,
+    with FlagWriter(args.bpd, debounce=args.debounce), \
+            collect(args.metrics_json, args.metrics_prom):
+        with phase('create_dataset_cli', 'total', args.dsid):
+            edd = erddapds.ERDDAPDATASET(args.dsid, **ymldct)
+            gds = default_gds_args(args.type, args.datadir,
                                    ymldct['details']['fileNameRegex'],
-                                   '',
-                                   '',
-                                   '',
-                                   '',
-                                   '',
-                                   '',
-                                   '',
-                                   'http://example.com',
-                                   'Some Organization',
-                                   'This is Some Data',
-                                   'NetCDF File',
-                                   gds_loc=args.gdsloc,
-                                   big_parent_directory=args.bpd)
-
-    edd.add_to_datasetsxml(dsxml=args.datasetsxml)
+                                   infourl=args.infourl, institution=args.institution,
+                                   summary=args.summary, title=args.title)
+            tree = edd.generate_datasetxml(*gds,
+                                           gds_loc=args.gdsloc,
+                                           big_parent_directory=args.bpd)
+
+            edd.add_to_datasetsxml(dsxml=args.datasetsxml)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,44 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import argparse
+import signal
+
+import yaml
+
+import erddapds
+from erddapds.daemon import IngestDaemon
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Watch incoming directories and update ERDDAP Datasets')
+    parser.add_argument('configfile', metavar='CONFIGFILE',
+                        help='Daemon config yaml file')
+
+    parser.add_argument('--version', action='version', version=erddapds.__version__)
+
+    return parser.parse_args()
+
+
+def parse_yaml(yaml_file):
+    with open(yaml_file, 'r') as yml:
+        ymldct = yaml.safe_load(yml.read())
+
+    assert 'datasets' in ymldct
+
+    return ymldct
+
+
+def main():
+    args = get_arguments()
+    print(args)
+    daemon = IngestDaemon.from_config(parse_yaml(args.configfile))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: daemon.stop())
+    daemon.run()
+
+
+if __name__ == '__main__':
+    main()
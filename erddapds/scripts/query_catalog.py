@@ -0,0 +1,70 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import argparse
+import re
+
+import erddapds
+from erddapds.catalog import Catalog
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Query, activate or deactivate the datasets of datasets.xml')
+    parser.add_argument('dsxml', metavar='DATASETSXML', type=str,
+                        help='datasets.xml location (full path)')
+
+    state = parser.add_mutually_exclusive_group()
+    state.add_argument('--active', dest='active', action='store_const', const=True,
+                       help='Active datasets only')
+    state.add_argument('--inactive', dest='active', action='store_const', const=False,
+                       help='Inactive datasets only')
+    parser.add_argument('--type', metavar='TYPE', type=str, help='Dataset type')
+    parser.add_argument('--file-dir', metavar='FILEDIR', type=str, help='fileDir')
+    parser.add_argument('--file-name-regex', metavar='FILENAMEREGEX', type=str,
+                        help='fileNameRegex')
+    parser.add_argument('--variable', metavar='VARIABLE', type=str, action='append',
+                        help='Destination name the dataset must have, can be repeated')
+    parser.add_argument('--attribute', metavar='NAME=VALUE', type=str, action='append',
+                        help='Global attribute value, can be repeated')
+    parser.add_argument('--regex', action='store_true',
+                        help='Match the type, fileDir, fileNameRegex and attribute values '
+                             'as regular expressions')
+
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--activate', action='store_true', help='Activate the datasets found')
+    action.add_argument('--deactivate', action='store_true', help='Deactivate the datasets found')
+    parser.add_argument('--bpd', metavar='BPD', type=str,
+                        help='Big Parent Directory, to flag the datasets (de)activated')
+    parser.add_argument('--version', action='version', version=erddapds.__version__)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+
+    def value(text):
+        return re.compile(text) if args.regex and text is not None else text
+
+    attributes = {}
+    for item in args.attribute or ():
+        name, _, text = item.partition('=')
+        attributes[name] = value(text)
+
+    catalog = Catalog(args.dsxml)
+    dsids = catalog.find(active=args.active, edd_type=value(args.type),
+                         fileDir=value(args.file_dir),
+                         fileNameRegex=value(args.file_name_regex),
+                         variables=args.variable, attributes=attributes)
+    if args.activate or args.deactivate:
+        for dsid, result in catalog.set_active(dsids, args.activate, bpd=args.bpd).items():
+            print(f'{dsid}: {result}')
+    else:
+        for dsid in dsids:
+            print(dsid)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,9 @@ import argparse
 import yaml
 
 import erddapds
+from erddapds.flags import FlagWriter
+from erddapds.metrics import (collect,
+                              phase)
 
 
 def get_arguments():
@@ -20,9 +23,64 @@ def get_arguments():
                         help='Datasets xml file (Full path)')
     parser.add_argument('datadir', metavar='DATADIRECTORY', type=str,
                         help='Data Directory')
-    parser.add_argument('newnc', metavar='NEWNCFILE', type=str,
-                        help='New NetCDF File to be added (full path)')
+    parser.add_argument('newnc', metavar='NEWNCFILE', type=str, nargs='+',
+                        help='New NetCDF File(s) or glob pattern(s) to be added (full path)')
 
+    parser.add_argument('--mode',
+                        metavar='MODE',
+                        type=str,
+                        choices=['merge', 'append', 'dedup'],
+                        default='merge',
+                        help='merge (full rewrite), append (write new time records in place) '
+                             'or dedup (append, resolving time overlaps by --overlap)')
+    parser.add_argument('--overlap',
+                        metavar='OVERLAP',
+                        type=str,
+                        choices=['no-conflicts', 'keep-newest', 'keep-oldest', 'reject'],
+                        default=None,
+                        help='How merge and dedup treat re-delivered time steps, by default '
+                             'merge fails on conflicting values and dedup keeps the newest')
+    parser.add_argument('--memory-budget',
+                        metavar='MEMORYBUDGET',
+                        type=str,
+                        default=None,
+                        help='Stream the merge in blocks of time steps fitting this budget, e.g. 2GB')
+    parser.add_argument('--layout',
+                        metavar='LAYOUT',
+                        type=str,
+                        choices=['single', 'partitioned', 'zarr'],
+                        default='single',
+                        help='single (one growing file), partitioned (time-bucketed files) '
+                             'or zarr (appends to a Zarr store)')
+    parser.add_argument('--partition',
+                        metavar='PARTITION',
+                        type=str,
+                        choices=['hourly', 'daily', 'monthly'],
+                        default='daily',
+                        help='Bucket size of the partitioned layout')
+    parser.add_argument('--encoding-profile',
+                        metavar='PROFILE',
+                        type=str,
+                        choices=['append-optimized', 'timeseries-read', 'spatial-read'],
+                        default=None,
+                        help='Compression and chunking of the written files, '
+                             'defaults to the encoding of the new file')
+    parser.add_argument('--debounce',
+                        metavar='SECONDS',
+                        type=float,
+                        default=0.0,
+                        help='Coalesce the reload flags written within this window, '
+                             'the rest are written on exit')
+    parser.add_argument('--metrics-json',
+                        metavar='METRICSJSON',
+                        type=str,
+                        default=None,
+                        help='Append per-phase metrics as JSON lines to this file (- for stderr)')
+    parser.add_argument('--metrics-prom',
+                        metavar='METRICSPROM',
+                        type=str,
+                        default=None,
+                        help='Write a Prometheus text dump of the metrics to this file')
     parser.add_argument('--version', action='version', version=erddapds.__version__)
 
     return parser.parse_args()
@@ -40,9 +98,18 @@ def parse_yaml(yaml_file):
 def main():
     args = get_arguments()
     print(args)
-    edd = erddapds.ERDDAPDATASET(args.dsid)
-    out = edd.update_dataset(args.datadir, args.newnc, args.bpd, args.datasetsxml)
-    print(out)
+    with FlagWriter(args.bpd, debounce=args.debounce), \
+            collect(args.metrics_json, args.metrics_prom):
+        with phase('update_dataset_cli', 'total', args.dsid) as m:
+            edd = erddapds.ERDDAPDATASET(args.dsid)
+            out = edd.update_dataset_batch(args.datadir, args.newnc, args.bpd, args.datasetsxml,
+                                           mode=args.mode, memory_budget=args.memory_budget,
+                                           layout=args.layout, partition=args.partition,
+                                           overlap=args.overlap,
+                                           encoding_profile=args.encoding_profile)
+            m.add(records=len(out))
+    for newnc, status in out.items():
+        print(f'{newnc}: {status}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,326 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import fcntl
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from erddapds.datasetsxml import (ENCODING,
+                                  ConflictError,
+                                  DatasetsXML,
+                                  _fragment_id,
+                                  _to_bytes)
+
+_ERRORS = {'KeyError': KeyError, 'ValueError': ValueError}
+
+
+class FileLock(object):
+    """Exclusive advisory lock on a file, shared by every process using it.
+
+    Args:
+        path (str): Lock file location, created if missing.
+        timeout (float): Seconds to wait for the lock, None to wait forever.
+        poll (float): Seconds between attempts while waiting.
+    """
+
+    def __init__(self, path, timeout=60.0, poll=0.05):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self.__fd = None
+
+    def __repr__(self):
+        return f'<FileLock: {self.path}>'
+
+    def acquire(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if deadline is not None and time.monotonic() > deadline:
+                    os.close(fd)
+                    raise TimeoutError(f'could not lock {self.path} in {self.timeout}s')
+                time.sleep(self.poll)
+        self.__fd = fd
+        return self
+
+    def release(self):
+        if self.__fd is not None:
+            fcntl.flock(self.__fd, fcntl.LOCK_UN)
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _encode_ops(ops):
+    return [[op] + [a.decode(ENCODING) if isinstance(a, bytes) else a for a in args]
+            for op, *args in ops]
+
+
+def _decode_ops(ops):
+    decoded = []
+    for op, *args in ops:
+        if op in ('insert', 'replace', 'put'):
+            args[-1] = args[-1].encode(ENCODING)
+        decoded.append(tuple([op] + args))
+    return decoded
+
+
+def _encode_error(error):
+    if error is None:
+        return None
+    return {'type': type(error).__name__,
+            'message': error.args[0] if error.args else str(error)}
+
+
+def _decode_error(error):
+    if error is None:
+        return None
+    return _ERRORS.get(error['type'], RuntimeError)(error['message'])
+
+
+class Transaction(object):
+    """Group of datasets.xml edits committed atomically and safely across processes.
+
+    Edits are queued with insert, put, replace, remove and toggle and written by
+    commit(), or on leaving the with block, in a single temp file and rename
+    while holding ``<dsxml>.lock``. The edits of a transaction are applied all
+    or none. If datasets.xml is changed by a writer not taking the lock while
+    the new file is being written, the commit is retried against the new file.
+
+    With group=True, a commit is first queued in ``<dsxml>.queue``. Whichever
+    process gets the lock applies every queued transaction in one write, so
+    concurrent workers share rewrites of datasets.xml instead of taking turns.
+
+    Args:
+        dsxml (str): datasets.xml location.
+        timeout (float): Seconds to wait for the lock.
+        retries (int): Commit attempts after a concurrent change.
+        group (bool): Commit together with the transactions of other processes.
+
+    Example:
+        >>> with Transaction('/erddap/content/datasets.xml') as txn:
+        ...     txn.insert(fragment)
+        ...     txn.toggle('old_dataset', False)
+    """
+
+    def __init__(self, dsxml, timeout=60.0, retries=3, group=True):
+        self.dsxml = os.path.abspath(dsxml)
+        self.timeout = timeout
+        self.retries = retries
+        self.group = group
+        self.__ops = []
+
+    def __repr__(self):
+        return f'<Transaction: {self.dsxml}, {len(self.__ops)} operation(s)>'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.__ops = []
+
+    @property
+    def lock_path(self):
+        return f'{self.dsxml}.lock'
+
+    @property
+    def queue_dir(self):
+        return f'{self.dsxml}.queue'
+
+    @property
+    def ops(self):
+        return list(self.__ops)
+
+    @property
+    def dsids(self):
+        """list: datasetIDs touched by the queued operations.
+        """
+        return [_fragment_id(args[0]) if op in ('insert', 'put') else args[0]
+                for op, *args in self.__ops]
+
+    def insert(self, fragment):
+        """Add a new dataset fragment before the closing erddapDatasets tag.
+        """
+        self.__ops.append(('insert', _to_bytes(fragment)))
+
+    def put(self, fragment):
+        """Insert fragment, or replace in place the dataset with its datasetID.
+
+        Nothing is written if that dataset already has the same content,
+        see datasetsxml.fragment_hash.
+        """
+        self.__ops.append(('put', _to_bytes(fragment)))
+
+    def replace(self, dsid, fragment):
+        """Replace the dataset dsid with fragment, keeping its datasetID.
+        """
+        self.__ops.append(('replace', dsid, _to_bytes(fragment)))
+
+    def remove(self, dsid):
+        """Remove the dataset dsid.
+        """
+        self.__ops.append(('remove', dsid))
+
+    def toggle(self, dsid, active):
+        """Set the active attribute of the dataset dsid.
+        """
+        if isinstance(active, bool):
+            active = 'true' if active else 'false'
+        self.__ops.append(('toggle', dsid, active))
+
+    def commit(self):
+        """Write the queued edits to datasets.xml, all or none.
+
+        Returns:
+            list: datasetIDs touched.
+
+        Raises:
+            KeyError: If an edited dataset is not in datasets.xml.
+            ValueError: If an inserted dataset is already in datasets.xml.
+            TimeoutError: If the lock could not be taken in time.
+        """
+        if not self.__ops:
+            return []
+        dsids = self.dsids
+        ops, self.__ops = self.__ops, []
+        error = self._commit([ops])[0]
+        if error is not None:
+            raise error
+        return dsids
+
+    def commit_each(self):
+        """Write the queued edits to datasets.xml in one write, each on its own.
+
+        Unlike commit(), an edit that fails does not hold back the others.
+
+        Returns:
+            OrderedDict: None, or the exception raised, for each datasetID touched.
+        """
+        if not self.__ops:
+            return OrderedDict()
+        dsids = self.dsids
+        ops, self.__ops = self.__ops, []
+        return OrderedDict(zip(dsids, self._commit([[op] for op in ops])))
+
+    def _commit(self, groups):
+        if self.group:
+            return self._commit_grouped(groups)
+        with FileLock(self.lock_path, timeout=self.timeout):
+            return self._apply(groups)
+
+    def _apply(self, transactions, written=None):
+        store = DatasetsXML(self.dsxml)
+        for attempt in range(self.retries + 1):
+            try:
+                return store.apply(transactions, written=written)
+            except ConflictError:
+                if attempt == self.retries:
+                    raise
+                time.sleep(0.05 * (attempt + 1))
+
+    def _commit_grouped(self, groups):
+        os.makedirs(self.queue_dir, exist_ok=True)
+        name = f'{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        queued = os.path.join(self.queue_dir, f'{name}.json')
+        with open(f'{queued}.part', 'w') as f:
+            json.dump([_encode_ops(ops) for ops in groups], f)
+        os.replace(f'{queued}.part', queued)
+
+        lock = FileLock(self.lock_path, timeout=self.timeout)
+        try:
+            lock.acquire()
+        except TimeoutError:
+            # Withdrawing and claiming both take the .json entry away, only one wins
+            try:
+                os.remove(queued)
+            except FileNotFoundError:
+                # Claimed by a drainer: it holds the lock until the results are written
+                lock = FileLock(self.lock_path, timeout=None).acquire()
+            else:
+                raise
+        try:
+            done = os.path.join(self.queue_dir, f'{name}.done')
+            if not os.path.exists(done):
+                try:
+                    self._drain(name)
+                except BaseException as e:
+                    if os.path.exists(queued):
+                        os.remove(queued)
+                    if not os.path.exists(done):
+                        raise
+                    # Failed after the edits were written: they still stand
+                    print(f'Queue of {self.dsxml} drained with error = {str(e)}')
+            with open(done, 'r') as f:
+                results = json.load(f)
+            os.remove(done)
+        finally:
+            lock.release()
+        return [_decode_error(error) for error in results]
+
+    def _drain(self, own):
+        """Apply every queued transaction in one write, holding the lock.
+        """
+        for entry in os.listdir(self.queue_dir):
+            path = os.path.join(self.queue_dir, entry)
+            if entry.endswith('.done') and entry[:-5] != own:
+                # Results nobody came back for, e.g. after a crash
+                if time.time() - os.path.getmtime(path) > 3600:
+                    os.remove(path)
+            elif entry.endswith('.claimed'):
+                # Claimed by a drainer that died before writing the results
+                os.replace(path, f'{path[:-8]}.json')
+
+        queued = []
+        batches = []
+        for entry in sorted(os.listdir(self.queue_dir)):
+            if not entry.endswith('.json'):
+                continue
+            path = os.path.join(self.queue_dir, entry)
+            claimed = f'{path[:-5]}.claimed'
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # Withdrawn by a writer that gave up waiting for the lock
+                continue
+            with open(claimed, 'r') as f:
+                groups = [_decode_ops(ops) for ops in json.load(f)]
+            queued.append((entry[:-5], len(groups)))
+            batches.extend(groups)
+
+        def written(results):
+            # Results go out as soon as datasets.xml is replaced, so that no
+            # transaction written is ever applied twice
+            for name, count in queued:
+                errors, results = results[:count], results[count:]
+                done = os.path.join(self.queue_dir, f'{name}.done')
+                with open(f'{done}.part', 'w') as f:
+                    json.dump([_encode_error(error) for error in errors], f)
+                os.replace(f'{done}.part', done)
+                os.remove(os.path.join(self.queue_dir, f'{name}.claimed'))
+
+        try:
+            self._apply(batches, written=written)
+        except BaseException:
+            # Not written: back in the queue for the next drainer
+            for name, _ in queued:
+                claimed = os.path.join(self.queue_dir, f'{name}.claimed')
+                if os.path.exists(claimed):
+                    os.replace(claimed, f'{claimed[:-8]}.json')
+            raise
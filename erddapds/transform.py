@@ -0,0 +1,322 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from lxml import etree
+
+from erddapds.utils import (IOOS_CATEGORIES,
+                            VAR_COLOUR_RANGES,
+                            replace_yx_with_lonlat)
+
+VAR_TAGS = ('axisVariable', 'dataVariable')
+
+DATA_VAR_NULL_ATTS = ('cell_measures', 'cell_methods', 'interval_operation',
+                      'interval_write', 'online_operation')
+
+
+class _Var(object):
+    __slots__ = ('el', 'source_names', 'dest_names', 'attrs', 'atts')
+
+    def __init__(self, el):
+        self.el = el
+        self.source_names = []
+        self.dest_names = []
+        self.attrs = None
+        self.atts = {}
+
+
+class _Index(object):
+    """Everything update_xml looks up, gathered in one traversal of a fragment.
+
+    Every element gets a sortable document order key so that elements
+    inserted while the plan runs keep "first in document order" lookups
+    exact, as ElementPath's find would see them.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.file_name_regex = None
+        self.attrs = None
+        self.attrs_last = None
+        self.atts = {}
+        self.keys = {}
+        self.vars = {tag: [] for tag in VAR_TAGS}
+        self.var_attrs = {}
+        self.__appended = 0
+        self.__inserted = 0
+
+        by_el = {}
+        for i, el in enumerate(root.iter(tag=etree.Element)):
+            self.keys[el] = (i,)
+            if el is root:
+                continue
+            tag = el.tag
+            parent = el.getparent()
+            if tag == 'att':
+                name = el.get('name')
+                self.atts.setdefault(name, []).append(el)
+                if parent is self.attrs:
+                    self.attrs_last = (i,)
+                var = by_el.get(parent.getparent())
+                if var is not None and parent is var.attrs:
+                    var.atts.setdefault(name, el)
+            elif tag in VAR_TAGS:
+                by_el[el] = _Var(el)
+                self.vars[tag].append(by_el[el])
+            elif tag == 'fileNameRegex':
+                if self.file_name_regex is None:
+                    self.file_name_regex = el
+            elif tag == 'addAttributes' and parent is root and self.attrs is None:
+                self.attrs = el
+                self.attrs_last = (i,)
+            elif parent in by_el:
+                var = by_el[parent]
+                if tag == 'sourceName':
+                    var.source_names.append(el)
+                elif tag == 'destinationName':
+                    var.dest_names.append(el)
+                elif tag == 'addAttributes' and var.attrs is None:
+                    var.attrs = el
+                    self.var_attrs[el] = var
+
+    def find_att(self, name):
+        els = self.atts.get(name)
+        return els[0] if els else None
+
+    def _add_att(self, el, key):
+        self.keys[el] = key
+        els = self.atts.setdefault(el.get('name'), [])
+        els.append(el)
+        els.sort(key=self.keys.__getitem__)
+
+    def insert_after(self, ref, name, text):
+        e = etree.Element('att', name=name)
+        e.text = text
+        ref.addnext(e)
+        self.__inserted += 1
+        self._add_att(e, self.keys[ref] + (-self.__inserted,))
+        var = self.var_attrs.get(ref.getparent())
+        if var is not None:
+            first = var.atts.get(name)
+            if first is None or self.keys[e] < self.keys[first]:
+                var.atts[name] = e
+        return e
+
+    def append_global(self, name, text):
+        e = etree.SubElement(self.attrs, 'att', name=name)
+        e.text = text
+        self.__appended += 1
+        self._add_att(e, self.attrs_last + (self.__appended,))
+        return e
+
+
+class TransformPlan(object):
+    """Precompiled form of utils.update_xml.
+
+    The metadata, details and variables config is interpreted once.
+    apply() then indexes the att and variable nodes of a fragment in a single
+    traversal and makes every edit from that index, producing exactly the
+    same XML as utils.update_xml.
+
+    Args:
+        metadata (dict): Global attributes, see core.METADATA.
+        details (dict): Dataset details (title, summary, fileNameRegex, type ...).
+        dataset_vars (dict): Variable renames, source name -> {'destinationName': ...}.
+        colour_ranges (dict): colorBar ranges per destination name, defaults to
+            utils.VAR_COLOUR_RANGES, see colorbar.compute_ranges.
+    """
+
+    def __init__(self, metadata, details, dataset_vars, colour_ranges=None):
+        self.details = details
+        self.dataset_vars = dataset_vars or {}
+        self.title = details['title']
+        self.summary = f'{self.title}\n\n{details["summary"]}'
+        self.has_keywords = 'keywords' in details
+        self.keywords = details.get('keywords')
+        self.tide_gauge = details['type'] == 'tide gauge'
+
+        self.metadata = []
+        for att, info in metadata.items():
+            text = info['text']
+            # Erddap doesn't like cdm_data_type Station
+            # Change to TimeSeries
+            if att == 'cdm_data_type' and text == 'Station':
+                text = 'TimeSeries'
+            self.metadata.append((att, text, 'after' in info, info.get('after')))
+
+        self.renames = {k: v['destinationName'] for k, v in self.dataset_vars.items()}
+        self.colour_ranges = VAR_COLOUR_RANGES if colour_ranges is None else colour_ranges
+
+    def __repr__(self):
+        return f'<TransformPlan: {self.title}>'
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a plan from a config dict with details, metadata and variables
+        sections, as in examples/config.yml.
+        """
+        metadata = config.get('metadata')
+        if metadata is None:
+            # Same default as ERDDAPDATASET, imported here to avoid a cycle
+            from erddapds.core import METADATA as metadata
+        return cls(metadata, config['details'], config.get('variables'))
+
+    def apply_many(self, fragments, processes=None, chunksize=8):
+        """Apply the plan to many fragments, using a process pool.
+
+        Args:
+            fragments (list): (fragment, datasetID) or (fragment, datasetID,
+                fileNameRegex) tuples, fragment being an element or bytes.
+            processes (int): Pool size, defaults to the number of cores.
+                With 1 the fragments are transformed in this process.
+            chunksize (int): Fragments sent to a worker at a time.
+
+        Returns:
+            list: Transformed fragments as lxml elements, in order.
+        """
+        jobs = []
+        for item in fragments:
+            fragment, dsid = item[0], item[1]
+            regex = item[2] if len(item) > 2 else None
+            if isinstance(fragment, etree._Element):
+                fragment = etree.tostring(fragment)
+            jobs.append((fragment, dsid, regex))
+
+        if processes == 1 or len(jobs) < 2:
+            results = [_apply_bytes(self, *job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                results = list(pool.map(partial(_apply_bytes, self), *zip(*jobs),
+                                        chunksize=chunksize))
+        parser = etree.XMLParser(remove_blank_text=True)
+        return [etree.fromstring(r, parser) for r in results]
+
+    def apply(self, root, datasetID, fileNameRegex=None, colour_ranges=None):
+        """Apply the plan to a dataset fragment in place.
+
+        Args:
+            root (lxml.etree._Element): Dataset fragment.
+            datasetID (str): Dataset ID.
+            fileNameRegex (str): Overrides details['fileNameRegex'].
+            colour_ranges (dict): Overrides the colorBar ranges of the plan.
+
+        Returns:
+            lxml.etree._Element: root
+        """
+        idx = _Index(root)
+        if colour_ranges is None:
+            colour_ranges = self.colour_ranges
+
+        root.attrib['datasetID'] = datasetID
+        idx.file_name_regex.text = fileNameRegex or self.details['fileNameRegex']
+
+        if self.has_keywords:
+            _required(idx, 'keywords').text = self.keywords
+        _required(idx, 'summary').text = self.summary
+        _required(idx, 'title').text = self.title
+
+        for att, text, has_after, after in self.metadata:
+            if has_after:
+                ref = idx.find_att(str(after))
+                if ref is None:
+                    raise AttributeError(f'{after} attribute element not found')
+                idx.insert_after(ref, att, text)
+            else:
+                el = idx.find_att(att)
+                if el is not None:
+                    el.text = text
+                else:
+                    idx.append_global(att, text)
+
+        etree.SubElement(idx.attrs, 'att', name='NCO').text = 'null'
+        if 'Bathymetry' not in datasetID:
+            etree.SubElement(idx.attrs, 'att', name='history').text = 'null'
+            etree.SubElement(idx.attrs, 'att', name='name').text = 'null'
+
+        axes = idx.vars['axisVariable']
+        for var in axes:
+            for source_name in var.source_names:
+                # Since v1.80 the ERDDAP GenerateDatasetsXml.sh tool changes variables named y and x
+                # into latitude and longitude variables. But our y and x are grid indices, so we fix them.
+                if source_name.text in ('y', 'x'):
+                    var.dest_names[0].text = f'grid{source_name.text.upper()}'
+                    _var_att(var, 'long_name').text = source_name.text.upper()
+                    for att_name in ('source_name', 'standard_name', 'units'):
+                        att = _var_att(var, att_name)
+                        att.getparent().remove(att)
+                        var.atts.pop(att_name)
+
+        for var in axes:
+            for dest_name in var.dest_names:
+                attrs = var.attrs
+                etree.SubElement(attrs, 'att', name='coverage_content_type').text = 'modelResult'
+
+                if dest_name.text == 'time':
+                    etree.SubElement(attrs, 'att', name='comment').text = (
+                        'time values are UTC at the centre of the intervals over which the calculated model results are averaged')
+
+                if dest_name.text in ('x', 'y', 'z'):
+                    dest_name.text = f'grid{dest_name.text.upper()}'
+
+                if dest_name.text in IOOS_CATEGORIES:
+                    etree.SubElement(attrs, 'att', name='ioos_category').text = IOOS_CATEGORIES[dest_name.text]
+
+        if self.tide_gauge:
+            replace_yx_with_lonlat(root)
+
+        for var in idx.vars['dataVariable']:
+            for dest_name in var.dest_names:
+                if dest_name.text in self.renames:
+                    dest_name.text = self.renames[dest_name.text]
+
+                attrs = var.attrs
+                colour_range = colour_ranges.get(dest_name.text)
+                if colour_range is not None:
+                    for att_name in ('colorBarMinimum', 'colorBarMaximum'):
+                        cb_att = var.atts.get(att_name)
+                        if cb_att is not None:
+                            cb_att.text = colour_range[att_name]
+                        else:
+                            etree.SubElement(attrs, 'att', name=att_name, type='double').text = (
+                                colour_range[att_name])
+
+                etree.SubElement(attrs, 'att', name='coverage_content_type').text = 'modelResult'
+                for att_name in DATA_VAR_NULL_ATTS:
+                    etree.SubElement(attrs, 'att', name=att_name).text = 'null'
+
+                if dest_name.text in IOOS_CATEGORIES:
+                    etree.SubElement(attrs, 'att', name='ioos_category').text = IOOS_CATEGORIES[dest_name.text]
+
+        return root
+
+
+def _required(idx, name):
+    e = idx.find_att(name)
+    if e is None:
+        raise ValueError('{} attribute element not found'.format(name))
+    return e
+
+
+def _var_att(var, name):
+    e = var.atts.get(name)
+    if e is None:
+        raise ValueError('{} attribute element not found'.format(name))
+    return e
+
+
+def _apply_bytes(plan, fragment, datasetID, fileNameRegex=None):
+    parser = etree.XMLParser(remove_blank_text=True)
+    root = etree.fromstring(fragment.strip(), parser)
+    plan.apply(root, datasetID, fileNameRegex=fileNameRegex)
+    return etree.tostring(root)
+
+
+def update_xml(root, datasetID, metadata, details, dataset_vars, colour_ranges=None):
+    """Drop-in replacement of utils.update_xml running a TransformPlan.
+    """
+    return TransformPlan(metadata, details, dataset_vars,
+                         colour_ranges=colour_ranges).apply(root, datasetID)
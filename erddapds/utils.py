@@ -2,12 +2,11 @@ from __future__ import (absolute_import,
                         division,
                         print_function,
                         unicode_literals)
-import os
-import subprocess
-import sys
-
 from lxml import etree
 
+from erddapds.flags import (active_writer,
+                            write_flag)
+
 
 VAR_COLOUR_RANGES = {
     'salinity': {'colorBarMinimum': '0.0', 'colorBarMaximum': '34.0'},
@@ -93,7 +92,10 @@ def replace_yx_with_lonlat(root):
             axis.getparent().replace(axis, new_axis)
 
 
-def update_xml(root, datasetID, metadata, details, dataset_vars):
+def update_xml(root, datasetID, metadata, details, dataset_vars, colour_ranges=None):
+    # colour_ranges, e.g. from colorbar.compute_ranges, replaces the static table
+    if colour_ranges is None:
+        colour_ranges = VAR_COLOUR_RANGES
     root.attrib['datasetID'] = datasetID
     root.find('.//fileNameRegex').text = details['fileNameRegex']
 
@@ -168,15 +170,15 @@ def update_xml(root, datasetID, metadata, details, dataset_vars):
         if var_name.text in dataset_vars:
             var_name.text = dataset_vars[var_name.text]['destinationName']
 
-        if var_name.text in VAR_COLOUR_RANGES:
+        if var_name.text in colour_ranges:
             for att_name in ('colorBarMinimum', 'colorBarMaximum'):
                 cb_att = var_name.getparent().find(f'addAttributes/att[@name="{att_name}"]')
                 if cb_att is not None:
-                    cb_att.text = VAR_COLOUR_RANGES[var_name.text][att_name]
+                    cb_att.text = colour_ranges[var_name.text][att_name]
                 else:
                     attrs = var_name.getparent().find('addAttributes')
                     etree.SubElement(attrs, 'att', name=att_name, type='double').text = (
-                        VAR_COLOUR_RANGES[var_name.text][att_name])
+                        colour_ranges[var_name.text][att_name])
 
         attrs = var_name.getparent().find('addAttributes')
         etree.SubElement(attrs, 'att', name='coverage_content_type').text = 'modelResult'
@@ -194,6 +196,9 @@ def update_xml(root, datasetID, metadata, details, dataset_vars):
 def update_datasetsxml(bpd, dsid):
     """Function to update the dataset after changes to datasets.xml
 
+    The reload flag is written in process. Inside a ``with FlagWriter(bpd):``
+    block it is only queued, and written once when the block exits.
+
     Args:
         bpd (str): Big Parent Directory location.
         dsid (str): Dataset ID
@@ -201,15 +206,17 @@ def update_datasetsxml(bpd, dsid):
     Returns:
         int: Return integer
     """
-    cmd = ['touch', os.path.join(os.path.abspath(bpd), 'flag', dsid)]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    out, err = p.communicate()
-
-    if p.returncode == 0:
-        print(f'Dataset sucessfully updated.')
-        return p.returncode
-    else:
+    writer = active_writer(bpd)
+    if writer is not None:
+        writer.flag(dsid)
+        return 0
+
+    try:
+        write_flag(bpd, dsid)
+    except OSError as e:
         print(f'Dataset update failed, '
-              f'exit-code={int(p.returncode)} error = {str(err)}')
-        return p.returncode
+              f'exit-code={int(e.errno or 1)} error = {str(e)}')
+        return int(e.errno or 1)
+
+    print(f'Dataset sucessfully updated.')
+    return 0
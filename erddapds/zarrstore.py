@@ -0,0 +1,201 @@
+from __future__ import (absolute_import,
+                        division,
+                        print_function,
+                        unicode_literals)
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from netCDF4 import Dataset
+import xarray as xr
+
+from erddapds.ncutils import parse_size
+
+# Encoding carried over from NetCDF, the storage settings (compression,
+# chunking ...) having no meaning in a Zarr store
+_ZARR_ENCODING = ('dtype', '_FillValue', 'scale_factor', 'add_offset', 'units', 'calendar')
+# Attributes Zarr keeps for itself
+_RESERVED_ATTS = ('_ARRAY_DIMENSIONS', '_FillValue')
+
+
+def zarr_path(datadir, fname):
+    """Path of the Zarr store of the dataset file fname, e.g. mooring.zarr.
+    """
+    stem, _ = os.path.splitext(os.path.basename(fname))
+    return os.path.join(datadir, f'{stem}.zarr')
+
+
+def time_chunk(ncfiles, chunk_bytes='8MB', dim='time'):
+    """Chunk length along dim keeping the chunks of every variable within chunk_bytes.
+
+    An append rewrites the last, partly filled chunk of each variable, so
+    chunks are kept a few MB rather than sized to the memory available.
+    """
+    record = 1
+    for ncfile in ncfiles:
+        with Dataset(ncfile, 'r') as nc:
+            for var in nc.variables.values():
+                if dim in var.dimensions:
+                    size = getattr(var.dtype, 'itemsize', 8)
+                    for d in var.dimensions:
+                        if d != dim:
+                            size *= len(nc.dimensions[d])
+                    record = max(record, size)
+    return max(1, parse_size(chunk_bytes) // record)
+
+
+def _zarr_encoding(ds, dim, chunk):
+    encoding = {}
+    for name, var in ds.variables.items():
+        enc = {k: v for k, v in var.encoding.items() if k in _ZARR_ENCODING}
+        if dim in var.dims:
+            enc['chunks'] = tuple(chunk if d == dim else size
+                                  for d, size in zip(var.dims, var.shape))
+        encoding[name] = enc
+    return encoding
+
+
+def netcdf_to_zarr(ncfiles, store, dim='time', chunk_bytes='8MB', overwrite=False):
+    """Convert NetCDF files into one Zarr store, once, before switching to Zarr appends.
+
+    Files are concatenated along dim in the order given. Attributes and
+    encodings (dtype, _FillValue, scale_factor ...) are carried over as in
+    update_dataset, the later file winning. The files are streamed through
+    dask one chunk at a time, chunks being sized by time_chunk. The store is built next to its final location and only
+    renamed into place once complete.
+
+    Args:
+        ncfiles (str or list): NetCDF file(s).
+        store (str): Zarr store directory.
+        dim (str): Record dimension, appended along later.
+        chunk_bytes (int or str): Largest chunk of a variable, see time_chunk.
+        overwrite (bool): Replace an existing store.
+
+    Returns:
+        str: store
+    """
+    if isinstance(ncfiles, str):
+        ncfiles = [ncfiles]
+    if os.path.exists(store) and not overwrite:
+        raise FileExistsError(f'{store} already exists')
+
+    chunk = time_chunk(ncfiles, chunk_bytes, dim=dim)
+    datasets = [xr.open_dataset(f, decode_cf=False, chunks={dim: chunk}) for f in ncfiles]
+    try:
+        if len(datasets) > 1:
+            ds = xr.concat(datasets, dim=dim, data_vars='minimal', coords='minimal',
+                           compat='override')
+        else:
+            ds = datasets[0]
+        # Dask chunks must line up with the Zarr chunks across file boundaries
+        ds = ds.chunk({dim: chunk})
+        for k, v in datasets[-1].variables.items():
+            ds[k].encoding = v.encoding
+            ds[k].attrs = v.attrs
+        ds.attrs = datasets[-1].attrs
+
+        parent = os.path.dirname(os.path.abspath(store))
+        tmp = tempfile.mkdtemp(dir=parent, suffix='.zarr.tmp')
+        try:
+            # Zarr format 2, the one ERDDAP reads
+            ds.to_zarr(tmp, mode='w', encoding=_zarr_encoding(ds, dim, chunk),
+                       consolidated=True, zarr_format=2,
+                       compute=False).compute(scheduler='synchronous')
+            if os.path.exists(store):
+                shutil.rmtree(store)
+            os.replace(tmp, store)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+    finally:
+        for d in datasets:
+            d.close()
+    return store
+
+
+def _check_zarr_schema(dst, src, dim):
+    for name, var in src.variables.items():
+        if name not in dst.variables:
+            raise ValueError(f'{name} variable not found in existing store')
+        old = dst.variables[name]
+        if old.dims != var.dims:
+            raise ValueError(f'{name} dimensions mismatch: {old.dims} != {var.dims}')
+        if old.dtype != var.dtype:
+            raise ValueError(f'{name} dtype mismatch: {old.dtype} != {var.dtype}')
+        for d, size in zip(var.dims, var.shape):
+            if d != dim and dst.sizes[d] != size:
+                raise ValueError(f'{d} dimension size mismatch: {dst.sizes[d]} != {size}')
+    for name, old in dst.variables.items():
+        if dim in old.dims and name not in src.variables:
+            raise ValueError(f'{name} variable not found in new file')
+
+
+def append_zarr(store, newFile, dim='time'):
+    """Append the records of newFile onto the Zarr store along dim.
+
+    Only the chunks holding new records are written; variables without dim
+    are left alone. Values are packed with the store's own scale_factor,
+    add_offset and _FillValue. Variable and global attributes are carried over from
+    newFile, as update_dataset does. Records already in the store, by time
+    value, are skipped; records earlier than the last one in the store are
+    rejected, the store being kept in time order.
+
+    Args:
+        store (str): Existing Zarr store, see netcdf_to_zarr.
+        newFile (str): NetCDF file holding the new records.
+        dim (str): Record dimension.
+
+    Returns:
+        int: Number of records appended.
+    """
+    import zarr
+
+    # Both sides decoded (masked and scaled, times left raw) so that the
+    # packing of the store is applied exactly once, when writing
+    with xr.open_zarr(store, decode_times=False) as dst, \
+            xr.open_dataset(newFile, decode_times=False) as src:
+        _check_zarr_schema(dst, src, dim)
+        old_times = dst[dim].values
+        new_times = src[dim].values
+        last = old_times[-1] if len(old_times) else None
+
+        keep = np.ones(len(new_times), dtype=bool)
+        if last is not None:
+            keep = ~np.isin(new_times, old_times)
+            if (new_times[keep] <= last).any():
+                raise ValueError(f'{newFile} has records earlier than the last one in {store}')
+        new = src.isel({dim: np.flatnonzero(keep)})
+
+        if new.sizes[dim]:
+            new = new.drop_vars([k for k, v in new.variables.items() if dim not in v.dims])
+            for var in new.variables.values():
+                # Encoding (dtype, scale_factor, _FillValue ...) is taken from
+                # the store, attributes are updated below
+                var.encoding = {}
+                var.attrs = {}
+            new.attrs = {}
+            new.to_zarr(store, mode='a', append_dim=dim, consolidated=True)
+
+        group = zarr.open_group(store, mode='r+')
+        for name, var in src.variables.items():
+            attrs = group[name].attrs
+            changed = {k: v for k, v in var.attrs.items()
+                       if k not in _RESERVED_ATTS and attrs.get(k) != _jsonable(v)}
+            if changed:
+                attrs.update({k: _jsonable(v) for k, v in changed.items()})
+        changed = {k: _jsonable(v) for k, v in src.attrs.items()
+                   if group.attrs.get(k) != _jsonable(v)}
+        if changed:
+            group.attrs.update(changed)
+        zarr.consolidate_metadata(store)
+        return int(new.sizes[dim])
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
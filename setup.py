@@ -46,7 +46,11 @@ setup(
     install_requires=install_requires,
     entry_points=dict(console_scripts=[
             'create_dataset = erddapds.scripts.create_dataset:main',
-            'update_dataset = erddapds.scripts.update_dataset:main'
+            'update_dataset = erddapds.scripts.update_dataset:main',
+            'ingest_daemon = erddapds.scripts.ingest_daemon:main',
+            'compact_dataset = erddapds.scripts.compact_dataset:main',
+            'convert_to_zarr = erddapds.scripts.convert_to_zarr:main',
+            'query_catalog = erddapds.scripts.query_catalog:main'
             ]
     )
 )
\ No newline at end of file
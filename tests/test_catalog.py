@@ -0,0 +1,25 @@
+import re
+
+from erddapds.catalog import Catalog
+
+DATASETS = '''<?xml version="1.0" encoding="ISO-8859-1" ?>
+<erddapDatasets>
+<dataset type="EDDTableFromNcCFFiles" datasetID="mooring" active="true">
+    <fileDir>/data/mooring/</fileDir>
+    <fileNameRegex>.*\\.nc</fileNameRegex>
+</dataset>
+<dataset type="EDDGridFromNcFiles" datasetID="model" active="false">
+    <fileDir>/data/model/</fileDir>
+    <fileNameRegex>.*\\.nc</fileNameRegex>
+</dataset>
+</erddapDatasets>
+'''
+
+
+def test_find_by_edd_type(tmp_path):
+    dsxml = tmp_path / 'datasets.xml'
+    dsxml.write_text(DATASETS, encoding='ISO-8859-1')
+    catalog = Catalog(str(dsxml))
+    assert catalog.find(edd_type='EDDGridFromNcFiles') == ['model']
+    assert catalog.find(edd_type=re.compile('^EDD'), active=True) == ['mooring']
+    assert catalog.get('model')['type'] == 'EDDGridFromNcFiles'
@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+from erddapds import colorbar
+from erddapds.colorbar import (compute_ranges,
+                               range_variables,
+                               variable_stats)
+
+
+def write_file(path, values, fill=-999.):
+    values = np.asarray(values, dtype='f4')
+    with Dataset(path, 'w') as nc:
+        nc.createDimension('time', None)
+        nc.createDimension('depth', values.shape[1])
+        nc.createVariable('time', 'f8', ('time',))[:] = np.arange(values.shape[0])
+        var = nc.createVariable('temperature', 'f4', ('time', 'depth'), fill_value=fill)
+        var.set_auto_maskandscale(False)
+        var[:] = values
+    return str(path)
+
+
+def test_fill_values_are_left_out(tmp_path):
+    values = np.array([[1, -999], [np.nan, 4], [-999, 2.5]])
+    ncfile = write_file(tmp_path / 'a.nc', values)
+    assert range_variables(ncfile) == ['temperature']
+    # Blocks of one row
+    stats = variable_stats(ncfile, 'temperature', block_bytes=8)
+    assert stats.count == 3
+    assert stats.range() == (1, 4)
+    assert compute_ranges([ncfile], workers=1) == {
+        'temperature': {'colorBarMinimum': '1', 'colorBarMaximum': '4'}}
+
+
+def test_percentile_bounds(tmp_path):
+    values = np.arange(1000, dtype='f4').reshape(100, 10)
+    values[0, 0] = -1e6
+    values[-1, -1] = 1e6
+    ncfile = write_file(tmp_path / 'a.nc', values)
+    assert compute_ranges([ncfile], workers=1)['temperature'] == \
+        {'colorBarMinimum': '-1e+06', 'colorBarMaximum': '1e+06'}
+    ranges = compute_ranges([ncfile], percentiles=(1, 99), workers=1)['temperature']
+    low, high = np.percentile(values, (1, 99))
+    assert ranges == {'colorBarMinimum': f'{low:.6g}', 'colorBarMaximum': f'{high:.6g}'}
+
+    # Sampled once there are more values than sample_size
+    stats = variable_stats(ncfile, 'temperature', sample_size=200)
+    assert stats.count == 1000 and len(stats.values) == 200
+    low, high = stats.range((1, 99))
+    assert -1e6 <= low < 100 and 900 < high <= 1e6
+
+
+def test_range_cache_follows_file_changes(tmp_path, monkeypatch):
+    ncfile = write_file(tmp_path / 'a.nc', [[0, 1], [2, 3]])
+    cache_dir = str(tmp_path / 'cache')
+    assert compute_ranges([ncfile], cache_dir=cache_dir, workers=1)['temperature'] == \
+        {'colorBarMinimum': '0', 'colorBarMaximum': '3'}
+    assert len(os.listdir(cache_dir)) == 1
+
+    scanned = []
+
+    def counting(*args):
+        scanned.append(args[:2])
+        return variable_stats(*args)
+    monkeypatch.setattr(colorbar, 'variable_stats', counting)
+    compute_ranges([ncfile], cache_dir=cache_dir, workers=1)
+    assert scanned == []
+
+    write_file(tmp_path / 'a.nc', [[5, 6], [7, 8]])
+    st = os.stat(ncfile)
+    os.utime(ncfile, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert compute_ranges([ncfile], cache_dir=cache_dir, workers=1)['temperature'] == \
+        {'colorBarMinimum': '5', 'colorBarMaximum': '8'}
+    assert scanned == [(ncfile, 'temperature')]
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_empty_variable_has_no_range(tmp_path):
+    ncfile = write_file(tmp_path / 'a.nc', [[-999, -999]])
+    assert variable_stats(ncfile, 'temperature').range() is None
+    assert compute_ranges([ncfile], workers=1) == {}
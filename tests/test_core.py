@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+from erddapds.core import ERDDAPDATASET
+
+
+def deliver(path, hours, values):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    xr.Dataset(
+        {'temperature': ('time', np.array(values, dtype='f4'))},
+        coords={'time': ('time', np.array(hours, dtype='f8') * 3600,
+                         {'units': 'seconds since 2024-01-01'})},
+    ).to_netcdf(path, unlimited_dims='time')
+    return str(path)
+
+
+def test_update_dataset_batch_mixed_outcomes(tmp_path):
+    datadir, bpd = tmp_path / 'data', tmp_path / 'bpd'
+    os.makedirs(bpd / 'flag')
+    deliver(datadir / 'a.nc', [0], [0])
+    deliver(datadir / 'b.nc', [0], [0])
+
+    newFiles = [
+        deliver(tmp_path / 'n1' / 'a.nc', [1], [1]),
+        # Same dataset file as n1: merged in the same pass
+        deliver(tmp_path / 'n2' / 'a.nc', [2], [2]),
+        # Conflicts with the record already in b.nc
+        deliver(tmp_path / 'n3' / 'b.nc', [0, 1], [5, 1]),
+        # No dataset file to merge into
+        deliver(tmp_path / 'n4' / 'c.nc', [0], [0]),
+        str(tmp_path / 'n5' / 'a.nc'),
+    ]
+    results = ERDDAPDATASET('mooring').update_dataset_batch(str(datadir), newFiles, str(bpd), '')
+
+    assert list(results) == newFiles
+    statuses = list(results.values())
+    assert statuses[:2] == ['NetCDF Successfully Updated.'] * 2
+    assert isinstance(statuses[2], ValueError)
+    assert isinstance(statuses[3], Exception)
+    assert isinstance(statuses[4], FileNotFoundError)
+
+    # Only the ingested files are removed, the others stay for a retry
+    assert [os.path.exists(f) for f in newFiles[:4]] == [False, False, True, True]
+    assert os.listdir(bpd / 'flag') == ['mooring']
+    with xr.open_dataset(datadir / 'a.nc', decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['temperature'].values, [0, 1, 2])
+    with xr.open_dataset(datadir / 'b.nc', decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['temperature'].values, [0])
+    assert sorted(os.listdir(datadir)) == ['a.nc', 'b.nc']
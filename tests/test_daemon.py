@@ -0,0 +1,71 @@
+import os
+import time
+
+import numpy as np
+import xarray as xr
+
+from erddapds.daemon import (FAILED,
+                             STAGING,
+                             IngestDaemon,
+                             WatchedDataset)
+
+
+def deliver(path, hours, values):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    xr.Dataset(
+        {'temperature': ('time', np.array(values, dtype='f4'))},
+        coords={'time': ('time', np.array(hours, dtype='f8') * 3600,
+                         {'units': 'seconds since 2024-01-01'})},
+    ).to_netcdf(path, unlimited_dims='time')
+    return str(path)
+
+
+def setup(tmp_path, **kwargs):
+    incoming, datadir, bpd = tmp_path / 'incoming', tmp_path / 'data', tmp_path / 'bpd'
+    for d in (incoming, datadir, bpd / 'flag'):
+        os.makedirs(d)
+    deliver(datadir / 'mooring.nc', [0], [0])
+    ds = WatchedDataset('mooring', str(incoming), str(datadir), **kwargs)
+    return ds, IngestDaemon([ds], str(bpd), '', workers=1, max_batch=10)
+
+
+def test_settled_keeps_the_files_beyond_the_limit(tmp_path):
+    ds, _ = setup(tmp_path)
+    for i in range(3):
+        path = deliver(tmp_path / 'incoming' / f'{i}.nc', [i], [i])
+        os.utime(path, (1000 + i, 1000 + i))
+    assert ds.settled(2) == []
+    assert [os.path.basename(p) for p in ds.settled(2)] == ['0.nc', '1.nc']
+    assert [os.path.basename(p) for p in ds.settled(2)] == ['2.nc']
+
+
+def test_failed_files_are_retried_after_a_delay(tmp_path):
+    ds, daemon = setup(tmp_path, retry_delay=0.5, max_attempts=2)
+    deliver(tmp_path / 'incoming' / 'mooring.nc', [1, 2], [1, 2])
+    (tmp_path / 'incoming' / 'broken.nc').write_bytes(b'not a netcdf file')
+
+    assert daemon.scan_once() == {}
+    results = daemon.scan_once()['mooring'].result()
+    ingested = {os.path.basename(p): isinstance(status, str) for p, status in results.items()}
+    assert ingested == {'mooring.nc': True, 'broken.nc': False}
+    assert os.listdir(tmp_path / 'data') == ['mooring.nc']
+
+    # Not due yet
+    assert daemon.scan_once() == {}
+    time.sleep(0.6)
+    results = daemon.scan_once()['mooring'].result()
+    assert [os.path.basename(p) for p in results] == ['broken.nc']
+    assert os.listdir(tmp_path / 'incoming' / STAGING) == []
+    failed = tmp_path / 'incoming' / FAILED
+    assert [os.listdir(failed / d) for d in os.listdir(failed)] == [['broken.nc']]
+    assert daemon.scan_once() == {}
+
+
+def test_files_left_in_staging_are_ingested_first(tmp_path):
+    ds, daemon = setup(tmp_path)
+    deliver(tmp_path / 'incoming' / STAGING / 'a1b2' / 'mooring.nc', [1, 2], [1, 2])
+    results = daemon.scan_once()['mooring'].result()
+    assert list(results.values()) == ['NetCDF Successfully Updated.']
+    assert os.listdir(tmp_path / 'incoming' / STAGING) == []
+    with xr.open_dataset(tmp_path / 'data' / 'mooring.nc', decode_times=False) as nc:
+        np.testing.assert_array_equal(nc['temperature'].values, [0, 1, 2])
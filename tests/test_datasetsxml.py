@@ -0,0 +1,216 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+from lxml import etree
+
+from erddapds.datasetsxml import DatasetsXML
+from erddapds.transaction import (FileLock,
+                                  Transaction)
+
+HEADER = '''<?xml version="1.0" encoding="ISO-8859-1" ?>
+<erddapDatasets>
+<!-- Some settings ERDDAP reads before the datasets -->
+<convertToPublicSourceUrl />
+'''
+
+DATASET = '''<dataset type="EDDTableFromNcCFFiles" datasetID="{dsid}" active="{active}">
+    <fileDir>/data/{dsid}/</fileDir>
+    <addAttributes>
+        <att name="title">{title}</att>
+    </addAttributes>
+</dataset>
+'''
+
+
+def dataset(dsid, title='Dataset', active='true'):
+    return DATASET.format(dsid=dsid, title=title, active=active)
+
+
+@pytest.fixture
+def dsxml(tmp_path):
+    path = tmp_path / 'datasets.xml'
+    body = ''.join(dataset(f'ds_{i}', title=f'Dataset {i}') for i in range(5))
+    path.write_text(HEADER + body + '</erddapDatasets>\n', encoding='ISO-8859-1')
+    return str(path)
+
+
+def canonical(root):
+    """Whitespace insensitive serialization of a datasets.xml tree."""
+    for el in root.iter():
+        if el.text is not None and not el.text.strip():
+            el.text = None
+        if el.tail is not None and not el.tail.strip():
+            el.tail = None
+    return etree.tostring(root, method='c14n')
+
+
+def read(path):
+    return canonical(etree.parse(path).getroot())
+
+
+def expected(path, edit):
+    root = etree.parse(path).getroot()
+    edit(root)
+    return canonical(root)
+
+
+def by_id(root, dsid):
+    return root.find(f'dataset[@datasetID="{dsid}"]')
+
+
+def add(root, dsid, **kwargs):
+    root.append(etree.fromstring(dataset(dsid, **kwargs)))
+
+
+def swap(root, dsid, **kwargs):
+    old = by_id(root, dsid)
+    old.getparent().replace(old, etree.fromstring(dataset(dsid, **kwargs)))
+
+
+def drop(root, dsid):
+    root.remove(by_id(root, dsid))
+
+
+def check_index(path, store):
+    """The index kept up to date by the edits equals one rebuilt from scratch."""
+    fresh = DatasetsXML(path, index_path=f'{path}.fresh')
+    assert store.ids() == fresh.ids()
+    for dsid in fresh.ids():
+        assert store.get_bytes(dsid) == fresh.get_bytes(dsid)
+
+
+def test_insert(dsxml):
+    want = expected(dsxml, lambda root: add(root, 'new', title='New'))
+    store = DatasetsXML(dsxml)
+    assert store.insert(dataset('new', title='New')) == 'new'
+    assert read(dsxml) == want
+    check_index(dsxml, store)
+
+
+def test_replace(dsxml):
+    want = expected(dsxml, lambda root: swap(root, 'ds_2', title='A much longer title'))
+    store = DatasetsXML(dsxml)
+    store.replace('ds_2', dataset('ds_2', title='A much longer title'))
+    assert read(dsxml) == want
+    check_index(dsxml, store)
+
+
+def test_remove(dsxml):
+    want = expected(dsxml, lambda root: drop(root, 'ds_0'))
+    store = DatasetsXML(dsxml)
+    store.remove('ds_0')
+    assert read(dsxml) == want
+    check_index(dsxml, store)
+
+
+def test_toggle(dsxml):
+    want = expected(dsxml, lambda root: by_id(root, 'ds_3').set('active', 'false'))
+    store = DatasetsXML(dsxml)
+    store.toggle('ds_3', False)
+    assert read(dsxml) == want
+    check_index(dsxml, store)
+
+
+def test_apply(dsxml):
+    def edit(root):
+        swap(root, 'ds_1', title='Replaced')
+        drop(root, 'ds_4')
+        by_id(root, 'ds_0').set('active', 'false')
+        add(root, 'new_a')
+        add(root, 'new_b', active='false')
+
+    want = expected(dsxml, edit)
+    store = DatasetsXML(dsxml)
+    results = store.apply([
+        [('replace', 'ds_1', dataset('ds_1', title='Replaced')), ('remove', 'ds_4')],
+        [('toggle', 'ds_0', False), ('insert', dataset('new_a'))],
+        # All or nothing: the unknown dataset holds back the whole group
+        [('remove', 'ds_2'), ('toggle', 'missing', False)],
+        [('put', dataset('new_b', active='false')), ('put', dataset('ds_3', title='Dataset 3'))],
+        [('insert', '<dataset datasetID="broken"><fileDir></dataset>')],
+    ])
+    assert results[:2] == [None, None] and results[3] is None
+    assert isinstance(results[2], KeyError)
+    assert isinstance(results[4], ValueError)
+    assert read(dsxml) == want
+    check_index(dsxml, store)
+
+
+def _commit(path, worker, count):
+    for i in range(count):
+        with Transaction(path, timeout=120) as txn:
+            txn.insert(dataset(f'w{worker}_{i}'))
+            txn.toggle(f'ds_{worker % 5}', i % 2 == 1)
+
+
+def test_concurrent_transactions(dsxml):
+    workers, count = 6, 10
+    context = multiprocessing.get_context('spawn')
+    procs = [context.Process(target=_commit, args=(dsxml, w, count)) for w in range(workers)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(300)
+        assert p.exitcode == 0
+
+    root = etree.parse(dsxml).getroot()
+    ids = [el.get('datasetID') for el in root.iter('dataset')]
+    assert len(ids) == len(set(ids)) == 5 + workers * count
+    assert set(ids) >= {f'w{w}_{i}' for w in range(workers) for i in range(count)}
+    check_index(dsxml, DatasetsXML(dsxml))
+    assert not [f for f in os.listdir(f'{dsxml}.queue') if f.endswith('.json')]
+
+
+def _commit_in_thread(dsxml, fragment, timeout):
+    out = {}
+
+    def commit():
+        try:
+            with Transaction(dsxml, timeout=timeout) as txn:
+                txn.insert(fragment)
+        except Exception as e:
+            out['error'] = e
+    thread = threading.Thread(target=commit)
+    thread.start()
+    queue = f'{dsxml}.queue'
+    while not (os.path.isdir(queue) and [f for f in os.listdir(queue) if f.endswith('.json')]):
+        time.sleep(0.01)
+    return thread, out
+
+
+def test_timed_out_commit_claimed_by_a_drainer(dsxml, monkeypatch):
+    drainer = Transaction(dsxml)
+    with FileLock(drainer.lock_path):
+        thread, out = _commit_in_thread(dsxml, dataset('late'), timeout=0.2)
+        apply = DatasetsXML.apply
+
+        def slow_apply(self, *args, **kwargs):
+            # The committer gives up on the lock while its edit is being written
+            time.sleep(0.6)
+            return apply(self, *args, **kwargs)
+        monkeypatch.setattr(DatasetsXML, 'apply', slow_apply)
+        drainer._drain(None)
+    thread.join(10)
+
+    assert out == {}
+    assert 'late' in DatasetsXML(dsxml)
+    assert os.listdir(drainer.queue_dir) == []
+
+
+def test_timed_out_commit_withdrawn(dsxml):
+    with open(dsxml, 'rb') as f:
+        before = f.read()
+    lock = FileLock(Transaction(dsxml).lock_path)
+    with lock:
+        thread, out = _commit_in_thread(dsxml, dataset('late'), timeout=0.2)
+        thread.join(10)
+        assert isinstance(out['error'], TimeoutError)
+    assert os.listdir(f'{dsxml}.queue') == []
+    with Transaction(dsxml) as txn:
+        txn.insert(dataset('other'))
+    assert 'late' not in DatasetsXML(dsxml)
+    with open(dsxml, 'rb') as f:
+        assert f.read().startswith(before[:-len(b'</erddapDatasets>\n')])
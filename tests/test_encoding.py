@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+from netCDF4 import Dataset
+
+from erddapds.core import ERDDAPDATASET
+from erddapds.encoding import (PROFILES,
+                               apply_profile,
+                               chunk_shape,
+                               profile_encoding)
+
+
+@pytest.mark.parametrize('profile, grid, series', [
+    ('append-optimized', (13, 100, 200), (65536,)),
+    ('timeseries-read', (4096, 8, 8), (65536,)),
+    ('spatial-read', (1, 100, 200), (65536,)),
+])
+def test_chunk_shape(profile, grid, series):
+    assert chunk_shape(('time', 'y', 'x'), (10, 100, 200), 4, profile) == grid
+    assert chunk_shape(('time',), (10,), 8, profile) == series
+
+
+def test_chunk_shape_fits_large_records():
+    # 8MB per time step: the largest dimension is halved until a record fits in 1MB
+    assert chunk_shape(('time', 'y', 'x'), (5, 1000, 1000), 8, 'spatial-read') == (1, 250, 500)
+    assert chunk_shape(('time', 'y', 'x'), (5, 1000, 1000), 8, 'append-optimized',
+                       chunk_bytes='16MB') == (2, 1000, 1000)
+
+
+def make_dataset(hours, depths=3):
+    values = np.arange(len(hours) * depths, dtype='f4').reshape(len(hours), depths) + hours[0]
+    return xr.Dataset(
+        {'temperature': (('time', 'depth'), values),
+         'station': ('time', np.array(['a'] * len(hours), dtype=object))},
+        coords={'time': ('time', np.array(hours, dtype='f8') * 3600,
+                         {'units': 'seconds since 2024-01-01'}),
+                'depth': ('depth', np.arange(depths, dtype='f4'))})
+
+
+def test_apply_profile():
+    ds = make_dataset([0, 1])
+    ds['temperature'].encoding = {'chunksizes': (1, 1), 'contiguous': False, 'dtype': 'f4'}
+    apply_profile(ds, 'timeseries-read')
+    assert ds['temperature'].encoding == {'dtype': 'f4', 'zlib': True, 'complevel': 4,
+                                          'shuffle': True, 'chunksizes': (65536, 3)}
+    assert ds['station'].encoding == {}
+    with pytest.raises(ValueError):
+        profile_encoding(ds, 'fast')
+
+
+def written(path, name='temperature'):
+    with Dataset(path, 'r') as nc:
+        var = nc.variables[name]
+        return var.chunking(), var.filters()['complevel']
+
+
+def deliver(path, hours):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    make_dataset(hours).drop_vars('station').to_netcdf(path, unlimited_dims='time')
+    return str(path)
+
+
+@pytest.mark.parametrize('profile', list(PROFILES))
+def test_merge_writes_the_profile(tmp_path, profile):
+    datadir, bpd = tmp_path / 'data', tmp_path / 'bpd'
+    os.makedirs(bpd / 'flag')
+    ncfile = deliver(datadir / 'mooring.nc', [0, 1])
+    newFile = deliver(tmp_path / 'new' / 'mooring.nc', [2, 3])
+    out = ERDDAPDATASET('mooring').update_dataset(str(datadir), newFile, str(bpd), '',
+                                                  encoding_profile=profile)
+    assert not isinstance(out, Exception), out
+    chunks = chunk_shape(('time', 'depth'), (4, 3), 4, profile)
+    assert written(ncfile) == (list(chunks), PROFILES[profile]['complevel'])
+
+
+@pytest.mark.parametrize('profile', list(PROFILES))
+def test_partitions_write_the_profile(tmp_path, profile):
+    datadir, bpd = tmp_path / 'data', tmp_path / 'bpd'
+    os.makedirs(datadir)
+    os.makedirs(bpd / 'flag')
+    edd = ERDDAPDATASET('mooring')
+    for name, hours in (('a', [0, 1]), ('b', [2, 25])):
+        newFile = deliver(tmp_path / name / 'mooring.nc', hours)
+        out = edd.update_dataset(str(datadir), newFile, str(bpd), '', layout='partitioned',
+                                 encoding_profile=profile)
+        assert not isinstance(out, Exception), out
+    chunks = list(chunk_shape(('time', 'depth'), (1, 3), 4, profile))
+    complevel = PROFILES[profile]['complevel']
+    # Merged into an existing partition, and a new one
+    assert written(datadir / 'mooring_20240101.nc') == (chunks, complevel)
+    assert written(datadir / 'mooring_20240102.nc') == (chunks, complevel)
@@ -0,0 +1,33 @@
+import os
+import time
+
+from erddapds.flags import FlagWriter
+from erddapds.utils import update_datasetsxml
+
+
+def flags(bpd):
+    return sorted(os.listdir(os.path.join(bpd, 'flag')))
+
+
+def test_nested_writer_hands_flags_to_the_outer_one(tmp_path):
+    bpd = str(tmp_path)
+    os.makedirs(os.path.join(bpd, 'flag'))
+    with FlagWriter(bpd) as outer:
+        with FlagWriter(bpd) as inner:
+            inner.flag('a')
+            update_datasetsxml(bpd, 'b')
+        assert flags(bpd) == []
+        assert outer.pending == ['a', 'b']
+    assert flags(bpd) == ['a', 'b']
+
+
+def test_debounce_window_coalesces_flags(tmp_path):
+    bpd = str(tmp_path)
+    os.makedirs(os.path.join(bpd, 'flag'))
+    with FlagWriter(bpd, debounce=0.2) as writer:
+        for _ in range(3):
+            update_datasetsxml(bpd, 'a')
+        assert flags(bpd) == []
+        time.sleep(0.5)
+        assert flags(bpd) == ['a']
+        assert writer.pending == []
@@ -0,0 +1,81 @@
+import copy
+import os
+
+import numpy as np
+from lxml import etree
+import xarray as xr
+
+from erddapds.core import METADATA
+from erddapds.generate import (FragmentCache,
+                               native_fragment)
+from erddapds.transform import TransformPlan
+from erddapds.utils import update_xml
+
+DETAILS = {'fileNameRegex': r'model\.nc', 'title': 'Model', 'summary': 'Model output',
+           'type': 'model'}
+
+
+def test_native_grid_fragment_without_index_coordinates(tmp_path):
+    xr.Dataset(
+        {'temperature': (('time', 'y', 'x'), np.zeros((2, 3, 4), dtype='f4'), {'units': 'degC'})},
+        coords={'time': ('time', [0., 1.], {'units': 'hours since 1970-01-01'})},
+    ).to_netcdf(tmp_path / 'model.nc')
+
+    root = etree.fromstring(native_fragment('EDDGridFromNcFiles', str(tmp_path), r'.*\.nc'))
+    for name in ('y', 'x'):
+        attrs = root.find(f'axisVariable[sourceName="{name}"]/addAttributes')
+        assert attrs.find('att[@name="long_name"]') is not None
+
+    # The fragment feeds straight into both transforms, with the same result
+    old = copy.deepcopy(root)
+    update_xml(old, 'model', copy.deepcopy(METADATA), DETAILS, {})
+    new = TransformPlan(copy.deepcopy(METADATA), DETAILS, {}).apply(copy.deepcopy(root), 'model')
+    assert etree.tostring(new) == etree.tostring(old)
+    assert old.find('axisVariable[sourceName="y"]/destinationName').text == 'gridY'
+
+
+def gds_setup(tmp_path):
+    gds_loc = tmp_path / 'GenerateDatasetsXml.sh'
+    gds_loc.write_text('java GenerateDatasetsXml "$@"\n')
+    datadir = tmp_path / 'data'
+    os.makedirs(datadir)
+    (datadir / 'model.nc').write_bytes(b'0' * 10)
+    return str(gds_loc), ['EDDGridFromNcFiles', str(datadir), r'.*\.nc']
+
+
+def test_fragment_cache_hit_and_miss(tmp_path):
+    gds_loc, args = gds_setup(tmp_path)
+    cache = FragmentCache(tmp_path / 'cache')
+    key = cache.key(gds_loc, args)
+    assert cache.get(key) is None
+    cache.put(key, b'<dataset />')
+    assert cache.get(cache.key(gds_loc, args)) == b'<dataset />'
+
+    # A new data file, or a changed one, is a different key
+    (tmp_path / 'data' / 'model2.nc').write_bytes(b'1')
+    assert cache.get(cache.key(gds_loc, args)) is None
+    cache.put(cache.key(gds_loc, args), b'<dataset />')
+    os.utime(tmp_path / 'data' / 'model.nc', (1000, 1000))
+    assert cache.get(cache.key(gds_loc, args)) is None
+    # Files the regex leaves out do not count
+    cache.put(cache.key(gds_loc, args), b'<dataset />')
+    (tmp_path / 'data' / 'notes.txt').write_text('x')
+    assert cache.get(cache.key(gds_loc, args)) == b'<dataset />'
+
+
+def test_fragment_cache_evicts_least_recently_used(tmp_path):
+    gds_loc, args = gds_setup(tmp_path)
+    cache = FragmentCache(tmp_path / 'cache', max_bytes=250)
+    keys = [cache.key(gds_loc, args[:1] + [f'arg{i}']) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        cache.put(key, b'x' * 100)
+        os.utime(cache._path(key), (1000 + i, 1000 + i))
+    # Reading the oldest entry makes it the most recently used
+    assert cache.get(keys[0]) == b'x' * 100
+    cache.put(keys[2], b'x' * 100)
+    assert [cache.get(key) is not None for key in keys] == [True, False, True]
+
+    cache.invalidate(gds_loc, args[:1] + ['arg0'])
+    assert cache.get(keys[0]) is None and cache.get(keys[2]) is not None
+    cache.invalidate()
+    assert os.listdir(tmp_path / 'cache') == []
@@ -0,0 +1,35 @@
+import pytest
+
+from erddapds.manifest import (create_datasets,
+                               gds_args)
+
+ENTRY = {'dsid': 'model', 'datadir': '/data/model',
+         'details': {'fileNameRegex': r'.*\.nc'}, 'title': 'Model'}
+
+
+def test_gds_args_table_prompts():
+    args = gds_args(ENTRY)
+    assert args[:3] == ['EDDTableFromNcCFFiles', '/data/model', r'.*\.nc']
+    assert args[-1] == 'Model'
+    assert len(args) == 14
+
+
+def test_gds_args_grid_prompts():
+    args = gds_args(dict(ENTRY, type='EDDGridFromNcFiles'))
+    assert args == ['EDDGridFromNcFiles', '/data/model', r'.*\.nc', '', '', '', '', '']
+
+
+def test_gds_args_unknown_type_needs_args():
+    with pytest.raises(ValueError):
+        gds_args(dict(ENTRY, type='EDDGridFromDap'))
+    args = gds_args(dict(ENTRY, type='EDDGridFromDap', args=['http://example.com/dap', 10080]))
+    assert args == ['EDDGridFromDap', 'http://example.com/dap', '10080']
+
+
+def test_create_datasets_reports_entries_without_args(tmp_path):
+    dsxml = tmp_path / 'datasets.xml'
+    dsxml.write_text('<?xml version="1.0" encoding="UTF-8"?>\n<erddapDatasets>\n</erddapDatasets>\n')
+    manifest = {'datasetsxml': str(dsxml), 'bpd': str(tmp_path),
+                'datasets': [dict(ENTRY, type='EDDGridFromDap')]}
+    results = create_datasets(manifest)
+    assert isinstance(results['model'], ValueError)
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from erddapds import metrics
+from erddapds.metrics import (PrometheusCollector,
+                              add_listener,
+                              collect,
+                              phase,
+                              remove_listener)
+
+
+def test_phase_without_listeners():
+    assert metrics._LISTENERS == []
+    with phase('update_dataset', 'merge', 'mooring') as p:
+        p.add(nbytes=10, records=2)
+    assert p is metrics._NULL_PHASE
+
+
+def test_phase_with_listeners():
+    phases = []
+    listener = add_listener(phases.append)
+
+    def broken(p):
+        raise RuntimeError('listener bug')
+    add_listener(broken)
+    try:
+        with phase('update_dataset', 'merge', 'mooring') as p:
+            p.add(nbytes=10, records=2)
+            p.add(nbytes=5)
+        with pytest.raises(KeyError):
+            with phase('update_dataset', 'flag'):
+                raise KeyError('mooring')
+    finally:
+        remove_listener(listener)
+        remove_listener(broken)
+
+    assert [(p.name, p.nbytes, p.records, p.error) for p in phases] == \
+        [('merge', 15, 2, None), ('flag', 0, 0, 'KeyError')]
+    assert phases[0].dsid == 'mooring' and phases[1].dsid is None
+    assert phases[0].seconds >= 0 and phases[0].process_peak_rss_kb > 0
+    assert list(phases[0].as_dict()) == list(metrics.Phase.__slots__)
+    assert metrics._LISTENERS == []
+
+
+def test_prometheus_render():
+    collector = PrometheusCollector(prefix='test')
+    for seconds, error in ((1.5, None), (0.5, None), (2.0, 'ValueError')):
+        p = metrics.Phase('update_dataset', 'merge', 'mooring')
+        p.seconds, p.error, p.process_peak_rss_kb = seconds, error, 2
+        p.add(nbytes=100, records=3)
+        collector(p)
+
+    lines = collector.render().splitlines()
+    labels = 'operation="update_dataset",phase="merge",dataset="mooring"'
+    assert lines[:4] == ['# HELP test_phase_total Phases run',
+                         '# TYPE test_phase_total counter',
+                         f'test_phase_total{{{labels},error="false"}} 2',
+                         f'test_phase_total{{{labels},error="true"}} 1']
+    assert f'test_phase_seconds_total{{{labels},error="false"}} 2.0' in lines
+    assert f'test_phase_bytes_total{{{labels},error="false"}} 200' in lines
+    assert f'test_phase_records_total{{{labels},error="true"}} 3' in lines
+    assert lines[-3:] == ['# HELP test_peak_rss_bytes Peak resident memory of the process',
+                          '# TYPE test_peak_rss_bytes gauge',
+                          'test_peak_rss_bytes 2048']
+
+
+def test_collect_removes_its_listeners(tmp_path):
+    json_path, prom_path = tmp_path / 'phases.jsonl', tmp_path / 'metrics.prom'
+    with pytest.raises(ValueError):
+        with collect(str(json_path), str(prom_path)) as collector:
+            assert len(metrics._LISTENERS) == 2
+            with phase('generate_datasetxml', 'gds', 'mooring') as p:
+                p.add(records=1)
+            raise ValueError('failed run')
+    assert metrics._LISTENERS == []
+
+    [line] = json_path.read_text().splitlines()
+    assert json.loads(line)['name'] == 'gds'
+    assert prom_path.read_text() == collector.render()
+    assert 'erddapds_phase_total{operation="generate_datasetxml"' in prom_path.read_text()
+
+    with collect() as collector:
+        assert collector is None and metrics._LISTENERS == []
@@ -0,0 +1,174 @@
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from erddapds import ncutils
+from erddapds.ncutils import (append_netcdf,
+                              dedup_netcdf,
+                              merge_datasets,
+                              time_overlap,
+                              write_checkpointed)
+
+
+def make_dataset(t0, values, salinity=None):
+    data = {'temperature': ('time', np.array(values, dtype='f4'))}
+    if salinity is not None:
+        data['salinity'] = ('time', np.array(salinity, dtype='f4'))
+    data['flag'] = ('time', np.arange(len(values), dtype='i2') + t0, {'_FillValue': np.int16(-1)})
+    return xr.Dataset(data, coords={'time': ('time', np.arange(t0, t0 + len(values), dtype='f8'))})
+
+
+def test_time_overlap():
+    appended, (new_idx, old_idx), inserted = time_overlap(
+        np.array([0., 1., 2., 4.]), np.array([5., 2., 3., 6., 5.]))
+    np.testing.assert_array_equal(appended, [4, 3])
+    np.testing.assert_array_equal(new_idx, [1])
+    np.testing.assert_array_equal(old_idx, [2])
+    np.testing.assert_array_equal(inserted, [2])
+
+
+@pytest.mark.parametrize('policy, expected', [
+    ('keep-newest', [0, 1, 20, 30, 40]),
+    ('keep-oldest', [0, 1, 2, 30, 40]),
+])
+def test_merge_datasets_policies(policy, expected):
+    old = make_dataset(0, [0, 1, 2])
+    new = make_dataset(2, [20, 30, 40])
+    merged = merge_datasets([old, new], policy=policy)
+    np.testing.assert_array_equal(merged['time'].values, [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(merged['temperature'].values, expected)
+    assert merged['flag'].dtype == np.dtype('i2')
+
+
+def test_merge_datasets_reject():
+    with pytest.raises(ValueError):
+        merge_datasets([make_dataset(0, [0, 1, 2]), make_dataset(2, [20])], policy='reject')
+
+
+def test_merge_datasets_fills_missing_values():
+    old = make_dataset(0, [0, 1], salinity=[30, 31])
+    new = make_dataset(1, [10, 20])
+    merged = merge_datasets([old, new], policy='keep-newest')
+    np.testing.assert_array_equal(merged['temperature'].values, [0, 10, 20])
+    np.testing.assert_array_equal(merged['salinity'].values[:2], [30, 31])
+    assert np.isnan(merged['salinity'].values[2])
+
+
+def test_merge_datasets_stays_lazy():
+    dask = pytest.importorskip('dask')
+    old = make_dataset(0, np.arange(100)).chunk({'time': 10})
+    new = make_dataset(90, np.arange(20)).chunk({'time': 10})
+    merged = merge_datasets([old, new], policy='keep-newest', block=10)
+    assert dask.is_dask_collection(merged['temperature'].data)
+    assert merged.chunks['time'] == (10,) * 11
+
+
+def test_merge_datasets_fails_on_conflicts_by_default():
+    old = make_dataset(0, [0, 1, 2])
+    with pytest.raises(ValueError, match='conflicting values'):
+        merge_datasets([old, make_dataset(2, [20, 30])])
+
+
+def test_merge_datasets_without_conflicts():
+    old = make_dataset(0, [0, 1, np.nan])
+    new = make_dataset(1, [1, 2, 3])
+    merged = merge_datasets([old, new])
+    np.testing.assert_array_equal(merged['time'].values, [0, 1, 2, 3])
+    np.testing.assert_array_equal(merged['temperature'].values, [0, 1, 2, 3])
+
+
+def write_file(path, times, values):
+    ds = make_dataset(0, values).assign_coords(time=np.array(times, dtype='f8'))
+    ds['time'].attrs['units'] = 'hours since 2024-01-01'
+    ds.to_netcdf(path, unlimited_dims='time')
+    return str(path)
+
+
+def test_append_netcdf(tmp_path):
+    ncfile = write_file(tmp_path / 'a.nc', [0, 1, 2], [0, 1, 2])
+    assert append_netcdf(ncfile, write_file(tmp_path / 'b.nc', [3, 4], [3, 4])) == 2
+    with xr.open_dataset(ncfile, decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['time'].values, [0, 1, 2, 3, 4])
+        np.testing.assert_array_equal(ds['temperature'].values, [0, 1, 2, 3, 4])
+
+
+@pytest.mark.parametrize('times', [[4, 5, 1], [4, 4], [2, 5], [-1]])
+def test_append_netcdf_keeps_time_order(tmp_path, times):
+    ncfile = write_file(tmp_path / 'a.nc', [0, 1, 2, 3, 4], np.arange(5))
+    with pytest.raises(ValueError):
+        append_netcdf(ncfile, write_file(tmp_path / 'b.nc', times, np.arange(len(times))))
+    with xr.open_dataset(ncfile, decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['time'].values, [0, 1, 2, 3, 4])
+
+
+@pytest.mark.parametrize('policy', ['keep-newest', 'keep-oldest', 'reject'])
+@pytest.mark.parametrize('times, counts', [
+    ([1, 3], {'appended': 0, 'inserted': 2, 'replaced': 0, 'skipped': 0}),
+    ([5, 6], {'appended': 2, 'inserted': 0, 'replaced': 0, 'skipped': 0}),
+    ([0, 2, 4], {'appended': 0, 'inserted': 0, 'replaced': 3, 'skipped': 0}),
+    ([2, 3, 6], {'appended': 1, 'inserted': 1, 'replaced': 1, 'skipped': 0}),
+])
+def test_dedup_netcdf(tmp_path, policy, times, counts):
+    ncfile = write_file(tmp_path / 'a.nc', [0, 2, 4], [0, 2, 4])
+    newFile = write_file(tmp_path / 'b.nc', times, np.array(times) * 10)
+    duplicated = sorted(set(times) & {0, 2, 4})
+    if policy == 'reject' and duplicated:
+        with pytest.raises(ValueError):
+            dedup_netcdf(ncfile, newFile, policy=policy)
+        expected = {0: 0, 2: 2, 4: 4}
+    else:
+        if policy == 'keep-oldest':
+            counts = dict(counts, replaced=0, skipped=counts['replaced'])
+        assert dedup_netcdf(ncfile, newFile, policy=policy) == counts
+        expected = {t: t * 10 for t in times}
+        if policy == 'keep-oldest':
+            expected.update({t: t for t in duplicated})
+        expected.update({t: t for t in (0, 2, 4) if t not in times})
+    with xr.open_dataset(ncfile, decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['time'].values, sorted(expected))
+        np.testing.assert_array_equal(ds['temperature'].values,
+                                      [expected[t] for t in sorted(expected)])
+
+
+def crash_after(monkeypatch, blocks):
+    """Make write_checkpointed fail once blocks blocks are journaled."""
+    write_journal = ncutils._write_journal
+
+    def journal(path, key, done):
+        write_journal(path, key, done)
+        if done >= blocks * 10:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(ncutils, '_write_journal', journal)
+
+
+def checkpointed(tmp_path):
+    source = write_file(tmp_path / 'source.nc', np.arange(100), np.arange(100))
+    ds = xr.open_dataset(source, decode_cf=False, chunks={'time': 10})
+    return ds, str(tmp_path / 'partial.nc'), str(tmp_path / 'out.nc'), [source]
+
+
+@pytest.mark.parametrize('damage', [None, 'truncate', 'shorten'])
+def test_write_checkpointed_resumes_after_crash(tmp_path, monkeypatch, damage):
+    pytest.importorskip('dask')
+    ds, path, target, inputs = checkpointed(tmp_path)
+    crash_after(monkeypatch, 4)
+    with pytest.raises(KeyboardInterrupt):
+        write_checkpointed(ds, path, target, inputs, 10)
+    monkeypatch.undo()
+    assert os.path.exists(f'{path}.journal')
+
+    if damage == 'truncate':
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) // 2)
+    elif damage == 'shorten':
+        os.remove(path)
+        ds.isel(time=slice(0, 10)).to_netcdf(path, unlimited_dims='time')
+
+    written = write_checkpointed(ds, path, target, inputs, 10)
+    assert written == (60 if damage is None else 100)
+    assert not os.path.exists(path) and not os.path.exists(f'{path}.journal')
+    with xr.open_dataset(target, decode_cf=False) as out:
+        xr.testing.assert_identical(out.load(), ds.load())
+    ds.close()
@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+from erddapds.core import ERDDAPDATASET
+
+
+def deliver(path, hours, values):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    xr.Dataset(
+        {'temperature': ('time', np.array(values, dtype='f4'))},
+        coords={'time': ('time', np.array(hours, dtype='f8') * 3600,
+                         {'units': 'seconds since 2024-01-01'})},
+    ).to_netcdf(path, unlimited_dims='time')
+    return str(path)
+
+
+def test_partitioned_merge_resolves_redelivered_records(tmp_path):
+    datadir, bpd = tmp_path / 'data', tmp_path / 'bpd'
+    os.makedirs(datadir)
+    os.makedirs(bpd / 'flag')
+    edd = ERDDAPDATASET('mooring')
+
+    def update(name, hours, values):
+        newFile = deliver(tmp_path / name / 'mooring.nc', hours, values)
+        out = edd.update_dataset(str(datadir), newFile, str(bpd), '', layout='partitioned',
+                                 partition='hourly', overlap='keep-newest')
+        assert not isinstance(out, Exception), out
+
+    update('a', [0, 0.5, 1], [0, 1, 2])
+    update('b', [0.5, 0.75, 1], [10, 15, 20])
+
+    with xr.open_dataset(datadir / 'mooring_2024010100.nc', decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['time'].values, [0, 1800, 2700])
+        np.testing.assert_array_equal(ds['temperature'].values, [0, 10, 15])
+    with xr.open_dataset(datadir / 'mooring_2024010101.nc', decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['temperature'].values, [20])
+
+    assert edd.compact_partitions(str(datadir), 'mooring.nc', older_than=0) == \
+        [str(datadir / 'mooring_20240101.nc')]
+    with xr.open_dataset(datadir / 'mooring_20240101.nc', decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['temperature'].values, [0, 10, 15, 20])
+    assert os.listdir(datadir) == ['mooring_20240101.nc']
+
+
+def test_redelivery_after_compaction(tmp_path):
+    datadir, bpd = tmp_path / 'data', tmp_path / 'bpd'
+    os.makedirs(datadir)
+    os.makedirs(bpd / 'flag')
+    edd = ERDDAPDATASET('mooring')
+
+    def update(name, hours, values):
+        newFile = deliver(tmp_path / name / 'mooring.nc', hours, values)
+        out = edd.update_dataset(str(datadir), newFile, str(bpd), '', layout='partitioned',
+                                 partition='hourly', overlap='keep-newest')
+        assert not isinstance(out, Exception), out
+
+    update('a', [0, 1], [0, 1])
+    update('b', [2, 3], [2, 3])
+    edd.compact_partitions(str(datadir), 'mooring.nc', older_than=0)
+
+    # Hour 1 again, and a new hour 4: both go to the daily partition
+    update('c', [1, 4], [10, 4])
+    partitions = [f for f in os.listdir(datadir) if f.endswith('.nc')]
+    assert partitions == ['mooring_20240101.nc']
+    assert edd.compact_partitions(str(datadir), 'mooring.nc', older_than=0) == []
+    with xr.open_dataset(datadir / 'mooring_20240101.nc', decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['time'].values / 3600, [0, 1, 2, 3, 4])
+        np.testing.assert_array_equal(ds['temperature'].values, [0, 10, 2, 3, 4])
+
+
+def test_compaction_resolves_duplicated_records(tmp_path):
+    datadir = tmp_path / 'data'
+    os.makedirs(datadir)
+    deliver(datadir / 'mooring_20240101.nc', [0, 1], [0, 1])
+    deliver(datadir / 'mooring_2024010101.nc', [1, 2], [10, 2])
+    edd = ERDDAPDATASET('mooring')
+    edd.compact_partitions(str(datadir), 'mooring.nc', older_than=0)
+    with xr.open_dataset(datadir / 'mooring_20240101.nc', decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['time'].values / 3600, [0, 1, 2])
+        np.testing.assert_array_equal(ds['temperature'].values, [0, 10, 2])
+
+
+def test_partitioned_merge_fails_on_conflicts_by_default(tmp_path):
+    datadir, bpd = tmp_path / 'data', tmp_path / 'bpd'
+    os.makedirs(datadir)
+    os.makedirs(bpd / 'flag')
+    edd = ERDDAPDATASET('mooring')
+    for name, values in (('a', [0, 1]), ('b', [1, 2])):
+        newFile = deliver(tmp_path / name / 'mooring.nc', [0, 1], values)
+        out = edd.update_dataset(str(datadir), newFile, str(bpd), '', layout='partitioned')
+    assert isinstance(out, ValueError)
+    with xr.open_dataset(datadir / 'mooring_20240101.nc', decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['temperature'].values, [0, 1])
@@ -0,0 +1,79 @@
+import copy
+import os
+
+import pytest
+import yaml
+from lxml import etree
+
+from erddapds.transform import TransformPlan
+from erddapds.utils import update_xml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(HERE, '..', 'examples', 'config.yml')) as f:
+    CONFIG = yaml.safe_load(f)
+CONFIG['metadata']['cdm_data_type'] = {'text': 'Station'}
+
+GLOBALS = '''
+    <addAttributes>
+        <att name="cdm_data_type">Grid</att>
+        <att name="institution">???</att>
+        <att name="keywords">ocean</att>
+        <att name="license">???</att>
+        <att name="summary">???</att>
+        <att name="title">???</att>
+    </addAttributes>'''
+
+AXIS = '''
+    <axisVariable>
+        <sourceName>{0}</sourceName>
+        <destinationName>{0}</destinationName>
+        <addAttributes>
+            <att name="long_name">{0}</att>
+            <att name="source_name">{0}</att>
+            <att name="standard_name">{0}</att>
+            <att name="units">1</att>
+        </addAttributes>
+    </axisVariable>'''
+
+VARIABLE = '''
+    <dataVariable>
+        <sourceName>{0}</sourceName>
+        <destinationName>{0}</destinationName>
+        <dataType>float</dataType>
+        <addAttributes>
+            <att name="long_name">{0}</att>{1}
+        </addAttributes>
+    </dataVariable>'''
+
+
+def fragment(edd_type, axes=(), variables=()):
+    body = GLOBALS + ''.join(AXIS.format(a) for a in axes) + ''.join(
+        VARIABLE.format(v, '\n            <att name="colorBarMaximum">1</att>' if v == 'salinity' else '')
+        for v in variables)
+    return (f'<dataset type="{edd_type}" datasetID="generated" active="true">'
+            f'<fileNameRegex>.*</fileNameRegex>{body}</dataset>')
+
+
+@pytest.mark.parametrize('xml, details, dataset_vars', [
+    (fragment('EDDTableFromNcCFFiles', variables=('time', 'temperature', 'salinity', 'sal')),
+     CONFIG['details'], {'sal': {'destinationName': 'practical_salinity'}}),
+    (fragment('EDDGridFromNcFiles', axes=('time', 'depth', 'y', 'x'),
+              variables=('temperature', 'ssh', 'nitrate')),
+     dict(CONFIG['details'], keywords='model, ocean'), {}),
+    (fragment('EDDGridFromNcFiles', axes=('time', 'y', 'x'), variables=('ssh',)),
+     dict(CONFIG['details'], type='tide gauge'), {}),
+])
+@pytest.mark.parametrize('dsid', ['mooring', 'Bathymetry'])
+def test_plan_matches_update_xml(xml, details, dataset_vars, dsid):
+    parser = etree.XMLParser(remove_blank_text=True)
+    old = etree.fromstring(xml, parser)
+    update_xml(old, dsid, copy.deepcopy(CONFIG['metadata']), details, dataset_vars)
+
+    plan = TransformPlan(copy.deepcopy(CONFIG['metadata']), details, dataset_vars)
+    new = plan.apply(etree.fromstring(xml, parser), dsid)
+    assert etree.tostring(new) == etree.tostring(old)
+
+    # A compiled plan is reusable across fragments
+    again = plan.apply(etree.fromstring(xml, parser), dsid)
+    assert etree.tostring(again) == etree.tostring(old)
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from erddapds.core import ERDDAPDATASET
+from erddapds.metrics import (add_listener,
+                              remove_listener)
+from erddapds.zarrstore import (append_zarr,
+                                netcdf_to_zarr)
+
+pytest.importorskip('zarr')
+
+
+def make_file(path, t0, values):
+    values = np.array(values, dtype='f8')
+    ds = xr.Dataset(
+        {'packed': ('time', values), 'scaled': ('time', values)},
+        coords={'time': ('time', np.arange(t0, t0 + len(values), dtype='f8'),
+                         {'units': 'hours since 1970-01-01'})})
+    ds['packed'].encoding = {'dtype': 'int16', 'scale_factor': 0.1, 'add_offset': 5.0,
+                             '_FillValue': np.int16(-32767)}
+    ds['scaled'].encoding = {'dtype': 'f4', 'scale_factor': 0.5, 'add_offset': 1.0}
+    ds.to_netcdf(path, unlimited_dims='time')
+    return str(path)
+
+
+def test_append_packed_round_trip(tmp_path):
+    store = str(tmp_path / 'mooring.zarr')
+    netcdf_to_zarr(make_file(tmp_path / 'a.nc', 0, [1, 2, 3, 4, 5]), store)
+    appended = append_zarr(store, make_file(tmp_path / 'b.nc', 5, [7, 8, np.nan, 10, 11]))
+    assert appended == 5
+
+    with xr.open_zarr(store) as ds:
+        expected = [1, 2, 3, 4, 5, 7, 8, np.nan, 10, 11]
+        np.testing.assert_allclose(ds['packed'].values, expected, atol=0.05)
+        np.testing.assert_allclose(ds['scaled'].values, expected)
+        assert ds['packed'].encoding['dtype'] == np.dtype('int16')
+    with xr.open_zarr(store, decode_cf=False) as raw:
+        assert raw['packed'].values[7] == -32767
+        assert raw['packed'].values[-1] == 60
+
+
+def test_append_skips_known_and_rejects_earlier_records(tmp_path):
+    store = str(tmp_path / 'mooring.zarr')
+    netcdf_to_zarr(make_file(tmp_path / 'a.nc', 0, [1, 2, 3]), store)
+    assert append_zarr(store, make_file(tmp_path / 'b.nc', 2, [3, 4])) == 1
+    with pytest.raises(ValueError):
+        append_zarr(store, make_file(tmp_path / 'c.nc', -1, [0]))
+    with xr.open_zarr(store, decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['time'].values, [0, 1, 2, 3])
+
+
+def test_update_dataset_migrates_to_zarr(tmp_path):
+    datadir, bpd = tmp_path / 'data', tmp_path / 'bpd'
+    datadir.mkdir()
+    (bpd / 'flag').mkdir(parents=True)
+    ncfile = make_file(datadir / 'mooring.nc', 0, [1, 2, 3])
+    edd = ERDDAPDATASET('mooring')
+    phases = []
+    listener = add_listener(phases.append)
+    try:
+        for t0, name in ((3, 'a'), (5, 'b')):
+            (tmp_path / name).mkdir()
+            newFile = make_file(tmp_path / name / 'mooring.nc', t0, [t0 + 1, t0 + 2])
+            out = edd.update_dataset(str(datadir), newFile, str(bpd), '', layout='zarr')
+            assert not isinstance(out, Exception), out
+    finally:
+        remove_listener(listener)
+
+    # The NetCDF file datasets.xml reads is kept as migrated
+    with xr.open_dataset(ncfile, decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['time'].values, [0, 1, 2])
+    with xr.open_zarr(str(datadir / 'mooring.zarr'), decode_times=False) as ds:
+        np.testing.assert_array_equal(ds['time'].values, np.arange(7))
+    assert [p.records for p in phases if p.name == 'zarr_append'] == [2, 2]
+
+
+def test_update_dataset_creates_zarr_store(tmp_path):
+    datadir, bpd = tmp_path / 'data', tmp_path / 'bpd'
+    datadir.mkdir()
+    (bpd / 'flag').mkdir(parents=True)
+    (tmp_path / 'a').mkdir()
+    newFile = make_file(tmp_path / 'a' / 'mooring.nc', 0, [1, 2, 3])
+    phases = []
+    listener = add_listener(phases.append)
+    try:
+        ERDDAPDATASET('mooring').update_dataset(str(datadir), newFile, str(bpd), '',
+                                                layout='zarr')
+    finally:
+        remove_listener(listener)
+    assert [p.records for p in phases if p.name == 'zarr_append'] == [3]